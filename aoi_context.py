@@ -0,0 +1,127 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aoi_store import aoi_asset_paths, open_aoi_asset, open_aoi_dataarray
+from nwm_index import archive_index
+from qm_tools import _file_stats
+
+
+def stack_spatial_modes(xr_RSM, dtype=np.float64):
+    """
+    Stacks the spatial modes of an AOI once into a (mode x pixel) matrix
+
+    :param xr_RSM: Dataset of the rotated spatial modes (SM_hydro_App.nc)
+    :param dtype: Data type of the matrix (default: float64)
+    :return: Spatial modes (mode x pixel) in the order of xr_RSM.mode
+    """
+    sm = xr_RSM.spatial_modes.transpose('mode', 'lat', 'lon').values
+    return np.ascontiguousarray(sm.reshape(sm.shape[0], -1), dtype=dtype)
+
+
+def _read_only(array, dtype=None):
+    array = np.array(array, dtype=dtype, order='C')
+    array.flags.writeable = False
+    return array
+
+
+class AOIContext:
+    """
+    Static assets of an AOI, loaded once into read-only contiguous NumPy arrays: spatial modes, temporal mean,
+    per-mode sites and RTPC statistics, quantile mapping and permanent water masks and coordinates. The NWM
+    archives are read by point lookups through their index, see nwm_index.py
+
+    Nothing can be modified after loading, so one context is safely shared by all threads and sessions, see
+    get_aoi_context.
+    """
+
+    def __init__(self, AOI_str):
+        """
+        :param AOI_str: Area-Of-Interest
+        """
+        asset_paths = aoi_asset_paths(AOI_str)
+        self.sources = tuple(asset_paths[name] for name in ('SM_hydro_App', 'JRC_perm_water', 'qm_spr_r_mask'))
+        self.source_stats = _file_stats(self.sources)
+        self.AOI_str = AOI_str
+
+        xr_RSM = open_aoi_asset(AOI_str, 'SM_hydro_App').load()
+        modes = xr_RSM.spatial_modes.mode
+        self.modes = _read_only(modes.values)
+        self.hydro_sites = _read_only(xr_RSM.hydro_site.sel(mode=modes).values)
+        self.nwm_sites = _read_only(xr_RSM.nwm_site.sel(mode=modes).values)
+        self.rtpc_mean = _read_only(xr_RSM.model_RTPC_mean_sel.sel(mode=modes).values, np.float64)
+        self.rtpc_std = _read_only(xr_RSM.model_RTPC_std_sel.sel(mode=modes).values, np.float64)
+        self.wf_mean = _read_only(xr_RSM.temporal_mean.values)
+        self.lat = _read_only(xr_RSM.lat.values)
+        self.lon = _read_only(xr_RSM.lon.values)
+        self._sm_matrices = {np.dtype(dtype): _read_only(stack_spatial_modes(xr_RSM, dtype))
+                             for dtype in (np.float64, np.float32)}
+        xr_RSM.close()
+
+        self.bounds = ((float(self.lat.min()), float(self.lon.min())), (float(self.lat.max()), float(self.lon.max())))
+
+        #qm_mask = open_aoi_dataarray(AOI_str, 'qm_pr_r_mask')
+        with open_aoi_dataarray(AOI_str, 'qm_spr_r_mask') as qm_mask:
+            self.qm_mask = _read_only(qm_mask.values == True)
+        with open_aoi_dataarray(AOI_str, 'JRC_perm_water') as jrc_perm_water:
+            self.perm_water = _read_only(jrc_perm_water.values == 1)
+
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('AOIContext is read-only')
+        super().__setattr__(name, value)
+
+    def spatial_modes(self, dtype=np.float64):
+        """
+        :param dtype: Data type of the matrix (default: float64)
+        :return: Spatial modes (mode x pixel), see stack_spatial_modes
+        """
+        sm_matrix = self._sm_matrices.get(np.dtype(dtype))
+        return sm_matrix if sm_matrix is not None else self._sm_matrices[np.dtype(np.float64)].astype(dtype)
+
+    def archive_times(self, in_run_type='archive'):
+        """
+        :param in_run_type: 'archive' or 'biascorrection'
+        :return: Dates of the NWM archive
+        """
+        return pd.DatetimeIndex(archive_index(self.AOI_str, in_run_type).times)
+
+    def archive_discharge(self, in_run_type, nwm_site, dois):
+        """
+        :param in_run_type: 'archive' or 'biascorrection'
+        :param nwm_site: NWM site
+        :param dois: Dates-Of-Interest
+        :return: Archived discharge at the site on each date
+        """
+        return archive_index(self.AOI_str, in_run_type).lookup(nwm_site, dois)
+
+    def is_fresh(self):
+        """
+        :return: Whether the source files are unchanged (size and modification time) since loading
+        """
+        try:
+            return _file_stats(self.sources) == self.source_stats
+        except OSError:
+            return False
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_aoi_context(AOI_str):
+    """
+    Returns the context of an AOI, loaded once per process and reloaded when its source files change
+
+    :param AOI_str: Area-Of-Interest
+    :return: The AOIContext
+    """
+    with _contexts_lock:
+        context = _contexts.get(AOI_str)
+        if context is None or not context.is_fresh():
+            context = AOIContext(AOI_str)
+            _contexts[AOI_str] = context
+    return context
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import xarray as xr
+
+from qm_tools import _atomic_open, _file_stats
+
+# Chunk size along lat/lon of the spatial arrays; requests read whole time series of a tile, so time is not split
+STORE_CHUNK = 256
+
+
+def nwm_archive_paths(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Paths to the archived NWM medium range forecast and to its bias-corrected counterpart
+    """
+    if AOI_str=='MississippiRiver':
+        return 'medium_lt08_tot.nc', 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App_biascorrected.nc'
+    elif AOI_str=='RedRiver':
+        return 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc', 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc'
+
+
+def aoi_asset_paths(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Dictionary of the NetCDF source of each static asset of the AOI
+    """
+    nwm_archive_path, nwm_bias_corrected_archive_path = nwm_archive_paths(AOI_str)
+    return {
+        'SM_hydro_App': 'AOI/'+AOI_str+'/RSM/SM_hydro_App.nc',
+        'JRC_perm_water': 'AOI/'+AOI_str+'/RSM/JRC_perm_water.nc',
+        'qm_pr_r_mask': 'AOI/'+AOI_str+'/for_qm_scaling/qm_pr_r_mask.nc',
+        'qm_spr_r_mask': 'AOI/'+AOI_str+'/for_qm_scaling/qm_spr_r_mask.nc',
+        'hist_real_wf_trim': 'AOI/'+AOI_str+'/for_qm_scaling/hist_real_wf_trim.nc',
+        'hist_syn_wf_trim': 'AOI/'+AOI_str+'/for_qm_scaling/hist_syn_wf_trim.nc',
+        'nwm_archive': nwm_archive_path,
+        'nwm_bias_corrected_archive': nwm_bias_corrected_archive_path,
+    }
+
+
+def store_path(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Directory of the Zarr stores of the AOI, with their manifest (manifest.json)
+    """
+    return 'AOI/'+AOI_str+'/zarr/'
+
+
+def open_netcdf(path):
+    """
+    Opens a NetCDF file lazily with h5netcdf, falling back to the default engine for the files h5netcdf cannot read
+
+    :param path: Path to the NetCDF file
+    :return: The dataset
+    """
+    try:
+        return xr.open_dataset(path, decode_coords='all', engine = 'h5netcdf')
+    except (OSError, ValueError):
+        return xr.open_dataset(path, decode_coords='all')
+
+
+def _store_chunks(ds, chunk=STORE_CHUNK):
+    chunks = {}
+    for dim, size in ds.sizes.items():
+        if dim in ('lat', 'lon', 'x', 'y'):
+            chunks[dim] = min(size, chunk)
+        elif dim=='site':
+            # One chunk per site, so a point lookup in the NWM archives reads a single site
+            chunks[dim] = 1
+        else:
+            chunks[dim] = size
+    return chunks
+
+
+def convert_aoi_store(AOI_str, chunk=STORE_CHUNK, assets=None):
+    """
+    Converts the static NetCDF assets of an AOI to consolidated, chunked Zarr stores with a manifest of their
+    sources; assets whose store is up to date are skipped
+
+    :param AOI_str: Area-Of-Interest
+    :param chunk: Chunk size along lat/lon
+    :param assets: Names of the assets to convert (default: all, see aoi_asset_paths)
+    :return: Path to the manifest
+    """
+    out_path = store_path(AOI_str)
+    os.makedirs(out_path, exist_ok=True)
+    manifest = _read_manifest(AOI_str)
+
+    for name, source in aoi_asset_paths(AOI_str).items():
+        if (assets is not None and name not in assets) or not os.path.exists(source):
+            continue
+        if _entry_is_fresh(AOI_str, manifest.get(name)):
+            continue
+
+        with open_netcdf(source) as ds:
+            ds = ds.chunk(_store_chunks(ds, chunk))
+            for var in ds.variables.values():
+                var.encoding = {}
+            store = out_path + name + '.zarr'
+            tmp_store = tempfile.mkdtemp(prefix='.' + name + '.zarr.', dir=out_path)
+            try:
+                # Zarr v2 layout, where consolidated metadata is part of the specification
+                ds.to_zarr(tmp_store, mode='w', consolidated=True, zarr_format=2)
+            except BaseException:
+                shutil.rmtree(tmp_store, ignore_errors=True)
+                raise
+        if os.path.exists(store):
+            shutil.rmtree(store)
+        os.replace(tmp_store, store)
+
+        manifest[name] = dict(source=source, store=name + '.zarr', source_stats=_file_stats([source]), chunk=chunk,
+                              data_vars=list(ds.data_vars), sizes=dict(ds.sizes))
+        _write_manifest(AOI_str, manifest)
+
+    return out_path + 'manifest.json'
+
+
+def _read_manifest(AOI_str):
+    manifest_path = store_path(AOI_str) + 'manifest.json'
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(AOI_str, manifest):
+    manifest_path = store_path(AOI_str) + 'manifest.json'
+    with _atomic_open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def _entry_is_fresh(AOI_str, entry):
+    if entry is None or not os.path.exists(store_path(AOI_str) + entry['store']):
+        return False
+    try:
+        return entry['source_stats'] == _file_stats([entry['source']])
+    except OSError:
+        return False
+
+
+def open_aoi_asset(AOI_str, name):
+    """
+    Opens a static asset of an AOI lazily: from its Zarr store when it is up to date, only reading the chunks that
+    are accessed, otherwise from the NetCDF source. Close it once read (close() or a with statement).
+
+    :param AOI_str: Area-Of-Interest
+    :param name: Name of the asset, see aoi_asset_paths
+    :return: The dataset
+    """
+    entry = _read_manifest(AOI_str).get(name)
+    if _entry_is_fresh(AOI_str, entry):
+        return xr.open_zarr(store_path(AOI_str) + entry['store'], consolidated=True)
+    return open_netcdf(aoi_asset_paths(AOI_str)[name])
+
+
+def open_aoi_dataarray(AOI_str, name):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param name: Name of an asset holding a single data variable, see aoi_asset_paths
+    :return: The lazily opened data array, like xr.open_dataarray: closing it (close() or a with statement) closes
+             its dataset
+    """
+    ds = open_aoi_asset(AOI_str, name)
+    data_vars = list(ds.data_vars)
+    if len(data_vars) != 1:
+        ds.close()
+        raise ValueError(name + ' holds ' + str(len(data_vars)) + ' data variables, expected 1')
+    da = ds[data_vars[0]]
+    da.set_close(ds.close)
+    return da
+
+
+def _request_working_set(AOI_str, use_store):
+    """
+    Reads what a forecast request needs: the spatial modes and their statistics, the masks and one archived
+    discharge
+    """
+    st_time = time.time()
+    if use_store:
+        open_asset = lambda name: open_aoi_asset(AOI_str, name)
+    else:
+        open_asset = lambda name: open_netcdf(aoi_asset_paths(AOI_str)[name])
+    with open_asset('SM_hydro_App') as ds:
+        for var in ('spatial_modes', 'temporal_mean', 'hydro_site', 'nwm_site', 'model_RTPC_mean_sel',
+                    'model_RTPC_std_sel'):
+            ds[var].values
+    for name in ('JRC_perm_water', 'qm_spr_r_mask'):
+        with open_asset(name) as ds:
+            ds[list(ds.data_vars)[0]].values
+    with open_asset('nwm_archive') as ds:
+        archive = ds[list(ds.data_vars)[0]]
+        archive.isel(site=0, time=-1).values
+    return time.time() - st_time
+
+
+def benchmark_aoi_store(AOI_str, repeat=5):
+    """
+    Times the reads of a forecast request from the NetCDF files and from the Zarr stores (converted first if
+    needed), cold (first read in a new Python process) and warm (repeated reads in this process)
+
+    :param AOI_str: Area-Of-Interest
+    :param repeat: Number of warm reads
+    :return: Dictionary of the timings in seconds
+    """
+    convert_aoi_store(AOI_str)
+    report = dict(AOI=AOI_str)
+    for label, use_store in (('netcdf', False), ('zarr', True)):
+        code = ('import aoi_store; print(aoi_store._request_working_set(%r, %r))' % (AOI_str, use_store))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                         os.environ.get('PYTHONPATH')])))
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True)
+        report[label + '_cold'] = float(out.stdout.split()[-1])
+        report[label + '_warm'] = min(_request_working_set(AOI_str, use_store) for _ in range(repeat))
+    return report
+
+
+if __name__ == '__main__':
+    # Offline conversion of the AOI assets, e.g. "python aoi_store.py MississippiRiver RedRiver"; add "benchmark"
+    # before the AOIs to time the NetCDF and Zarr reads as well
+    benchmark = sys.argv[1:2] == ['benchmark']
+    for AOI_str in sys.argv[2 if benchmark else 1:]:
+        print(convert_aoi_store(AOI_str))
+        if benchmark:
+            print(json.dumps(benchmark_aoi_store(AOI_str), indent=1))
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import json
+import pickle
+import threading
+
+import numpy as np
+
+from qm_tools import _atomic_open, _file_stats
+
+# interp1d kinds with a compiled counterpart
+BIAS_KINDS = ('nearest', 'nearest-up', 'linear')
+
+
+def bias_function_paths(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Dictionary of the pickled bias-correction function (scipy interp1d) of each NWM site of the AOI
+    """
+    model_path = 'AOI/'+AOI_str+'/nwm_archive/'
+    paths = {}
+    for name in sorted(os.listdir(model_path)) if os.path.isdir(model_path) else ():
+        match = re.fullmatch(r'interpolated_function(\d+)\.pkl', name)
+        if match:
+            paths[int(match.group(1))] = model_path + name
+    return paths
+
+
+def compiled_path(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Path to the compiled bias-correction functions of the AOI
+    """
+    return 'AOI/'+AOI_str+'/nwm_archive/bias_correction.npz'
+
+
+def compile_bias_function(bc_model):
+    """
+    :param bc_model: Bias-correction function (scipy interp1d of a 1-D forecast to corrected discharge mapping)
+    :return: Dictionary of its kind, sorted knots and values, and behaviour outside the knots: extrapolation (for
+             nearest kinds, the value of the end knot) or fill values below and above
+    """
+    kind = getattr(bc_model, '_kind', None)
+    if kind not in BIAS_KINDS:
+        raise ValueError('Unsupported bias-correction function kind: ' + str(kind))
+    knots = np.asarray(bc_model.x, dtype=np.float64)
+    values = np.asarray(bc_model.y, dtype=np.float64)
+    if values.ndim != 1:
+        raise ValueError('Bias-correction functions must map a discharge to a single discharge')
+    order = np.argsort(knots, kind='stable')
+
+    extrapolate = bool(bc_model._extrapolate)
+    fill_below = fill_above = np.nan
+    if not extrapolate and not bc_model.bounds_error:
+        fill_below, fill_above = np.broadcast_to(np.asarray(bc_model.fill_value, dtype=np.float64), (2,))
+    return dict(kind=kind, knots=knots[order], values=values[order], extrapolate=extrapolate,
+                fill_below=float(fill_below), fill_above=float(fill_above))
+
+
+def build_bias_correction(AOI_str):
+    """
+    Compiles the pickled bias-correction functions of an AOI into one file of sorted knot and value arrays
+
+    :param AOI_str: Area-Of-Interest
+    :return: Path to the compiled functions
+    """
+    paths = bias_function_paths(AOI_str)
+    compiled = []
+    for path in paths.values():
+        with open(path, 'rb') as file:
+            compiled.append(compile_bias_function(pickle.load(file)))
+
+    sizes = [len(bias['knots']) for bias in compiled]
+    meta = dict(source_stats=_file_stats(list(paths.values())), sites=list(paths),
+                kinds=[bias['kind'] for bias in compiled])
+    out_path = compiled_path(AOI_str)
+    with _atomic_open(out_path) as f:
+        np.savez(f, meta=json.dumps(meta),
+                 offsets=np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+                 knots=np.concatenate([bias['knots'] for bias in compiled]) if compiled else np.empty(0),
+                 values=np.concatenate([bias['values'] for bias in compiled]) if compiled else np.empty(0),
+                 extrapolate=np.array([bias['extrapolate'] for bias in compiled], dtype=bool),
+                 fill=np.array([[bias['fill_below'], bias['fill_above']] for bias in compiled]).reshape(-1, 2))
+    return out_path
+
+
+class BiasCorrection:
+    """
+    Compiled bias-correction functions of the NWM sites of an AOI, applied to arrays of any shape (all days of a
+    forecast horizon, ensemble members, ...) at once; NaN discharges stay NaN
+    """
+
+    def __init__(self, AOI_str):
+        """
+        :param AOI_str: Area-Of-Interest; the functions are compiled first if the compiled file is missing or older
+                        than the pickled functions
+        """
+        self.AOI_str = AOI_str
+        self.source_stats = _file_stats(list(bias_function_paths(AOI_str).values()))
+        self._functions = {}
+        if not self.source_stats:
+            # No bias correction for the AOI
+            return
+        path = compiled_path(AOI_str)
+        arrays = self._load(path)
+        if arrays is None:
+            build_bias_correction(AOI_str)
+            arrays = self._load(path)
+
+        meta = json.loads(str(arrays['meta']))
+        for ct, (site, kind) in enumerate(zip(meta['sites'], meta['kinds'])):
+            start, stop = arrays['offsets'][ct:ct + 2]
+            knots, values = arrays['knots'][start:stop], arrays['values'][start:stop]
+            # Nearest kinds switch value halfway between knots, as interp1d does
+            bounds = (knots[1:] + knots[:-1]) / 2 if kind != 'linear' else None
+            self._functions[site] = (kind, knots, values, bounds, bool(arrays['extrapolate'][ct]), arrays['fill'][ct])
+
+    def _load(self, path):
+        try:
+            with np.load(path) as arrays:
+                arrays = dict(arrays)
+        except (OSError, ValueError):
+            return None
+        if json.loads(str(arrays['meta']))['source_stats'] != self.source_stats:
+            return None
+        return arrays
+
+    @property
+    def sites(self):
+        """
+        :return: NWM sites with a bias-correction function
+        """
+        return list(self._functions)
+
+    def missing(self, sites):
+        """
+        :param sites: NWM sites, possibly repeated
+        :return: The unique sites without a bias-correction function, in order
+        """
+        return [site for site in dict.fromkeys(int(site) for site in sites) if site not in self._functions]
+
+    def apply(self, site, q):
+        """
+        :param site: NWM site
+        :param q: Forecasted discharge (any shape)
+        :return: Bias-corrected discharge; KeyError when the site has no bias-correction function
+        """
+        kind, knots, values, bounds, extrapolate, fill = self._functions[int(site)]
+        q = np.asarray(q, dtype=np.float64)
+        if kind=='linear':
+            corrected = np.interp(q, knots, values)
+            if extrapolate and len(knots) > 1:
+                # Extension of the end segments
+                slope_below = (values[1] - values[0]) / (knots[1] - knots[0])
+                slope_above = (values[-1] - values[-2]) / (knots[-1] - knots[-2])
+                corrected = np.where(q < knots[0], values[0] + (q - knots[0]) * slope_below, corrected)
+                corrected = np.where(q > knots[-1], values[-1] + (q - knots[-1]) * slope_above, corrected)
+        else:
+            corrected = values[np.searchsorted(bounds, q, side='left' if kind=='nearest' else 'right')]
+        if not extrapolate:
+            corrected = np.where(q < knots[0], fill[0], np.where(q > knots[-1], fill[1], corrected))
+        return np.where(np.isnan(q), np.nan, corrected)
+
+    def is_fresh(self):
+        """
+        :return: Whether the pickled functions are unchanged (size and modification time) since loading
+        """
+        try:
+            return _file_stats(list(bias_function_paths(self.AOI_str).values())) == self.source_stats
+        except OSError:
+            return False
+
+
+_corrections = {}
+_corrections_lock = threading.Lock()
+
+
+def get_bias_correction(AOI_str):
+    """
+    Returns the bias-correction functions of an AOI, loaded once per process and reloaded when they change
+
+    :param AOI_str: Area-Of-Interest
+    :return: The BiasCorrection
+    """
+    with _corrections_lock:
+        correction = _corrections.get(AOI_str)
+        if correction is None or not correction.is_fresh():
+            correction = BiasCorrection(AOI_str)
+            _corrections[AOI_str] = correction
+    return correction
+
+
+if __name__ == '__main__':
+    # Offline compilation of the bias-correction functions, e.g. "python bias_correction.py MississippiRiver"
+    for AOI_str in sys.argv[1:]:
+        print(build_bias_correction(AOI_str))
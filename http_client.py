@@ -0,0 +1,196 @@
+import ssl
+import time
+import random
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+from collections import namedtuple
+
+# Statuses worth another attempt: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# A response: status (304 when served from the validators of an earlier response), headers and body
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class HTTPClient:
+    """
+    Thread-safe HTTP(S) client keeping connections alive per host, with a scoped SSL context (the global default
+    context is left untouched), at most max_per_host requests in flight per host and conditional GETs: the ETag and
+    Last-Modified of each URL are sent back, and an unchanged resource (304) is served from the earlier body
+
+    Failed attempts (connection errors, timeouts, truncated or malformed responses, RETRY_STATUSES) are retried up
+    to retries times after a fully jittered exponential backoff, as long as the retry budget allows: every retry
+    spends one token, every success earns back budget_ratio tokens (up to retry_budget), so a failing host is not
+    flooded with retries.
+    """
+
+    def __init__(self, max_per_host=4, retries=3, backoff=0.5, retry_budget=10., budget_ratio=0.1,
+                 ssl_context=None):
+        """
+        :param max_per_host: Maximum number of requests in flight (and of idle connections) per host
+        :param retries: Maximum number of retries of a request
+        :param backoff: Base of the exponential backoff in seconds
+        :param retry_budget: Maximum number of retry tokens
+        :param budget_ratio: Retry tokens earned by each successful request
+        :param ssl_context: SSL context of the HTTPS connections (default: ssl.create_default_context(), which
+                            verifies the certificates and host names)
+        """
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = retry_budget
+        self.budget_ratio = budget_ratio
+        self.ssl_context = ssl_context if ssl_context is not None else ssl.create_default_context()
+        self._tokens = retry_budget
+        self._idle = {}
+        self._slots = {}
+        self._validators = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.retried = 0
+
+    def _slot(self, host_key):
+        with self._lock:
+            slot = self._slots.get(host_key)
+            if slot is None:
+                slot = self._slots[host_key] = threading.BoundedSemaphore(self.max_per_host)
+            return slot
+
+    def _connect(self, host_key, timeout):
+        with self._lock:
+            idle = self._idle.get(host_key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.connections += 1
+        scheme, host, port = host_key
+        if scheme=='https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _release(self, host_key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host_key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _spend_retry(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.retried += 1
+            return True
+
+    def _request(self, host_key, path, headers, timeout):
+        """
+        One attempt, on an idle connection of the host when there is one; a connection the server closed while
+        idle is replaced once without counting as a retry
+        """
+        for _ in range(2):
+            conn, reused = self._connect(host_key, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(host_key, conn)
+            return response.status, response.reason, response.headers, body
+
+    def get(self, url, timeout=30, headers=None):
+        """
+        :param url: URL of the resource
+        :param timeout: Timeout in seconds of the connection and of each read
+        :param headers: Additional request headers
+        :return: The Response; failures raise urllib.error.HTTPError (HTTP errors), OSError (connection errors,
+                 timeouts) or http.client.HTTPException (truncated or malformed responses) once the retries are
+                 exhausted
+        """
+        parts = urllib.parse.urlsplit(url)
+        host_key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme=='https' else 80))
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        request_headers = {'Accept-Encoding': 'identity', 'Connection': 'keep-alive'}
+        request_headers.update(headers or {})
+        with self._lock:
+            validators = self._validators.get(url)
+        if validators is not None:
+            etag, last_modified, _ = validators
+            if etag:
+                request_headers['If-None-Match'] = etag
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+
+        attempt = 0
+        while True:
+            with self._lock:
+                self.requests += 1
+            try:
+                with self._slot(host_key):
+                    status, reason, response_headers, body = self._request(host_key, path, request_headers, timeout)
+                error = None
+            except (OSError, http.client.HTTPException) as e:
+                status, error = None, e
+
+            if status is not None and status not in RETRY_STATUSES:
+                break
+            if attempt >= self.retries or not self._spend_retry():
+                if error is not None:
+                    raise error
+                raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
+
+        with self._lock:
+            self._tokens = min(self.retry_budget, self._tokens + self.budget_ratio)
+            if status==304 and validators is not None:
+                self.not_modified += 1
+                return Response(304, response_headers, validators[2])
+        if status >= 400 or status==304:
+            raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+
+        etag, last_modified = response_headers.get('ETag'), response_headers.get('Last-Modified')
+        if etag or last_modified:
+            with self._lock:
+                self._validators[url] = (etag, last_modified, body)
+        return Response(status, response_headers, body)
+
+    def close(self):
+        """
+        Closes the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        """
+        :return: Dictionary of the attempts made, connections opened, responses served as not modified and retries
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'not_modified': self.not_modified,
+                'retried': self.retried,
+            }
@@ -94,14 +94,10 @@ with row1_col2:
             in_run_type = 'analysis_assim'
             in_run_type2 = 'analysis_assim'
 
-            ssl._create_default_https_context = ssl._create_stdlib_context
-           
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id=7469342')
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
+            # Forecast times from the forecast cache shared with the computations
+            exp_fct_indata = {'forecast-time':pd.to_datetime(forecast_cache.get(in_run_type, 7469342).times, unit='s')}
 
-            exp_fct_data = pd.DataFrame(JSON_object[0]["data"])["forecast-time"]
+            exp_fct_data = pd.DataFrame(exp_fct_indata)["forecast-time"]
             exp_fct_time = pd.to_datetime(exp_fct_data)
 
             first_date = exp_fct_time[0]
@@ -122,7 +118,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -136,12 +132,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -160,9 +160,8 @@ with row1_col2:
            
             AOI_str = st.session_state.AOI_str
 
-            exp_fct_indata = {'time':xr.load_dataarray('AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc', engine='h5netcdf').time.data}
-            if AOI_str == 'MississippiRiver': 
-                exp_fct_indata = {'time':xr.load_dataarray('medium_lt08_tot.nc').time.data}           
+            # Dates from the index of the archive, without loading the archive
+            exp_fct_indata = {'time':archive_index(AOI_str, in_run_type).times}
 
             exp_fct_data = pd.DataFrame(exp_fct_indata)['time']
             exp_fct_time = pd.to_datetime(exp_fct_data)
@@ -186,7 +185,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -200,12 +199,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -223,10 +226,7 @@ with row1_col2:
             in_run_type2 = 'biascorrection' #archive
            
             AOI_str = st.session_state.AOI_str
-            if AOI_str=='MississippiRiver':
-                exp_fct_indata = {'time':xr.load_dataarray('AOI/'+AOI_str+'/nwm_archive/medium_lt08_App_biascorrected.nc').time.data}
-            elif AOI_str=='RedRiver':
-                exp_fct_indata = {'time':xr.load_dataarray('AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc' , engine='h5netcdf').time.data}
+            exp_fct_indata = {'time':archive_index(AOI_str, in_run_type).times}
             exp_fct_data = pd.DataFrame(exp_fct_indata)['time']
             exp_fct_time = pd.to_datetime(exp_fct_data)
             
@@ -249,7 +249,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -263,12 +263,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -285,14 +289,10 @@ with row1_col2:
             in_run_type = 'short_range'
             in_run_type2 = 'short_range'
 
-            ssl._create_default_https_context = ssl._create_stdlib_context           
-
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id=7469342')
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
+            # Forecast times from the forecast cache shared with the computations
+            exp_fct_indata = {'forecast-time':pd.to_datetime(forecast_cache.get(in_run_type, 7469342).times, unit='s')}
 
-            exp_fct_data = pd.DataFrame(JSON_object[0]["data"])["forecast-time"]
+            exp_fct_data = pd.DataFrame(exp_fct_indata)["forecast-time"]
             exp_fct_time = pd.to_datetime(exp_fct_data)
 
             first_date = exp_fct_time[0]
@@ -314,7 +314,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -328,12 +328,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -351,14 +355,10 @@ with row1_col2:
        if run_type == 'Medium-Range':
             in_run_type = 'medium_range_ensemble_mean'
             in_run_type2 = 'medium_range_ensemble_mean'
-            ssl._create_default_https_context = ssl._create_stdlib_context
-           
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id=7469342')
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
+            # Forecast times from the forecast cache shared with the computations
+            exp_fct_indata = {'forecast-time':pd.to_datetime(forecast_cache.get(in_run_type, 7469342).times, unit='s')}
 
-            exp_fct_data = pd.DataFrame(JSON_object[0]["data"])["forecast-time"]
+            exp_fct_data = pd.DataFrame(exp_fct_indata)["forecast-time"]
             exp_fct_time = pd.to_datetime(exp_fct_data)
 
             first_date = exp_fct_time[0]
@@ -380,7 +380,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -394,12 +394,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -416,14 +420,10 @@ with row1_col2:
             in_run_type = 'medium_range_ensemble_mean'
             in_run_type2 = 'medium_range_ensemble_mean_bias_corrected'
 
-            ssl._create_default_https_context = ssl._create_stdlib_context
-           
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id=7469342')
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
+            # Forecast times from the forecast cache shared with the computations
+            exp_fct_indata = {'forecast-time':pd.to_datetime(forecast_cache.get(in_run_type, 7469342).times, unit='s')}
 
-            exp_fct_data = pd.DataFrame(JSON_object[0]["data"])["forecast-time"]
+            exp_fct_data = pd.DataFrame(exp_fct_indata)["forecast-time"]
             exp_fct_time = pd.to_datetime(exp_fct_data)
 
             first_date = exp_fct_time[0]
@@ -445,7 +445,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -459,12 +459,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -483,14 +487,10 @@ with row1_col2:
             in_run_type = 'long_range_ensemble_mean'
             in_run_type2 = 'long_range_ensemble_mean'
 
-            ssl._create_default_https_context = ssl._create_stdlib_context
-           
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id=7469342')
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
+            # Forecast times from the forecast cache shared with the computations
+            exp_fct_indata = {'forecast-time':pd.to_datetime(forecast_cache.get(in_run_type, 7469342).times, unit='s')}
 
-            exp_fct_data = pd.DataFrame(JSON_object[0]["data"])["forecast-time"]
+            exp_fct_data = pd.DataFrame(exp_fct_indata)["forecast-time"]
             exp_fct_time = pd.to_datetime(exp_fct_data)
 
             first_date = exp_fct_time[0]
@@ -512,7 +512,7 @@ with row1_col2:
                 #streamlit_proc(date, AOI_str, in_run_type)
 
                 AOI_str = st.session_state.AOI_str
-                bounds = run_fier(AOI_str, str(date), in_run_type, in_run_type2)
+                bounds, pyramid = run_fier(AOI_str, str(date), in_run_type, in_run_type2, tiles=True)
                 st.write(AOI_str)
 
                 if region=='Mississippi River':
@@ -526,12 +526,16 @@ with row1_col2:
                         control_scale=True,
                 )
 
-                folium.raster_layers.ImageOverlay(
-                    image= 'Output/water_fraction.png',
-                    # image = sar_image,
-                    bounds = bounds,
+                # Tile pyramid of the water fraction, the browser only fetches the visible tiles
+                folium.raster_layers.TileLayer(
+                    tiles = pyramid['url'],
+                    attr = 'FIER',
+                    min_native_zoom = pyramid['min_zoom'],
+                    max_native_zoom = pyramid['max_zoom'],
+                    bounds = pyramid['bounds'],
                     opacity = 0.5,
                     name = 'Water Fraction Map',
+                    overlay = True,
                     show = True,
                 ).add_to(m)
 
@@ -554,6 +558,9 @@ with row1_col2:
             mime= "application/netcdf")
     except:
         pass
+
+    cache_stats = result_cache.stats()
+    st.caption('Result cache: %d%% hits, %.1f s saved' % (100*cache_stats['hit_ratio'], cache_stats['saved_seconds']))
             
             
 
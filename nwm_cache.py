@@ -0,0 +1,206 @@
+import os
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+from nwm_forecast import CYCLE_HOURS, ForecastSeries, fetch_forecasts, parse_forecast
+from qm_tools import _atomic_open
+
+
+def cycle_seconds(run_type):
+    """
+    :param run_type: NWM run type
+    :return: Seconds between the issue cycles of the run type (default: hourly)
+    """
+    return CYCLE_HOURS.get(run_type, 1) * 3600
+
+
+# Hours between the issue time of a cycle and the publication of its forecasts by the NWM API (default: 1)
+PUBLICATION_LAG_HOURS = {
+    'analysis_assim': 1,
+    'short_range': 2,
+    'medium_range': 6,
+    'medium_range_ensemble_mean': 8,
+    'long_range': 8,
+    'long_range_ensemble_mean': 8,
+}
+
+
+def expiry_time(run_type, issue_time):
+    """
+    A forecast cannot be superseded before the next issue cycle of its run type is published
+
+    :param run_type: NWM run type
+    :param issue_time: Issue time of the forecast (pd.Timestamp, UTC)
+    :return: Expected publication time of the next issue cycle (UTC, seconds since the epoch)
+    """
+    return issue_time.timestamp() + cycle_seconds(run_type) + PUBLICATION_LAG_HOURS.get(run_type, 1) * 3600
+
+
+class ForecastCache:
+    """
+    Disk cache of the parsed live NWM forecasts, shared by the date pickers and resolve_discharges: one entry per
+    run type, station and issue cycle (cache_dir/<run type>/<station>_<issue time>.npz), fresh until the next issue
+    cycle is expected to be published (see expiry_time). Past that time, an entry whose refresh still returns the
+    same cycle (late publication) is only fresh for revalidate_seconds, until the next cycle appears.
+
+    A stale entry is still returned while a background thread fetches its replacement; only missing entries and
+    entries expected to be superseded for more than max_stale_cycles cycles are fetched before returning.
+    """
+
+    def __init__(self, cache_dir='Output/nwm_cache', max_stale_cycles=4, revalidate_seconds=300,
+                 fetch=fetch_forecasts):
+        """
+        :param cache_dir: Directory of the cache
+        :param max_stale_cycles: Number of cycles past the expected next cycle a stale entry is still returned for
+        :param revalidate_seconds: Freshness of an entry fetched after the expected publication of the next cycle
+        :param fetch: Function fetching the forecasts of a run type and stations, see fetch_forecasts
+        """
+        self.cache_dir = cache_dir
+        self.max_stale_cycles = max_stale_cycles
+        self.revalidate_seconds = revalidate_seconds
+        self.fetch = fetch
+        self._memory = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+
+    def _entry_dir(self, run_type):
+        return os.path.join(self.cache_dir, run_type)
+
+    def _read_disk(self, run_type, station):
+        entry_dir = self._entry_dir(run_type)
+        prefix = str(station) + '_'
+        try:
+            names = sorted(name for name in os.listdir(entry_dir) if name.startswith(prefix) and name.endswith('.npz'))
+        except OSError:
+            return None
+        if not names:
+            return None
+        try:
+            with np.load(os.path.join(entry_dir, names[-1])) as arrays:
+                series = ForecastSeries(station, pd.Timestamp(str(arrays['issue_time'])), arrays['times'],
+                                        arrays['values'], arrays['days'], arrays['daily_q'])
+                return series, float(arrays['fetched_at']), float(arrays['expires_at'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _write_disk(self, run_type, series, fetched_at, expires_at):
+        entry_dir = self._entry_dir(run_type)
+        os.makedirs(entry_dir, exist_ok=True)
+        name = '%d_%s.npz' % (series.station, series.issue_time.strftime('%Y%m%dT%H%M'))
+        path = os.path.join(entry_dir, name)
+        with _atomic_open(path) as f:
+            np.savez(f, issue_time=str(series.issue_time), times=series.times, values=series.values, days=series.days,
+                     daily_q=series.daily_q, fetched_at=fetched_at, expires_at=expires_at)
+        # Older issue cycles of the station are superseded
+        for other in os.listdir(entry_dir):
+            if other.startswith(str(series.station) + '_') and other.endswith('.npz') and other != name:
+                try:
+                    os.remove(os.path.join(entry_dir, other))
+                except OSError:
+                    pass
+
+    def _lookup(self, run_type, station):
+        with self._lock:
+            entry = self._memory.get((run_type, station))
+        if entry is None:
+            entry = self._read_disk(run_type, station)
+            if entry is not None:
+                with self._lock:
+                    self._memory[(run_type, station)] = entry
+        return entry
+
+    def _store(self, run_type, payloads, fetched_at):
+        entries = {}
+        for station, payload in payloads.items():
+            series = parse_forecast(station, payload)
+            if series.issue_time is None:
+                # Latest cycle expected to be published at the request when the API does not tell
+                cycle = cycle_seconds(run_type)
+                published = fetched_at - PUBLICATION_LAG_HOURS.get(run_type, 1) * 3600
+                series = series._replace(issue_time=pd.Timestamp(published // cycle * cycle, unit='s'))
+            expires_at = expiry_time(run_type, series.issue_time)
+            if expires_at <= fetched_at:
+                # The next cycle is late: revalidate soon
+                expires_at = fetched_at + self.revalidate_seconds
+            entry = (series, fetched_at, expires_at)
+            self._write_disk(run_type, *entry)
+            with self._lock:
+                self._memory[(run_type, station)] = entry
+            entries[station] = entry
+        return entries
+
+    def _refresh(self, run_type, stations):
+        try:
+            fetched_at = time.time()
+            self._store(run_type, self.fetch(run_type, stations), fetched_at)
+        except Exception:
+            # The stale entries stay until the next refresh succeeds
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.difference_update((run_type, station) for station in stations)
+
+    def get_many(self, run_type, stations):
+        """
+        :param run_type: NWM run type
+        :param stations: NWM sites, possibly repeated
+        :return: Dictionary of the ForecastSeries of each unique station
+        """
+        now = time.time()
+        max_stale = self.max_stale_cycles * cycle_seconds(run_type)
+        series, missing, stale = {}, [], []
+        for station in dict.fromkeys(int(station) for station in stations):
+            entry = self._lookup(run_type, station)
+            if entry is None or now > entry[2] + max_stale:
+                missing.append(station)
+                continue
+            series[station] = entry[0]
+            if now > entry[2]:
+                stale.append(station)
+
+        with self._lock:
+            self.misses += len(missing)
+            self.stale_hits += len(stale)
+            self.hits += len(series) - len(stale)
+            stale = [station for station in stale if (run_type, station) not in self._refreshing]
+            self._refreshing.update((run_type, station) for station in stale)
+        if stale:
+            threading.Thread(target=self._refresh, args=(run_type, stale), daemon=True).start()
+
+        if missing:
+            fetched_at = time.time()
+            for station, entry in self._store(run_type, self.fetch(run_type, missing), fetched_at).items():
+                series[station] = entry[0]
+        return series
+
+    def get(self, run_type, station):
+        """
+        :param run_type: NWM run type
+        :param station: NWM site
+        :return: The ForecastSeries of the station
+        """
+        return self.get_many(run_type, [station])[int(station)]
+
+    def stats(self):
+        """
+        :return: Dictionary of the fresh hits, stale hits (served while refreshing), misses and failed refreshes
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refresh_errors': self.refresh_errors,
+            }
+
+
+# Shared by the date pickers and the computations of all sessions of the process
+forecast_cache = ForecastCache()
@@ -0,0 +1,340 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from http_client import HTTPClient
+from qm_tools import _atomic_open
+
+# Latest NWM forecasts of the NOHRSC API, per run type and station; NWM_API points elsewhere, e.g. to a local stub
+# server
+NWM_API = os.environ.get('NWM_API', 'https://nwmdata.nohrsc.noaa.gov/latest/forecasts/')
+
+# Seconds to wait for the connection and for each read of a response
+FETCH_TIMEOUT = 30
+
+# Client of all NWM requests: kept-alive connections, conditional GETs, retries and at most 4 requests in flight
+nwm_client = HTTPClient(max_per_host=4)
+
+
+def forecast_url(run_type, station, base_url=None):
+    """
+    :param run_type: NWM run type (short_range, medium_range_ensemble_mean, long_range_ensemble_mean, ...)
+    :param station: NWM site
+    :param base_url: Root of the NWM API (default: NWM_API)
+    :return: URL of the latest streamflow forecast of the station
+    """
+    return (base_url or NWM_API)+run_type+'/streamflow?&station_id='+str(station)
+
+
+class LiveSource:
+    """
+    Forecast source of the NWM API, through nwm_client
+    """
+
+    def fetch(self, run_type, station, base_url=None, timeout=FETCH_TIMEOUT):
+        """
+        :param run_type: NWM run type
+        :param station: NWM site
+        :param base_url: Root of the NWM API (default: NWM_API)
+        :param timeout: Timeout in seconds of the request
+        :return: Text of the JSON forecast of the station
+        """
+        response = nwm_client.get(forecast_url(run_type, station, base_url), timeout=timeout)
+        return response.body.decode(response.headers.get_content_charset('utf-8'))
+
+
+def recording_path(directory, run_type, station):
+    """
+    :param directory: Directory of the recordings
+    :param run_type: NWM run type
+    :param station: NWM site
+    :return: Path to the recorded forecast of the station
+    """
+    return os.path.join(directory, run_type, str(int(station)) + '.json')
+
+
+class RecordSource:
+    """
+    Forecast source passing the forecasts of another source (default: live) through, and saving them to a
+    directory for ReplaySource
+    """
+
+    def __init__(self, directory, source=None):
+        """
+        :param directory: Directory of the recordings
+        :param source: Source of the forecasts (default: LiveSource)
+        """
+        self.directory = directory
+        self.source = source if source is not None else LiveSource()
+
+    def fetch(self, run_type, station, base_url=None, timeout=FETCH_TIMEOUT):
+        text = self.source.fetch(run_type, station, base_url, timeout)
+        path = recording_path(self.directory, run_type, station)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _atomic_open(path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        return text
+
+
+class ReplaySource:
+    """
+    Forecast source serving the forecasts recorded by RecordSource, after an injected latency, so the live run
+    types can be exercised and timed without network; a forecast that was not recorded raises FileNotFoundError
+    """
+
+    def __init__(self, directory, latency=0.):
+        """
+        :param directory: Directory of the recordings
+        :param latency: Seconds to wait before each response, as a stand-in for the API round-trip
+        """
+        self.directory = directory
+        self.latency = latency
+
+    def fetch(self, run_type, station, base_url=None, timeout=FETCH_TIMEOUT):
+        if self.latency:
+            time.sleep(self.latency)
+        with open(recording_path(self.directory, run_type, station), encoding='utf-8') as f:
+            return f.read()
+
+
+def source_from_env():
+    """
+    Forecast source selected by the environment: NWM_SOURCE ('live', 'record' or 'replay', default: 'live'),
+    NWM_RECORDINGS (directory of the recordings, default: Output/nwm_recordings) and NWM_LATENCY (replay latency in
+    seconds, default: 0)
+
+    :return: The forecast source
+    """
+    mode = os.environ.get('NWM_SOURCE', 'live')
+    directory = os.environ.get('NWM_RECORDINGS', 'Output/nwm_recordings')
+    if mode=='live':
+        return LiveSource()
+    elif mode=='record':
+        return RecordSource(directory)
+    elif mode=='replay':
+        return ReplaySource(directory, float(os.environ.get('NWM_LATENCY', 0)))
+    raise ValueError('Unknown NWM_SOURCE: ' + mode)
+
+
+# Source of all forecasts, see set_forecast_source
+forecast_source = source_from_env()
+
+
+def set_forecast_source(source):
+    """
+    :param source: Forecast source of the following requests (LiveSource, RecordSource, ReplaySource or any object
+                   with their fetch method)
+    :return: The previous source
+    """
+    global forecast_source
+    previous, forecast_source = forecast_source, source
+    return previous
+
+
+def fetch_forecast(run_type, station, base_url=None, timeout=FETCH_TIMEOUT):
+    """
+    :param run_type: NWM run type
+    :param station: NWM site
+    :param base_url: Root of the NWM API (default: NWM_API)
+    :param timeout: Timeout in seconds of the request
+    :return: Decoded JSON of the latest streamflow forecast of the station, from forecast_source
+    """
+    return json.loads(forecast_source.fetch(run_type, station, base_url, timeout))
+
+
+def fetch_forecasts(run_type, stations, base_url=None, timeout=FETCH_TIMEOUT, n_workers=8):
+    """
+    Fetches the latest forecasts of several stations concurrently, once per unique station: modes sharing a gauge
+    share its forecast
+
+    :param run_type: NWM run type
+    :param stations: NWM sites, possibly repeated
+    :param base_url: Root of the NWM API (default: NWM_API)
+    :param timeout: Timeout in seconds of each request
+    :param n_workers: Maximum number of requests in flight
+    :return: Dictionary of the decoded JSON forecast of each unique station; the first failed request raises its
+             error (urllib.error.HTTPError, socket.timeout, ...), see HTTPClient.get
+    """
+    unique_stations = list(dict.fromkeys(int(station) for station in stations))
+    if not unique_stations:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(unique_stations))) as pool:
+        payloads = pool.map(lambda station: fetch_forecast(run_type, station, base_url, timeout), unique_stations)
+        return dict(zip(unique_stations, payloads))
+
+
+# Hours between the issue cycles of each NWM run type
+CYCLE_HOURS = {
+    'analysis_assim': 1,
+    'short_range': 1,
+    'medium_range': 6,
+    'medium_range_ensemble_mean': 6,
+    'long_range': 6,
+    'long_range_ensemble_mean': 6,
+}
+
+# Keys of the issue time in the JSON forecast, when the API provides it
+_ISSUE_TIME_KEYS = ('reference-time', 'reference_time', 'issue-time', 'issue_time')
+
+# Cubic feet per second to cubic meters per second
+CFS_TO_CMS = 0.0283168
+
+SECONDS_PER_DAY = 86400
+
+# A forecast of one station, parsed once: issue time (UTC, None when unknown), forecast times (UTC seconds since the
+# epoch, int64), discharges (cms, float32), and the days of the horizon (UTC days since the epoch, int64) with their
+# daily mean discharges (cms, float64)
+ForecastSeries = namedtuple('ForecastSeries', ['station', 'issue_time', 'times', 'values', 'days', 'daily_q'])
+
+
+# UTC offset ending the time of day of an ISO 8601 time, e.g. '+06:00', '-0500' or '+06'
+_UTC_OFFSET = re.compile(r'[+-]\d\d(:?\d\d)?$')
+
+
+def _epoch_seconds(fct_times):
+    """
+    :param fct_times: ISO 8601 forecast times
+    :return: UTC seconds since the epoch (int64)
+    """
+    if not any(_UTC_OFFSET.search(t.partition('T')[2]) for t in fct_times):
+        try:
+            # Naive or Zulu times, parsed by NumPy without building timestamps
+            stamps = np.array([t[:-1] if t.endswith('Z') else t for t in fct_times], dtype='datetime64[s]')
+            return stamps.astype(np.int64)
+        except ValueError:
+            pass
+    # Times with a UTC offset, converted to UTC by pandas (NumPy only parses them with a deprecation warning)
+    stamps = pd.to_datetime(fct_times, utc=True, format='ISO8601').tz_localize(None).values
+    return stamps.astype('datetime64[s]').astype(np.int64)
+
+
+def daily_means(times, q):
+    """
+    :param times: UTC seconds since the epoch
+    :param q: Discharges at these times
+    :return: UTC days of the horizon (days since the epoch) and the mean discharge of each, in one group-by;
+             missing (non-finite) discharges are skipped, as pandas does, and a day without any is NaN
+    """
+    days, inverse = np.unique(times // SECONDS_PER_DAY, return_inverse=True)
+    valid = np.isfinite(q)
+    sums = np.bincount(inverse, weights=np.where(valid, q, 0.), minlength=len(days))
+    counts = np.bincount(inverse, weights=valid, minlength=len(days))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return days, np.where(counts > 0, sums / counts, np.nan)
+
+
+def parse_forecast(station, payload):
+    """
+    :param station: NWM site
+    :param payload: Decoded JSON forecast of the station, see fetch_forecast
+    :return: The ForecastSeries
+    """
+    series = payload[0]
+    data = series["data"]
+    issue_time = next((series[key] for key in _ISSUE_TIME_KEYS if series.get(key)), None)
+    if issue_time is not None:
+        issue_time = pd.to_datetime(issue_time, utc=True).tz_localize(None)
+
+    times = _epoch_seconds([point["forecast-time"] for point in data])
+    # Missing values (null) are NaN
+    q = np.fromiter((np.nan if point.get("value") is None else point["value"] for point in data), dtype=np.float64,
+                    count=len(data)) * CFS_TO_CMS
+    days, daily_q = daily_means(times, q)
+    return ForecastSeries(int(station), issue_time, times, q.astype(np.float32), days, daily_q)
+
+
+def daily_discharge(series, dois):
+    """
+    :param series: ForecastSeries of a station
+    :param dois: Dates-Of-Interest
+    :return: Mean discharge (cms) of the UTC day of each date, NaN outside the horizon
+    """
+    doi_days = pd.to_datetime(np.atleast_1d(dois)).values.astype('datetime64[D]').astype(np.int64)
+    if not len(series.days):
+        return np.full(len(doi_days), np.nan)
+    pos = np.minimum(np.searchsorted(series.days, doi_days), len(series.days) - 1)
+    return np.where(series.days[pos] == doi_days, series.daily_q[pos], np.nan)
+
+
+def serve_recordings(directory, latency=0., port=0):
+    """
+    Serves the recordings of a directory over HTTP at the paths of the NWM API, after an injected latency, as a
+    local stand-in for it: point NWM_API to the returned URL to exercise the live path (HTTP client included)
+    without network
+
+    :param directory: Directory of the recordings, see RecordSource
+    :param latency: Seconds to wait before each response
+    :param port: Port to listen on (default: any free port)
+    :return: The server (serving in a background thread, stop with shutdown()) and its base URL
+    """
+    class RecordingHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            run_type = url.path.strip('/').split('/')[0]
+            station = urllib.parse.parse_qs(url.query).get('station_id', ['0'])[0]
+            if latency:
+                time.sleep(latency)
+            try:
+                with open(recording_path(directory, run_type, station), 'rb') as f:
+                    body = f.read()
+                status = 200
+            except (OSError, ValueError):
+                body, status = b'', 404
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), RecordingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def benchmark_forecast_source(run_type, stations, repeat=5):
+    """
+    Times the fetch of the forecasts of several stations through forecast_source, without the forecast cache
+
+    :param run_type: NWM run type
+    :param stations: NWM sites
+    :param repeat: Number of fetches
+    :return: Dictionary of the fastest and median fetch times in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        st_time = time.time()
+        fetch_forecasts(run_type, stations)
+        timings.append(time.time() - st_time)
+    return dict(run_type=run_type, stations=len(set(stations)), best=min(timings), median=float(np.median(timings)))
+
+
+if __name__ == '__main__':
+    # "python nwm_forecast.py record <directory> <run type> <stations...>" records forecasts from the API,
+    # "python nwm_forecast.py serve <directory> [latency]" serves them at http://127.0.0.1:8765/ until interrupted
+    command, directory = sys.argv[1:3]
+    if command=='record':
+        set_forecast_source(RecordSource(directory))
+        print(sorted(fetch_forecasts(sys.argv[3], sys.argv[4:])))
+    elif command=='serve':
+        server, base_url = serve_recordings(directory, float(sys.argv[3]) if len(sys.argv) > 3 else 0., port=8765)
+        print('NWM_API=' + base_url)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
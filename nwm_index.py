@@ -0,0 +1,142 @@
+import os
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aoi_store import nwm_archive_paths, open_netcdf
+from qm_tools import _atomic_open, _file_stats
+
+
+def index_path(nc_path):
+    """
+    :param nc_path: Path to an NWM archive (NetCDF, site x time)
+    :return: Directory of its index: index.json (time range, sites, source stats), times.npy (sorted times) and
+             values.npy (discharges, site x time)
+    """
+    return os.path.splitext(nc_path)[0] + '.idx/'
+
+
+def build_archive_index(nc_path):
+    """
+    Reads an NWM archive once and writes its index next to it
+
+    :param nc_path: Path to the NWM archive
+    :return: Path to the index directory
+    """
+    out_path = index_path(nc_path)
+    os.makedirs(out_path, exist_ok=True)
+    with open_netcdf(nc_path) as ds:
+        archive = ds[list(ds.data_vars)[0]].transpose('site', 'time').load()
+    order = np.argsort(archive.time.values, kind='stable')
+    times = archive.time.values[order].astype('datetime64[ns]')
+    values = np.ascontiguousarray(archive.values[:, order], dtype=np.float64)
+
+    for name, array in (('times.npy', times), ('values.npy', values)):
+        with _atomic_open(out_path + name) as f:
+            np.save(f, array)
+    meta = dict(source=nc_path, source_stats=_file_stats([nc_path]), variable=archive.name,
+                sites=archive.site.values.tolist(), n_times=len(times),
+                first_time=str(pd.Timestamp(times[0])), last_time=str(pd.Timestamp(times[-1])))
+    with _atomic_open(out_path + 'index.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return out_path
+
+
+class ArchiveIndex:
+    """
+    Point-lookup reader of an NWM archive: discharges are read at their offset in the memory-mapped values, after a
+    binary search on the sorted times, so neither the date picker nor a forecast loads the whole archive
+    """
+
+    def __init__(self, nc_path):
+        """
+        :param nc_path: Path to the NWM archive; its index is built if missing or older than the archive
+        """
+        path = index_path(nc_path)
+        if not self._is_fresh(nc_path, path):
+            build_archive_index(nc_path)
+        with open(path + 'index.json') as f:
+            self.meta = json.load(f)
+        self.nc_path = nc_path
+        self.sites = self.meta['sites']
+        self.first_time = pd.Timestamp(self.meta['first_time'])
+        self.last_time = pd.Timestamp(self.meta['last_time'])
+        self.times = np.load(path + 'times.npy', mmap_mode='r')
+        self._values = np.load(path + 'values.npy', mmap_mode='r')
+        self._site_offsets = {site: ct for ct, site in enumerate(self.sites)}
+
+    @staticmethod
+    def _is_fresh(nc_path, path):
+        if not all(os.path.exists(path + name) for name in ('index.json', 'times.npy', 'values.npy')):
+            return False
+        with open(path + 'index.json') as f:
+            return json.load(f)['source_stats'] == _file_stats([nc_path])
+
+    def is_fresh(self):
+        """
+        :return: Whether the archive is unchanged (size and modification time) since the index was built
+        """
+        try:
+            return self.meta['source_stats'] == _file_stats([self.nc_path])
+        except OSError:
+            return False
+
+    def lookup(self, site, dois):
+        """
+        :param site: NWM site
+        :param dois: Dates-Of-Interest
+        :return: Archived discharge at the site on each date
+        """
+        dois = pd.to_datetime(np.atleast_1d(dois)).values.astype('datetime64[ns]')
+        offsets = np.searchsorted(self.times, dois)
+        found = offsets < len(self.times)
+        found[found] = self.times[offsets[found]] == dois[found]
+        if not found.all():
+            missing = pd.DatetimeIndex(dois[~found]).strftime('%Y-%m-%d')
+            raise KeyError('Dates not in the NWM archive: ' + str(list(missing)))
+        return np.array(self._values[self._site_offset(site), offsets])
+
+    def site_values(self, site):
+        """
+        :param site: NWM site
+        :return: Archived discharge at the site on every date of the archive (in the order of times)
+        """
+        return np.array(self._values[self._site_offset(site)])
+
+    def _site_offset(self, site):
+        site = site.item() if hasattr(site, 'item') else site
+        if site not in self._site_offsets:
+            raise KeyError('Site not in the NWM archive: ' + str(site))
+        return self._site_offsets[site]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_archive_index(nc_path):
+    """
+    Returns the index of an NWM archive, opened once per process and rebuilt when the archive changes
+
+    :param nc_path: Path to the NWM archive
+    :return: The ArchiveIndex
+    """
+    with _indexes_lock:
+        index = _indexes.get(nc_path)
+        if index is None or not index.is_fresh():
+            index = ArchiveIndex(nc_path)
+            _indexes[nc_path] = index
+    return index
+
+
+def archive_index(AOI_str, in_run_type='archive'):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param in_run_type: 'archive' or 'biascorrection'
+    :return: The ArchiveIndex of the archived (or bias-corrected) NWM medium range forecast of the AOI
+    """
+    nwm_archive_path, nwm_bias_corrected_archive_path = nwm_archive_paths(AOI_str)
+    return open_archive_index(nwm_archive_path if in_run_type=='archive' else nwm_bias_corrected_archive_path)
@@ -0,0 +1,1329 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import time
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Memory budget in bytes of the table rebuilds triggered by a stale table while serving a forecast: the historical
+# stacks are then streamed tile by tile instead of being loaded in full
+REBUILD_MEMORY = 2**30
+
+
+def _batched_interp(x, xp, fp, pix=None):
+    """
+    Vectorized equivalent of calling np.interp(x[:, p], xp[:, pix[p]], fp[:, pix[p]]) for every pixel p
+
+    Follows the same rules as np.interp (searchsorted-right bracketing, end-point clamping, exact knot hits and
+    the NaN fall-backs for zero-width knot intervals), so the results are identical to the per-pixel calls.
+
+    :param x: Values to be mapped, shape (time, pixel)
+    :param xp: Increasing knot positions, shape (knots,) shared by all pixels or a (..., knots, column) table
+    :param fp: Knot values, shape (knots,) shared by all pixels or a (..., knots, column) table
+    :param pix: Column of the xp/fp tables used by each pixel (default: column p for pixel p), shape (pixel,) or
+                (time, pixel). For tables with leading axes it is the flat offset of the first knot of the column.
+    :return: Mapped values, shape (time, pixel)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_knots = np.shape(xp)[0] if np.ndim(xp) == 1 else np.shape(xp)[-2]
+    if pix is None:
+        pix = np.arange(x.shape[1])
+    pix = np.broadcast_to(pix, x.shape)
+
+    def knot_lookup(table, idx):
+        if np.ndim(table) == 1:
+            return np.asarray(table, dtype=np.float64)[idx]
+        table = np.asarray(table)
+        return np.take(table.reshape(-1), idx * table.shape[-1] + pix).astype(np.float64, copy=False)
+
+    if np.ndim(xp) == 1:
+        j = np.searchsorted(xp, x, side='right') - 1
+    else:
+        # Per-pixel binary search: j is the last knot with xp[j] <= x (-1 if x is below the first knot)
+        lo = np.zeros(x.shape, dtype=np.intp)
+        hi = np.full(x.shape, n_knots, dtype=np.intp)
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            go_right = knot_lookup(xp, np.minimum(mid, n_knots - 1)) <= x
+            lo = np.where(active & go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+        j = lo - 1
+
+    jc = np.clip(j, 0, n_knots - 2)
+    x0 = knot_lookup(xp, jc)
+    x1 = knot_lookup(xp, jc + 1)
+    y0 = knot_lookup(fp, jc)
+    y1 = knot_lookup(fp, jc + 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1 - y0) / (x1 - x0)
+        out = slope * (x - x0) + y0
+        retry = np.isnan(out)
+        out = np.where(retry, slope * (x - x1) + y1, out)
+    out = np.where(np.isnan(out) & (y0 == y1), y0, out)
+
+    out = np.where(x == x0, y0, out)
+    out = np.where(j == n_knots - 1, knot_lookup(fp, np.full(x.shape, n_knots - 1)), out)
+    out = np.where(j < 0, knot_lookup(fp, np.zeros(x.shape, dtype=np.intp)), out)
+    # np.interp returns NaN for NaN inputs and for pixels whose knots are all NaN (no valid history)
+    out = np.where(np.isnan(x) | np.isnan(knot_lookup(xp, np.full(x.shape, n_knots - 1))), np.nan, out)
+
+    return out
+
+
+def qm_bins(nbins=100):
+    """
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :return: Quantile levels used for the quantile tables, from 0 to 1 with a step of 1/nbins
+    """
+    return np.arange(0, 1. + 1. / nbins, 1. / nbins)
+
+
+def apply_qm_tables(fct_syn_wf_stack, qobs, qsyn, qm_mask, binmid):
+    """
+    Quantile-scales all masked pixels and all time steps at once with pre-computed quantile tables
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled (time x lat x lon), scaled in place
+    :param qobs: Quantiles of the historical observed water fraction (nbins+1 x lat x lon)
+    :param qsyn: Quantiles of the historical synthesized water fraction (nbins+1 x lat x lon)
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param binmid: Quantile levels of the tables
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    rows, cols = np.nonzero(np.asarray(qm_mask) == True)
+
+    if rows.size > 0:
+        # Work on flat (knots x pixel) views of the tables so only the knots visited by the search are read
+        n_pix = fct_syn_wf_stack.shape[1] * fct_syn_wf_stack.shape[2]
+        pix = np.ravel_multi_index((rows, cols), fct_syn_wf_stack.shape[1:])
+        qsyn = np.asarray(qsyn).reshape(-1, n_pix)
+        qobs = np.asarray(qobs).reshape(-1, n_pix)
+
+        bin_fct_syn = _batched_interp(fct_syn_wf_stack[:, rows, cols], qsyn, binmid, pix)
+        fct_syn_wf_stack[:, rows, cols] = _batched_interp(bin_fct_syn, binmid, qobs, pix)
+
+    fct_syn_wf_stack[fct_syn_wf_stack > 100] = 100
+    fct_syn_wf_stack[fct_syn_wf_stack < 0] = 0
+
+    return fct_syn_wf_stack
+
+
+def perf_qm_vectorized(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100):
+    """
+    Drop-in replacement of perf_qm_quick that maps every masked pixel in a few array operations instead of a
+    per-pixel Python loop. Gives the same output as perf_qm_quick.
+
+    :param hist_real_wf_stack: Historical real water fraction as reference to get the scales
+    :param hist_syn_wf_stack: Historical synthesized water fraction to get the scales
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled
+    :param qm_mask: Mask of where quantile scaling will be performed, based on the pre-generated correlation between
+                    historical observed and synthesized water fractions (Default is Spearman's correlation)
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    binmid = qm_bins(nbins)
+
+    obs = np.asarray(hist_real_wf_stack)
+    syn = np.asarray(hist_syn_wf_stack)
+
+    # Sort each history once and gather the quantiles, np.nanquantile loops over every pixel holding NaN
+    qobs = sorted_quantiles(*sort_history(obs), binmid)
+    qsyn = sorted_quantiles(*sort_history(syn), binmid)
+
+    return apply_qm_tables(fct_syn_wf_stack, qobs, qsyn, qm_mask, binmid)
+
+
+def _file_stats(paths):
+    return [[os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+
+
+def source_hash(paths, nbins=100):
+    """
+    :param paths: Source files the quantile tables are built from
+    :param nbins: Number of bins of the quantile tables
+    :return: SHA-256 hex digest of the content of the source files and the number of bins
+    """
+    digest = hashlib.sha256(str(nbins).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _qm_table_paths(qm_scaling_path, prefix):
+    return qm_scaling_path + prefix + '.npy', qm_scaling_path + prefix + '.json'
+
+
+def _tmp_path(path):
+    """
+    :return: Path of a new, unique temporary file next to path, so concurrent writers of the same artifact never
+             write into the same file
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    return tmp_path
+
+
+@contextmanager
+def _atomic_open(path, mode='wb'):
+    """
+    Opens a unique temporary file that replaces path once written, and is removed if writing fails
+    """
+    tmp_path = _tmp_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_table(table, meta, qm_scaling_path, prefix):
+    """
+    Writes a table and then its manifest atomically, so readers never see a partially written artifact
+    """
+    table_path, meta_path = _qm_table_paths(qm_scaling_path, prefix)
+    with _atomic_open(table_path) as f:
+        np.save(f, table)
+    with _atomic_open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def _table_is_fresh(qm_scaling_path, prefix, sources, nbins):
+    """
+    Checks the manifest of a stored table against its source files. File size and modification time are compared
+    first; the content hash is only recomputed when they changed, and the manifest is refreshed if it still matches.
+    """
+    table_path, meta_path = _qm_table_paths(qm_scaling_path, prefix)
+    if not (os.path.exists(table_path) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('nbins') != nbins:
+        return False
+    if meta.get('source_stats') == _file_stats(sources):
+        return True
+    if meta.get('source_hash') != source_hash(sources, nbins):
+        return False
+    meta['source_stats'] = _file_stats(sources)
+    with _atomic_open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return True
+
+
+def qm_source_paths(qm_scaling_path):
+    """
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :return: Paths to the historical observed and synthesized water fraction stacks
+    """
+    return [qm_scaling_path + 'hist_real_wf_trim.nc', qm_scaling_path + 'hist_syn_wf_trim.nc']
+
+
+def build_qm_tables(qm_scaling_path, nbins=100, dtype=np.float64, max_memory=None, n_workers=None):
+    """
+    Offline build of the quantile tables of an AOI. Writes qm_tables.npy (2 x nbins+1 x lat x lon, qobs then qsyn)
+    and its manifest qm_tables.json, which holds the content hash of the historical stacks.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI, e.g. 'AOI/RedRiver/for_qm_scaling/'
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param dtype: Data type of the stored tables (default: float64, which keeps the output identical to perf_qm_quick)
+    :param max_memory: Memory budget in bytes; when given the stacks are streamed tile by tile, see
+                       build_qm_tables_chunked (default: None, the stacks are loaded in full)
+    :param n_workers: Number of worker processes of a streamed build (default: number of cores)
+    :return: Path to the written tables
+    """
+    if max_memory is not None:
+        return build_qm_tables_chunked(qm_scaling_path, nbins, dtype, max_memory, n_workers)
+
+    sources = qm_source_paths(qm_scaling_path)
+    binmid = qm_bins(nbins)
+
+    hist_obs_wf = xr.load_dataarray(sources[0], decode_coords='all', engine='h5netcdf')
+    hist_syn_wf = xr.load_dataarray(sources[1], decode_coords='all', engine='h5netcdf')
+
+    tables = np.empty((2, binmid.size) + hist_obs_wf.shape[1:], dtype=dtype)
+    tables[0] = np.nanquantile(hist_obs_wf.values, binmid, axis=0)
+    tables[1] = np.nanquantile(hist_syn_wf.values, binmid, axis=0)
+
+    meta = {
+        'nbins': nbins,
+        'dtype': np.dtype(dtype).name,
+        'shape': list(tables.shape),
+        'source_hash': source_hash(sources, nbins),
+        'source_stats': _file_stats(sources),
+    }
+    _save_table(tables, meta, qm_scaling_path, 'qm_tables')
+
+    return _qm_table_paths(qm_scaling_path, 'qm_tables')[0]
+
+
+def _tile_slices(shape, n_pix_tile):
+    """
+    Splits a (lat, lon) grid into windows of at most n_pix_tile pixels: bands of full rows when a row fits, otherwise
+    pieces of single rows
+    """
+    n_lat, n_lon = shape
+    tile_lat = max(1, min(n_lat, n_pix_tile // n_lon))
+    tile_lon = n_lon if n_pix_tile >= n_lon else max(1, n_pix_tile)
+    return [(slice(r, min(r + tile_lat, n_lat)), slice(c, min(c + tile_lon, n_lon)))
+            for r in range(0, n_lat, tile_lat) for c in range(0, n_lon, tile_lon)]
+
+
+def sorted_quantiles(sorted_hist, count, levels, chunk=65536):
+    """
+    Quantiles of each pixel's history from its sorted form, identical to np.nanquantile (linear method) but without
+    its per-pixel loop over the histories holding NaN
+
+    :param sorted_hist: Sorted history (time x lat x lon), see sort_history
+    :param count: Number of valid values per pixel (lat x lon)
+    :param levels: Quantile levels (between 0 and 1)
+    :param chunk: Number of pixels processed at once
+    :return: Quantiles (levels x lat x lon); NaN where a pixel has no valid value
+    """
+    shape = np.shape(count)
+    count = np.asarray(count).reshape(-1)
+    levels = np.asarray(levels, dtype=np.float64)
+    n_pix = count.size
+    sorted_hist = np.asarray(sorted_hist).reshape(-1, n_pix)
+    n_time = sorted_hist.shape[0]
+
+    # The interpolation positions only depend on the number of valid values: tabulate them once per count
+    n = np.arange(n_time + 1, dtype=np.float64)[:, None]
+    virtual = (n - 1) * levels[None]
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    last = np.maximum(n - 1, 0)
+    previous = np.where(virtual >= n - 1, last, np.maximum(previous, 0))
+    following = np.where(virtual >= n - 1, last, np.minimum(previous + 1, last)).astype(np.intp)
+    previous = previous.astype(np.intp)
+    upper = gamma >= 0.5
+    complement = 1 - gamma
+
+    quants = np.empty((len(levels), n_pix))
+    for start in range(0, n_pix, chunk):
+        stop = min(start + chunk, n_pix)
+        # Pixel-major copy, so the gathers read one contiguous run of each history; the (pixel x levels)
+        # temporaries are reused in place
+        by_pixel = np.ascontiguousarray(sorted_hist[:, start:stop].T).reshape(-1)
+        n_valid = count[start:stop]
+        offset = (np.arange(stop - start) * n_time)[:, None]
+        idx = previous[n_valid]
+        idx += offset
+        below = np.take(by_pixel, idx)
+        idx = following[n_valid]
+        idx += offset
+        above = np.take(by_pixel, idx)
+        diff = np.subtract(above, below)
+        # Same rounding as numpy's interpolation: from the upper value when the weight is 0.5 or more
+        quant = gamma[n_valid]
+        quant *= diff
+        quant += below
+        from_above = complement[n_valid]
+        from_above *= diff
+        np.subtract(above, from_above, out=from_above)
+        np.copyto(quant, from_above, where=upper[n_valid])
+        quant[n_valid == 0] = np.nan
+        quants[:, start:stop] = quant.T
+    return quants.reshape(levels.shape + shape)
+
+
+def _build_qm_tile(job):
+    """
+    Worker of the tiled builds: writes the tables of one spatial tile of one historical stack into the table files
+    """
+    kind, source, paths, ct, (lat_sl, lon_sl), binmid, hist_mon = job
+    with xr.open_dataarray(source, decode_coords='all', engine='h5netcdf') as hist_wf:
+        hist_tile = np.asarray(hist_wf[:, lat_sl, lon_sl].values, dtype=np.float64)
+    tables = np.load(paths[0], mmap_mode='r+')
+    if kind=='tables':
+        tables[ct, :, lat_sl, lon_sl] = sorted_quantiles(*sort_history(hist_tile), binmid)
+    elif kind=='month_tables':
+        for mon in np.unique(hist_mon):
+            tables[ct, mon-1, :, lat_sl, lon_sl] = sorted_quantiles(*sort_history(hist_tile[hist_mon == mon]), binmid)
+    else:
+        sorted_wf, count = sort_history(hist_tile)
+        tables[ct, :sorted_wf.shape[0], lat_sl, lon_sl] = sorted_wf
+        tables[ct, sorted_wf.shape[0]:, lat_sl, lon_sl] = sorted_wf[-1]
+        counts = np.load(paths[1], mmap_mode='r+')
+        counts[ct, lat_sl, lon_sl] = count
+        counts.flush()
+    tables.flush()
+
+
+def _build_qm_tiled(kind, sources, outputs, binmid, pixel_bytes, max_memory, n_workers, hist_mon=None):
+    """
+    Streams the historical stacks in spatial tiles (full time depth, limited lat/lon window) through _build_qm_tile
+    into preallocated on-disk arrays. Tiles are processed in parallel worker processes and their size is chosen so
+    that all workers together stay within max_memory. The arrays replace their paths once complete.
+
+    :param kind: Tables to build: 'tables', 'month_tables' or 'sorted'
+    :param sources: Historical observed and synthesized water fraction stacks
+    :param outputs: Path, shape, data type and initial value (None: left uninitialized) of each array to write
+    :param binmid: Quantile levels
+    :param pixel_bytes: Memory needed per pixel of a tile
+    :param max_memory: Memory budget in bytes for the tiles being processed
+    :param n_workers: Number of worker processes (default: number of cores; 1 builds in this process)
+    :param hist_mon: Month of each historical scene, for the monthly tables
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    n_pix_tile = max(1, int(max_memory // (n_workers * pixel_bytes)))
+
+    tmp_paths = []
+    try:
+        for path, shape, dtype, fill in outputs:
+            tmp_paths.append(_tmp_path(path))
+            table = np.lib.format.open_memmap(tmp_paths[-1], mode='w+', dtype=dtype, shape=shape)
+            if fill is not None:
+                table[...] = fill
+            del table
+
+        jobs = [(kind, sources[ct], tmp_paths, ct, tile, binmid, hist_mon)
+                for ct in range(2) for tile in _tile_slices(outputs[0][1][-2:], n_pix_tile)]
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                list(pool.map(_build_qm_tile, jobs))
+        else:
+            for job in jobs:
+                _build_qm_tile(job)
+        for tmp_path, output in zip(tmp_paths, outputs):
+            os.replace(tmp_path, output[0])
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+
+def _stack_shapes(sources):
+    """
+    :return: Shapes of the historical stacks and the month of each scene of the observed one
+    """
+    shapes, months = [], []
+    for path in sources:
+        with xr.open_dataarray(path, decode_coords='all', engine='h5netcdf') as hist_wf:
+            shapes.append(hist_wf.shape)
+            months.append(hist_wf.time.dt.month.values)
+    return shapes, months[0]
+
+
+def build_qm_tables_chunked(qm_scaling_path, nbins=100, dtype=np.float64, max_memory=2**30, n_workers=None):
+    """
+    Out-of-core build of the quantile tables for historical stacks larger than RAM. The stacks are read in spatial
+    tiles; each tile's quantiles are computed from one sort along time and written into a preallocated on-disk
+    cube, see _build_qm_tiled. Writes the same qm_tables.npy/.json as build_qm_tables.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param dtype: Data type of the stored tables (default: float64)
+    :param max_memory: Memory budget in bytes for the tiles being processed (default: 1 GiB)
+    :param n_workers: Number of worker processes (default: number of cores; 1 builds in this process)
+    :return: Path to the written tables
+    """
+    sources = qm_source_paths(qm_scaling_path)
+    binmid = qm_bins(nbins)
+    table_path, meta_path = _qm_table_paths(qm_scaling_path, 'qm_tables')
+
+    shapes, _ = _stack_shapes(sources)
+    shape = (2, binmid.size) + shapes[0][1:]
+    n_time = max(hist_shape[0] for hist_shape in shapes)
+    # The history of a pixel plus its sorted and pixel-major copies, and the temporaries of sorted_quantiles
+    _build_qm_tiled('tables', sources, [(table_path, shape, dtype, None)], binmid,
+                    8 * (3 * n_time + 7 * binmid.size), max_memory, n_workers)
+
+    meta = {
+        'nbins': nbins,
+        'dtype': np.dtype(dtype).name,
+        'shape': list(shape),
+        'source_hash': source_hash(sources, nbins),
+        'source_stats': _file_stats(sources),
+    }
+    with _atomic_open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    return table_path
+
+
+def load_qm_tables(qm_scaling_path, nbins=100, max_memory=REBUILD_MEMORY):
+    """
+    Memory-maps the stored quantile tables of an AOI, rebuilding them first if they are missing or stale
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param max_memory: Memory budget in bytes of a rebuild (default: REBUILD_MEMORY; None loads the stacks in full)
+    :return: qobs, qsyn (read-only memory maps, nbins+1 x lat x lon) and the quantile levels
+    """
+    if not _table_is_fresh(qm_scaling_path, 'qm_tables', qm_source_paths(qm_scaling_path), nbins):
+        build_qm_tables(qm_scaling_path, nbins, max_memory=max_memory)
+
+    tables = np.load(_qm_table_paths(qm_scaling_path, 'qm_tables')[0], mmap_mode='r')
+
+    return tables[0], tables[1], qm_bins(nbins)
+
+
+def perf_qm_tables(fct_syn_wf_stack, qm_scaling_path, qm_mask, nbins=100, max_memory=REBUILD_MEMORY):
+    """
+    Quantile-scales the forecast with the stored quantile tables instead of the raw historical stacks
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param max_memory: Memory budget in bytes of a rebuild of stale tables (default: REBUILD_MEMORY)
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    qobs, qsyn, binmid = load_qm_tables(qm_scaling_path, nbins, max_memory)
+
+    return apply_qm_tables(fct_syn_wf_stack, qobs, qsyn, qm_mask, binmid)
+
+
+def build_qm_month_tables(qm_scaling_path, nbins=100, dtype=np.float64, max_memory=None, n_workers=None):
+    """
+    Offline build of the climatological (monthly) quantile tables of an AOI. Writes qm_month_tables.npy
+    (2 x 12 x nbins+1 x lat x lon, qobs then qsyn, January first) and its manifest qm_month_tables.json.
+    Months without historical scenes are filled with NaN.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param dtype: Data type of the stored tables (default: float64)
+    :param max_memory: Memory budget in bytes; when given the stacks are streamed tile by tile, see _build_qm_tiled
+                       (default: None, the stacks are loaded in full)
+    :param n_workers: Number of worker processes of a streamed build (default: number of cores)
+    :return: Path to the written tables
+    """
+    sources = qm_source_paths(qm_scaling_path)
+    binmid = qm_bins(nbins)
+    table_path = _qm_table_paths(qm_scaling_path, 'qm_month_tables')[0]
+
+    if max_memory is not None:
+        shapes, hist_mon = _stack_shapes(sources)
+        shape = (2, 12, binmid.size) + shapes[0][1:]
+        n_time = max(hist_shape[0] for hist_shape in shapes)
+        # As for build_qm_tables_chunked, plus the scenes of one month
+        _build_qm_tiled('month_tables', sources, [(table_path, shape, dtype, np.nan)], binmid,
+                        8 * (4 * n_time + 7 * binmid.size), max_memory, n_workers, hist_mon)
+        meta = {
+            'nbins': nbins,
+            'dtype': np.dtype(dtype).name,
+            'shape': list(shape),
+            'months': [int(mon) for mon in np.unique(hist_mon)],
+            'source_hash': source_hash(sources, nbins),
+            'source_stats': _file_stats(sources),
+        }
+        with _atomic_open(_qm_table_paths(qm_scaling_path, 'qm_month_tables')[1], 'w') as f:
+            json.dump(meta, f)
+        return table_path
+
+    hist_obs_wf = xr.load_dataarray(sources[0], decode_coords='all', engine='h5netcdf')
+    hist_syn_wf = xr.load_dataarray(sources[1], decode_coords='all', engine='h5netcdf')
+    hist_mon = hist_obs_wf.time.dt.month.values
+
+    tables = np.full((2, 12, binmid.size) + hist_obs_wf.shape[1:], np.nan, dtype=dtype)
+    for mon in np.unique(hist_mon):
+        tables[0, mon-1] = np.nanquantile(hist_obs_wf.values[hist_mon == mon], binmid, axis=0)
+        tables[1, mon-1] = np.nanquantile(hist_syn_wf.values[hist_mon == mon], binmid, axis=0)
+
+    meta = {
+        'nbins': nbins,
+        'dtype': np.dtype(dtype).name,
+        'shape': list(tables.shape),
+        'months': [int(mon) for mon in np.unique(hist_mon)],
+        'source_hash': source_hash(sources, nbins),
+        'source_stats': _file_stats(sources),
+    }
+    _save_table(tables, meta, qm_scaling_path, 'qm_month_tables')
+
+    return table_path
+
+
+def load_qm_month_tables(qm_scaling_path, nbins=100, max_memory=REBUILD_MEMORY):
+    """
+    Memory-maps the stored monthly quantile tables of an AOI, rebuilding them first if they are missing or stale
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param max_memory: Memory budget in bytes of a rebuild (default: REBUILD_MEMORY; None loads the stacks in full)
+    :return: qobs, qsyn (read-only memory maps, 12 x nbins+1 x lat x lon) and the quantile levels
+    """
+    if not _table_is_fresh(qm_scaling_path, 'qm_month_tables', qm_source_paths(qm_scaling_path), nbins):
+        build_qm_month_tables(qm_scaling_path, nbins, max_memory=max_memory)
+
+    tables = np.load(_qm_table_paths(qm_scaling_path, 'qm_month_tables')[0], mmap_mode='r')
+
+    return tables[0], tables[1], qm_bins(nbins)
+
+
+def apply_qm_month_tables(fct_syn_wf_stack, fct_dates, qobs_mon, qsyn_mon, qm_mask, binmid):
+    """
+    Climatologically quantile-scales all masked pixels and all time steps at once. Every forecast step reads the
+    table slice of its own month, so horizons crossing a month boundary take a single pass like single-month ones.
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled (time x lat x lon), scaled in place
+    :param fct_dates: Date of each forecast step (anything accepted by pd.to_datetime)
+    :param qobs_mon: Monthly quantiles of the historical observed water fraction (12 x nbins+1 x lat x lon)
+    :param qsyn_mon: Monthly quantiles of the historical synthesized water fraction (12 x nbins+1 x lat x lon)
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param binmid: Quantile levels of the tables
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    rows, cols = np.nonzero(np.asarray(qm_mask) == True)
+    fct_mon = np.asarray(pd.DatetimeIndex(np.atleast_1d(pd.to_datetime(fct_dates))).month)
+
+    if rows.size > 0:
+        n_pix = fct_syn_wf_stack.shape[1] * fct_syn_wf_stack.shape[2]
+        pix = np.ravel_multi_index((rows, cols), fct_syn_wf_stack.shape[1:])
+        qsyn_mon = np.asarray(qsyn_mon).reshape(12, -1, n_pix)
+        qobs_mon = np.asarray(qobs_mon).reshape(12, -1, n_pix)
+        # Offset of the month slice for every (time, pixel)
+        pix = (fct_mon[:, None] - 1) * qsyn_mon.shape[1] * n_pix + pix[None, :]
+
+        bin_fct_syn = _batched_interp(fct_syn_wf_stack[:, rows, cols], qsyn_mon, binmid, pix)
+        fct_syn_wf_stack[:, rows, cols] = _batched_interp(bin_fct_syn, binmid, qobs_mon, pix)
+
+    fct_syn_wf_stack[fct_syn_wf_stack > 100] = 100
+    fct_syn_wf_stack[fct_syn_wf_stack < 0] = 0
+
+    return fct_syn_wf_stack
+
+
+def perf_qm_month_tables(fct_syn_wf_stack, fct_dates, qm_scaling_path, qm_mask, nbins=100,
+                         max_memory=REBUILD_MEMORY):
+    """
+    Climatologically quantile-scales the forecast with the stored monthly quantile tables. Gives the same output
+    as perf_qm_month_quick.
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled
+    :param fct_dates: Date of each forecast step
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :param max_memory: Memory budget in bytes of a rebuild of stale tables (default: REBUILD_MEMORY)
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    qobs_mon, qsyn_mon, binmid = load_qm_month_tables(qm_scaling_path, nbins, max_memory)
+
+    return apply_qm_month_tables(fct_syn_wf_stack, fct_dates, qobs_mon, qsyn_mon, qm_mask, binmid)
+
+
+def _parse_func_key(key):
+    """
+    :param key: Key of a pickled interpolator dictionary, 'r<row>_c<col>' or 'mon<month>_r<row>_c<col>' (the
+                quant2wf monthly dictionaries use 'mon<month>r<row>_c<col>')
+    :return: month (0 for yearly keys), row and column
+    """
+    match = re.fullmatch(r'(?:mon(\d+)_?)?r(\d+)_c(\d+)', key)
+    if match is None:
+        raise ValueError('Unrecognized interpolator key: ' + key)
+    mon, row, col = match.groups()
+    return int(mon or 0), int(row), int(col)
+
+
+def convert_qm_funcs(funcs, shape, monthly=False):
+    """
+    Converts a dictionary of per-pixel scipy interp1d objects (wf2quant/quant2wf) into dense arrays
+
+    Knot arrays are padded with their last knot, so np.interp rules hold over the padded tail. Pixels without an
+    interpolator are flagged in the validity bitmap instead of being looked up and caught at run time.
+
+    :param funcs: Dictionary of linear interp1d objects keyed like the pickled dictionaries
+    :param shape: Shape of the grid (lat, lon)
+    :param monthly: Whether the dictionary is keyed by month (mon1 ... mon12)
+    :return: Dictionary of arrays: knots (2 x month x knots x pixel, positions then values), count, valid, left,
+             right, extrapolate (month x pixel) and shape
+    """
+    n_mon = 12 if monthly else 1
+    n_pix = shape[0] * shape[1]
+
+    parsed = []
+    for key, func in funcs.items():
+        mon, row, col = _parse_func_key(key)
+        if getattr(func, '_kind', 'linear') != 'linear':
+            raise ValueError('Only linear interpolators can be converted, got ' + str(func._kind) + ' for ' + key)
+        parsed.append((max(mon - 1, 0), row * shape[1] + col, func))
+    n_knots = max([len(func.x) for _, _, func in parsed] + [2])
+
+    knots = np.full((2, n_mon, n_knots, n_pix), np.nan)
+    count = np.zeros((n_mon, n_pix), dtype=np.int32)
+    valid = np.zeros((n_mon, n_pix), dtype=bool)
+    left = np.full((n_mon, n_pix), np.nan)
+    right = np.full((n_mon, n_pix), np.nan)
+    extrapolate = np.zeros((n_mon, n_pix), dtype=bool)
+
+    for mon, pix, func in parsed:
+        x = np.asarray(func.x, dtype=np.float64)
+        y = np.asarray(func.y, dtype=np.float64).reshape(-1)
+        knots[0, mon, :, pix] = np.concatenate([x, np.repeat(x[-1:], n_knots - x.size)])
+        knots[1, mon, :, pix] = np.concatenate([y, np.repeat(y[-1:], n_knots - y.size)])
+        count[mon, pix] = x.size
+        valid[mon, pix] = True
+        extrapolate[mon, pix] = bool(getattr(func, '_extrapolate', False))
+        if not func.bounds_error and not extrapolate[mon, pix]:
+            left[mon, pix] = np.asarray(func._fill_value_below).reshape(-1)[0]
+            right[mon, pix] = np.asarray(func._fill_value_above).reshape(-1)[0]
+
+    return dict(knots=knots, count=count, valid=valid, left=left, right=right, extrapolate=extrapolate,
+                shape=np.asarray(shape))
+
+
+def save_qm_funcs(func_arrays, qm_scaling_path, name, sources=None):
+    """
+    Writes converted interpolators as <name>_knots.npy (memory-mappable) and <name>_meta.npz, and the manifest
+    <name>_knots.json of the files they were converted from
+
+    :param func_arrays: Output of convert_qm_funcs
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param name: Name of the interpolator set, e.g. 'wf2quant_funcs'
+    :param sources: Source files of the interpolators (default: the pickled <name>.npy dictionary)
+    """
+    sources = sources if sources is not None else [qm_scaling_path + name + '.npy']
+    with _atomic_open(qm_scaling_path + name + '_knots.npy') as f:
+        np.save(f, func_arrays['knots'])
+    with _atomic_open(qm_scaling_path + name + '_meta.npz') as f:
+        np.savez(f, **{key: value for key, value in func_arrays.items() if key != 'knots'})
+    meta = {
+        'nbins': None,
+        'shape': list(func_arrays['knots'].shape),
+        'source_hash': source_hash(sources, None),
+        'source_stats': _file_stats(sources),
+    }
+    with _atomic_open(qm_scaling_path + name + '_knots.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_qm_funcs(qm_scaling_path, name, shape=None):
+    """
+    Loads converted interpolators, converting the pickled <name>.npy dictionary first if they are missing or
+    stale (the manifest of the converted files does not match the pickled dictionary)
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param name: Name of the interpolator set, e.g. 'wf2quant_funcs' or 'quant2wf_mon_funcs'
+    :param shape: Shape of the grid (lat, lon), only needed when the pickled dictionary has to be converted
+    :return: Dictionary of arrays as returned by convert_qm_funcs, with the knots memory-mapped
+    """
+    sources = [qm_scaling_path + name + '.npy']
+    if os.path.exists(sources[0]):
+        fresh = _table_is_fresh(qm_scaling_path, name + '_knots', sources, None)
+    else:
+        # Converted interpolators may be deployed without their pickled dictionary
+        fresh = os.path.exists(qm_scaling_path + name + '_knots.npy')
+    if not fresh:
+        if shape is None:
+            raise ValueError('The grid shape is needed to convert ' + qm_scaling_path + name + '.npy')
+        funcs = np.load(qm_scaling_path + name + '.npy', allow_pickle=True).item()
+        save_qm_funcs(convert_qm_funcs(funcs, shape, monthly='_mon' in name), qm_scaling_path, name, sources)
+
+    with np.load(qm_scaling_path + name + '_meta.npz') as meta:
+        func_arrays = {key: meta[key] for key in meta.files}
+    func_arrays['knots'] = np.load(qm_scaling_path + name + '_knots.npy', mmap_mode='r')
+
+    return func_arrays
+
+
+def eval_qm_funcs(values, func_arrays, pix, mon=0):
+    """
+    Evaluates converted interpolators for many pixels at once, with the out-of-range rules of interp1d
+    (linear extrapolation, fill values, or NaN where the interpolator would raise)
+
+    :param values: Values to be mapped (time x pixel)
+    :param func_arrays: Converted interpolators, see convert_qm_funcs
+    :param pix: Flat grid index of each pixel
+    :param mon: Month (1-12) for monthly interpolators, 0 for yearly ones
+    :return: Mapped values (time x pixel)
+    """
+    knots = func_arrays['knots']
+    n_pix = knots.shape[-1]
+    slot = max(mon - 1, 0)
+    xp = knots[0, slot]
+    fp = knots[1, slot]
+    out = _batched_interp(values, xp, fp, pix)
+
+    count = func_arrays['count'][slot, pix]
+    last = np.maximum(count - 1, 1)
+    x0, x1 = xp[0, pix], xp[1, pix]
+    xm, xn = xp[last - 1, pix], xp[last, pix]
+    y0, y1 = fp[0, pix], fp[1, pix]
+    ym, yn = fp[last - 1, pix], fp[last, pix]
+
+    extrapolate = func_arrays['extrapolate'][slot, pix]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        below = np.where(extrapolate, y0 + (values - x0) * (y1 - y0) / (x1 - x0), func_arrays['left'][slot, pix])
+        above = np.where(extrapolate, yn + (values - xn) * (yn - ym) / (xn - xm), func_arrays['right'][slot, pix])
+    out = np.where(values < x0, below, out)
+    out = np.where(values > xn, above, out)
+
+    return out
+
+
+def perf_qm_arrays(fct_syn_wf_stack, qm_scaling_path, qm_mask, fct_date=None):
+    """
+    Array-backed replacement of perf_qm (fct_date=None) and perf_qm_mon (fct_date given). Scales every time step
+    of every masked pixel with a converted interpolator in one pass; masked pixels without an interpolator are
+    only clipped to [0, 100], unmasked pixels are left unchanged, as in perf_qm.
+
+    :param fct_syn_wf_stack: Synthesized forecasted water fractions without quantile scaling
+    :param qm_scaling_path: Path to the pre-fitted quantile scaling function
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param fct_date: Forecasting date for the climatological (monthly) interpolators
+    :return: Quantile-scaled synthesized forecasted water fractions
+    """
+    suffix = '_funcs' if fct_date is None else '_mon_funcs'
+    mon = 0 if fct_date is None else pd.to_datetime(fct_date).month
+    shape = fct_syn_wf_stack.shape[1:]
+
+    wf2quant = load_qm_funcs(qm_scaling_path, 'wf2quant' + suffix, shape)
+    quant2wf = load_qm_funcs(qm_scaling_path, 'quant2wf' + suffix, shape)
+
+    rows, cols = np.nonzero(np.asarray(qm_mask) == True)
+    pix = np.ravel_multi_index((rows, cols), shape)
+    slot = max(mon - 1, 0)
+    valid = wf2quant['valid'][slot, pix] & quant2wf['valid'][slot, pix]
+
+    values = fct_syn_wf_stack[:, rows, cols]
+    if valid.any():
+        values[:, valid] = eval_qm_funcs(eval_qm_funcs(values[:, valid], wf2quant, pix[valid], mon),
+                                         quant2wf, pix[valid], mon)
+    fct_syn_wf_stack[:, rows, cols] = np.clip(values, 0, 100)
+
+    return fct_syn_wf_stack
+
+
+def sort_history(hist_wf_stack):
+    """
+    Sorts every pixel's history and compacts the NaN: valid values come first in increasing order and the tail is
+    padded with the largest valid value, so the columns stay non-decreasing
+
+    :param hist_wf_stack: Historical water fraction (time x lat x lon)
+    :return: Sorted history (time x lat x lon) and the number of valid values per pixel (lat x lon)
+    """
+    hist = np.sort(np.asarray(hist_wf_stack, dtype=np.float64), axis=0)
+    missing = np.isnan(hist)
+    count = hist.shape[0] - np.count_nonzero(missing, axis=0)
+    # NaN sort last: overwrite them with the largest valid value
+    largest = np.take_along_axis(hist, np.maximum(count - 1, 0)[None], axis=0)
+    np.copyto(hist, np.broadcast_to(largest, hist.shape), where=missing)
+    return hist, count.astype(np.int32)
+
+
+def build_qm_sorted(qm_scaling_path, max_memory=None, n_workers=None):
+    """
+    Offline build of the sorted histories used by the exact empirical-CDF quantile mapping. Writes qm_sorted.npy
+    (2 x time x lat x lon, observed then synthesized), qm_sorted_counts.npy (2 x lat x lon) and the manifest
+    qm_sorted.json.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param max_memory: Memory budget in bytes; when given the stacks are streamed tile by tile, see _build_qm_tiled
+                       (default: None, the stacks are loaded in full)
+    :param n_workers: Number of worker processes of a streamed build (default: number of cores)
+    :return: Path to the written sorted histories
+    """
+    sources = qm_source_paths(qm_scaling_path)
+    table_path, meta_path = _qm_table_paths(qm_scaling_path, 'qm_sorted')
+
+    if max_memory is not None:
+        shapes, _ = _stack_shapes(sources)
+        n_time = max(hist_shape[0] for hist_shape in shapes)
+        shape = (2, n_time) + shapes[0][1:]
+        # The history of a pixel and its sorted copy
+        _build_qm_tiled('sorted', sources, [(table_path, shape, np.float64, None),
+                                            (qm_scaling_path + 'qm_sorted_counts.npy', (2,) + shape[2:], np.int32,
+                                             None)],
+                        None, 8 * 3 * n_time, max_memory, n_workers)
+        meta = {
+            'nbins': None,
+            'shape': list(shape),
+            'source_hash': source_hash(sources, None),
+            'source_stats': _file_stats(sources),
+        }
+        with _atomic_open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return table_path
+
+    hist_obs_wf = xr.load_dataarray(sources[0], decode_coords='all', engine='h5netcdf')
+    hist_syn_wf = xr.load_dataarray(sources[1], decode_coords='all', engine='h5netcdf')
+
+    n_time = max(hist_obs_wf.shape[0], hist_syn_wf.shape[0])
+    tables = np.empty((2, n_time) + hist_obs_wf.shape[1:])
+    counts = np.empty((2,) + hist_obs_wf.shape[1:], dtype=np.int32)
+    for ct, hist_wf in enumerate([hist_obs_wf, hist_syn_wf]):
+        sorted_wf, counts[ct] = sort_history(hist_wf.values)
+        tables[ct, :sorted_wf.shape[0]] = sorted_wf
+        tables[ct, sorted_wf.shape[0]:] = sorted_wf[-1]
+
+    with _atomic_open(qm_scaling_path + 'qm_sorted_counts.npy') as f:
+        np.save(f, counts)
+    meta = {
+        'nbins': None,
+        'shape': list(tables.shape),
+        'source_hash': source_hash(sources, None),
+        'source_stats': _file_stats(sources),
+    }
+    _save_table(tables, meta, qm_scaling_path, 'qm_sorted')
+
+    return table_path
+
+
+def load_qm_sorted(qm_scaling_path, max_memory=REBUILD_MEMORY):
+    """
+    Memory-maps the stored sorted histories of an AOI, rebuilding them first if they are missing or stale
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param max_memory: Memory budget in bytes of a rebuild (default: REBUILD_MEMORY; None loads the stacks in full)
+    :return: Sorted observed and synthesized histories (time x lat x lon) and their valid counts (lat x lon)
+    """
+    if not _table_is_fresh(qm_scaling_path, 'qm_sorted', qm_source_paths(qm_scaling_path), None):
+        build_qm_sorted(qm_scaling_path, max_memory)
+
+    tables = np.load(_qm_table_paths(qm_scaling_path, 'qm_sorted')[0], mmap_mode='r')
+    counts = np.load(qm_scaling_path + 'qm_sorted_counts.npy')
+
+    return tables[0], tables[1], counts[0], counts[1]
+
+
+def apply_qm_ecdf(fct_syn_wf_stack, sorted_obs, sorted_syn, count_obs, count_syn, qm_mask):
+    """
+    Exact empirical-CDF quantile mapping: the forecast is located in the sorted synthesized history (batched binary
+    search plus linear interpolation between order statistics) and the matching probability is read back from the
+    sorted observed history, i.e. the 100-bin mapping of perf_qm_quick in the limit of infinitely many bins
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled (time x lat x lon), scaled in place
+    :param sorted_obs: Sorted, NaN-compacted observed history (time x lat x lon), see sort_history
+    :param sorted_syn: Sorted, NaN-compacted synthesized history (time x lat x lon)
+    :param count_obs: Number of valid observed values per pixel (lat x lon)
+    :param count_syn: Number of valid synthesized values per pixel (lat x lon)
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    rows, cols = np.nonzero(np.asarray(qm_mask) == True)
+
+    if rows.size > 0:
+        n_pix = fct_syn_wf_stack.shape[1] * fct_syn_wf_stack.shape[2]
+        pix = np.ravel_multi_index((rows, cols), fct_syn_wf_stack.shape[1:])
+        sorted_syn = np.asarray(sorted_syn).reshape(-1, n_pix)
+        sorted_obs = np.asarray(sorted_obs).reshape(-1, n_pix)
+        n_syn = np.asarray(count_syn).reshape(-1)[pix]
+        n_obs = np.asarray(count_obs).reshape(-1)[pix]
+
+        # Forward: fractional rank of the forecast among the synthesized order statistics, as a probability
+        fct_pix = np.asarray(fct_syn_wf_stack[:, rows, cols], dtype=np.float64)
+        rank = np.minimum(_batched_interp(fct_pix, sorted_syn, np.arange(sorted_syn.shape[0]), pix), n_syn - 1)
+        prob = rank / np.maximum(n_syn - 1, 1)
+        single = (n_syn == 1) & ~np.isnan(prob)
+        prob = np.where(single, (fct_pix >= sorted_syn[0, pix]).astype(np.float64), prob)
+
+        # Inverse: linear interpolation between the observed order statistics at that probability
+        pos = prob * np.maximum(n_obs - 1, 0)
+        lo = np.clip(np.floor(np.nan_to_num(pos)), 0, np.maximum(n_obs - 1, 0)).astype(np.intp)
+        hi = np.minimum(lo + 1, np.maximum(n_obs - 1, 0))
+        flat_obs = sorted_obs.reshape(-1)
+        obs_lo = np.take(flat_obs, lo * n_pix + pix)
+        obs_hi = np.take(flat_obs, hi * n_pix + pix)
+        mapped = obs_lo + (obs_hi - obs_lo) * (pos - lo)
+        fct_syn_wf_stack[:, rows, cols] = np.where(np.isnan(pos) | (n_obs == 0), np.nan, mapped)
+
+    fct_syn_wf_stack[fct_syn_wf_stack > 100] = 100
+    fct_syn_wf_stack[fct_syn_wf_stack < 0] = 0
+
+    return fct_syn_wf_stack
+
+
+def perf_qm_ecdf(fct_syn_wf_stack, qm_scaling_path, qm_mask, max_memory=REBUILD_MEMORY):
+    """
+    Quantile-scales the forecast with the stored sorted histories (exact empirical-CDF matching)
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param max_memory: Memory budget in bytes of a rebuild of stale sorted histories (default: REBUILD_MEMORY)
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    sorted_obs, sorted_syn, count_obs, count_syn = load_qm_sorted(qm_scaling_path, max_memory)
+
+    return apply_qm_ecdf(fct_syn_wf_stack, sorted_obs, sorted_syn, count_obs, count_syn, qm_mask)
+
+
+def init_qm_sketch(shape, value_range=(0., 100.), n_sketch_bins=200):
+    """
+    Creates an empty per-pixel quantile sketch: a fixed-size histogram of counts on shared bin edges, the counts of
+    the values lying exactly on an edge (point masses, e.g. whole percentages with the default range) plus the exact
+    per-pixel minimum and maximum. Values outside value_range are counted in the edge bins.
+
+    :param shape: Shape of the grid (lat, lon)
+    :param value_range: Range covered by the histogram bins
+    :param n_sketch_bins: Number of histogram bins
+    :return: Sketch as a dictionary of arrays (counts, points, edges, vmin, vmax)
+    """
+    return dict(
+        counts=np.zeros((n_sketch_bins,) + tuple(shape), dtype=np.uint32),
+        points=np.zeros((n_sketch_bins + 1,) + tuple(shape), dtype=np.uint32),
+        edges=np.linspace(value_range[0], value_range[1], n_sketch_bins + 1),
+        vmin=np.full(shape, np.inf),
+        vmax=np.full(shape, -np.inf),
+    )
+
+
+def update_qm_sketch(sketch, wf_stack):
+    """
+    Folds new scenes into a sketch, in time proportional to the number of new scenes
+
+    :param sketch: Sketch created by init_qm_sketch, updated in place
+    :param wf_stack: New water fraction scenes (time x lat x lon), NaN are ignored
+    :return: The updated sketch
+    """
+    wf_stack = np.asarray(wf_stack, dtype=np.float64).reshape((-1,) + sketch['vmin'].shape)
+    counts = sketch['counts'].reshape(sketch['counts'].shape[0], -1)
+    points = sketch['points'].reshape(sketch['points'].shape[0], -1)
+    edges = sketch['edges']
+    n_pix = counts.shape[1]
+
+    values = wf_stack.reshape(wf_stack.shape[0], -1)
+    valid = ~np.isnan(values)
+    pix = np.broadcast_to(np.arange(n_pix), values.shape)[valid]
+    values = values[valid]
+    position = (values - edges[0]) / (edges[1] - edges[0])
+
+    edge = np.clip(np.rint(position), 0, len(edges) - 1).astype(np.intp)
+    on_edge = edges[edge] == values
+    np.add.at(points.reshape(-1), edge[on_edge] * n_pix + pix[on_edge], 1)
+    bins = np.clip(position[~on_edge].astype(np.intp), 0, counts.shape[0] - 1)
+    np.add.at(counts.reshape(-1), bins * n_pix + pix[~on_edge], 1)
+
+    sketch['vmin'] = np.fmin(sketch['vmin'], np.fmin.reduce(wf_stack, axis=0))
+    sketch['vmax'] = np.fmax(sketch['vmax'], np.fmax.reduce(wf_stack, axis=0))
+
+    return sketch
+
+
+def qm_sketch_quantiles(sketch, binmid, chunk=65536):
+    """
+    Emits a quantile table from a sketch, in time proportional to the sketch size (not to the archive length).
+    The point masses keep their exact value and the other values of a bin are assumed evenly spread inside it;
+    quantiles are interpolated linearly between consecutive values, like the linear method of np.nanquantile, and
+    clamped to the exact per-pixel extremes. Histories made of edge values only get their exact quantiles.
+
+    :param sketch: Sketch created by init_qm_sketch
+    :param binmid: Quantile levels
+    :param chunk: Number of pixels processed at once
+    :return: Quantile table (quantile levels x lat x lon), NaN for pixels without any value
+    """
+    counts = sketch['counts'].reshape(sketch['counts'].shape[0], -1)
+    points = sketch['points'].reshape(sketch['points'].shape[0], -1)
+    edges = sketch['edges']
+    vmin = sketch['vmin'].reshape(-1)
+    vmax = sketch['vmax'].reshape(-1)
+    n_bins, n_pix = counts.shape
+    n_segments = 2 * n_bins + 1
+    quants = np.empty((len(binmid), n_pix))
+
+    for start in range(0, n_pix, chunk):
+        stop = min(start + chunk, n_pix)
+        # Segments in increasing value order: the point mass of each edge, then the inside of the bin above it
+        count = np.empty((n_segments, stop - start))
+        count[0::2] = points[:, start:stop]
+        count[1::2] = counts[:, start:stop]
+        cum_before = np.cumsum(count, axis=0) - count
+        total = cum_before[-1] + count[-1]
+
+        # Two knots per segment in order-statistic space: its first and its last value
+        with np.errstate(divide='ignore', invalid='ignore'):
+            half_step = 0.5 * (edges[1] - edges[0]) / count[1::2]
+        low = np.empty_like(count)
+        high = np.empty_like(count)
+        low[0::2] = high[0::2] = edges[:, None]
+        low[1::2] = edges[:-1, None] + half_step
+        high[1::2] = edges[1:, None] - half_step
+        knot_x = np.stack([cum_before, cum_before + count - 1])
+        knot_y = np.stack([low, high])
+
+        # Empty segments repeat the last knot of the previous non-empty segment (the first knot of the first
+        # non-empty segment before it), so the knots stay non-decreasing and ties share the same value
+        nonempty = count > 0
+        prev = np.maximum.accumulate(np.where(nonempty, np.arange(n_segments)[:, None], -1), axis=0)
+        first = np.argmax(nonempty, axis=0)
+        cols = np.arange(stop - start)
+        fill_x = np.where(prev >= 0, knot_x[1, np.maximum(prev, 0), cols], knot_x[0, first, cols])
+        fill_y = np.where(prev >= 0, knot_y[1, np.maximum(prev, 0), cols], knot_y[0, first, cols])
+        knot_x = np.where(nonempty, knot_x, fill_x).transpose(1, 0, 2).reshape(2 * n_segments, -1)
+        knot_y = np.where(nonempty, knot_y, fill_y).transpose(1, 0, 2).reshape(2 * n_segments, -1)
+
+        ranks = np.asarray(binmid)[:, None] * np.maximum(total - 1, 0)[None, :]
+        quant = _batched_interp(ranks, knot_x, knot_y)
+        quant = np.clip(quant, vmin[start:stop], vmax[start:stop])
+        quant[0] = vmin[start:stop]
+        quant[-1] = vmax[start:stop]
+        quant[:, total == 0] = np.nan
+        quants[:, start:stop] = quant
+
+    return quants.reshape((len(binmid),) + sketch['vmin'].shape)
+
+
+# Arrays of a sketch, as stored in qm_sketch.npz
+_SKETCH_KEYS = ('counts', 'points', 'edges', 'vmin', 'vmax')
+
+
+def _save_qm_sketches(sketches, meta, qm_scaling_path):
+    """
+    Writes the sketches with their manifest (running hash of the scenes they hold and stats of the historical stacks)
+    """
+    arrays = {kind + '_' + key: value for kind, sketch in sketches.items() for key, value in sketch.items()}
+    with _atomic_open(qm_scaling_path + 'qm_sketch.npz') as f:
+        np.savez(f, meta=json.dumps(meta), **arrays)
+
+
+def _load_qm_sketches(qm_scaling_path):
+    """
+    :return: The stored sketches and their manifest; None, None when they are missing or lack a manifest, point
+             masses or the hash of their scenes (older sketches)
+    """
+    try:
+        with np.load(qm_scaling_path + 'qm_sketch.npz') as arrays:
+            arrays = dict(arrays)
+    except (OSError, ValueError):
+        return None, None
+    if 'meta' not in arrays or any(kind + '_' + key not in arrays for kind in ('obs', 'syn') for key in _SKETCH_KEYS):
+        return None, None
+    meta = json.loads(str(arrays['meta']))
+    if 'scenes_hash' not in meta:
+        return None, None
+    sketches = {kind: {key: arrays[kind + '_' + key] for key in _SKETCH_KEYS} for kind in ('obs', 'syn')}
+    return sketches, meta
+
+
+def _sketch_grid(value_range, n_sketch_bins):
+    """
+    :return: Number of bins closest to n_sketch_bins with a whole number of bins per unit of a range of whole
+             numbers, so every whole percentage is a bin edge
+    """
+    width = int(round(value_range[1] - value_range[0]))
+    return width * max(1, int(round(n_sketch_bins / width)))
+
+
+def _scenes_hash(previous, *wf_stacks):
+    """
+    :return: Running SHA-256 hex digest of the scenes folded into the sketches, chained from the previous digest
+    """
+    digest = hashlib.sha256(previous.encode())
+    for wf_stack in wf_stacks:
+        digest.update(np.ascontiguousarray(wf_stack, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def build_qm_sketches(qm_scaling_path, n_sketch_bins=200):
+    """
+    Builds the observed and synthesized sketches of an AOI once from the full historical stacks (qm_sketch.npz).
+    Each sketch covers 0-100 % widened to the range of its history, with about n_sketch_bins bins and every whole
+    percentage on a bin edge; later values outside the range fall in the edge bins.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param n_sketch_bins: Number of histogram bins of each sketch
+    :return: Dictionary of the observed ('obs') and synthesized ('syn') sketches, and their manifest
+    """
+    sources = qm_source_paths(qm_scaling_path)
+    hist_obs_wf = xr.load_dataarray(sources[0], decode_coords='all', engine='h5netcdf')
+    hist_syn_wf = xr.load_dataarray(sources[1], decode_coords='all', engine='h5netcdf')
+    sketches = {}
+    for kind, hist_wf in [('obs', hist_obs_wf), ('syn', hist_syn_wf)]:
+        value_range = (min(np.floor(np.nanmin(hist_wf.values)), 0.), max(np.ceil(np.nanmax(hist_wf.values)), 100.))
+        sketch = init_qm_sketch(hist_wf.shape[1:], value_range, _sketch_grid(value_range, n_sketch_bins))
+        sketches[kind] = update_qm_sketch(sketch, hist_wf.values)
+    meta = {'scenes_hash': _scenes_hash('', hist_obs_wf.values, hist_syn_wf.values),
+            'source_stats': _file_stats(sources)}
+    _save_qm_sketches(sketches, meta, qm_scaling_path)
+    return sketches, meta
+
+
+def _save_qm_sketch_tables(sketches, meta, qm_scaling_path, nbins):
+    """
+    Emits the quantile tables of the sketches into qm_sketch_tables.npy, apart from the exact qm_tables.npy
+    """
+    binmid = qm_bins(nbins)
+    tables = np.stack([qm_sketch_quantiles(sketches['obs'], binmid), qm_sketch_quantiles(sketches['syn'], binmid)])
+    meta = {
+        'nbins': nbins,
+        'dtype': tables.dtype.name,
+        'shape': list(tables.shape),
+        'method': 'sketch',
+        'scenes_hash': meta['scenes_hash'],
+        'source_stats': meta['source_stats'],
+    }
+    _save_table(tables, meta, qm_scaling_path, 'qm_sketch_tables')
+    return _qm_table_paths(qm_scaling_path, 'qm_sketch_tables')[0]
+
+
+def update_qm_sketch_tables(qm_scaling_path, new_obs_wf, new_syn_wf, nbins=100):
+    """
+    Folds newly ingested scenes into the stored sketches of an AOI and emits fresh approximate quantile tables
+    (qm_sketch_tables.npy) without reading the historical archive. Call it after the new scenes were appended to
+    hist_real_wf_trim.nc and hist_syn_wf_trim.nc: the manifests record the size and modification time of the
+    updated source files, so a repeated call does not fold the same scenes twice, and a running hash of the folded
+    scenes. The exact qm_tables.npy are left untouched.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param new_obs_wf: New observed water fraction scenes (time x lat x lon)
+    :param new_syn_wf: Synthesized water fraction of the same scenes (time x lat x lon)
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :return: Path to the written tables
+    """
+    sources = qm_source_paths(qm_scaling_path)
+    sketches, meta = _load_qm_sketches(qm_scaling_path)
+    if sketches is None:
+        # First update: the sketches are built from the history, which already holds the new scenes
+        sketches, meta = build_qm_sketches(qm_scaling_path)
+    elif meta['source_stats'] != _file_stats(sources):
+        update_qm_sketch(sketches['obs'], new_obs_wf)
+        update_qm_sketch(sketches['syn'], new_syn_wf)
+        meta = {'scenes_hash': _scenes_hash(meta['scenes_hash'], new_obs_wf, new_syn_wf),
+                'source_stats': _file_stats(sources)}
+        _save_qm_sketches(sketches, meta, qm_scaling_path)
+    return _save_qm_sketch_tables(sketches, meta, qm_scaling_path, nbins)
+
+
+def load_qm_sketch_tables(qm_scaling_path, nbins=100):
+    """
+    Memory-maps the quantile tables emitted from the sketches of an AOI. When the historical stacks changed
+    without update_qm_sketch_tables being called, the sketches are rebuilt from the stacks first.
+
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :return: qobs, qsyn (read-only memory maps, nbins+1 x lat x lon) and the quantile levels
+    """
+    stats = _file_stats(qm_source_paths(qm_scaling_path))
+    table_path, meta_path = _qm_table_paths(qm_scaling_path, 'qm_sketch_tables')
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+    if not (os.path.exists(table_path) and meta.get('nbins') == nbins and meta.get('source_stats') == stats):
+        sketches, meta = _load_qm_sketches(qm_scaling_path)
+        if sketches is None or meta.get('source_stats') != stats:
+            sketches, meta = build_qm_sketches(qm_scaling_path)
+        _save_qm_sketch_tables(sketches, meta, qm_scaling_path, nbins)
+
+    tables = np.load(table_path, mmap_mode='r')
+
+    return tables[0], tables[1], qm_bins(nbins)
+
+
+def perf_qm_sketch_tables(fct_syn_wf_stack, qm_scaling_path, qm_mask, nbins=100):
+    """
+    Quantile-scales the forecast with the quantile tables emitted from the sketches, which follow the daily
+    ingestion without full rebuilds but are approximate (see qm_sketch_quantiles)
+
+    :param fct_syn_wf_stack: Forecasted synthesized water fraction to be scaled
+    :param qm_scaling_path: Path to the quantile scaling folder of an AOI
+    :param qm_mask: Mask of where quantile scaling will be performed
+    :param nbins: Number of bins to get the quantile (default: 100)
+    :return: Quantile-scaled forecasted synthesized water fraction
+    """
+    qobs, qsyn, binmid = load_qm_sketch_tables(qm_scaling_path, nbins)
+
+    return apply_qm_tables(fct_syn_wf_stack, qobs, qsyn, qm_mask, binmid)
+
+
+def benchmark_qm_vectorized(shape=(200, 200), n_hist=100, n_fct=8, nan_frac=0.2, seed=0):
+    """
+    Benchmarks perf_qm_vectorized against the per-pixel perf_qm_quick of syn_noaa2 on synthetic water fractions
+
+    :param shape: Shape of the grid (lat, lon)
+    :param n_hist: Number of historical scenes
+    :param n_fct: Number of forecast steps
+    :param nan_frac: Fraction of missing historical values
+    :param seed: Seed of the random generator
+    :return: Dictionary of run times (s), speedup and largest difference between both outputs (% water fraction)
+    """
+    from syn_noaa2 import perf_qm_quick
+
+    rng = np.random.default_rng(seed)
+    obs = np.clip(rng.gamma(2., 15., (n_hist,) + shape), 0, 100)
+    syn = np.clip(obs * 0.8 + rng.normal(10., 8., obs.shape), 0, 100)
+    obs[rng.random(obs.shape) < nan_frac] = np.nan
+    syn[rng.random(syn.shape) < nan_frac] = np.nan
+    fct = np.clip(rng.gamma(2., 15., (n_fct,) + shape), 0, 100)
+    qm_mask = xr.DataArray(rng.random(shape) < 0.7)
+
+    report = {}
+    st_time = time.time()
+    out_quick = perf_qm_quick(xr.DataArray(obs), xr.DataArray(syn), fct.copy(), qm_mask)
+    report['quick'] = time.time() - st_time
+    st_time = time.time()
+    out_vectorized = perf_qm_vectorized(obs, syn, fct.copy(), qm_mask)
+    report['vectorized'] = time.time() - st_time
+
+    report['speedup'] = report['quick'] / report['vectorized']
+    report['max_abs_diff'] = float(np.nanmax(np.abs(out_vectorized - out_quick)))
+
+    return report
+
+
+def benchmark_qm_ecdf(shape=(300, 300), n_hist=365, n_fct=8, nan_frac=0.2, seed=0):
+    """
+    Benchmarks the exact empirical-CDF mapping against the 100-bin mapping on synthetic water fractions
+
+    :param shape: Shape of the grid (lat, lon)
+    :param n_hist: Number of historical scenes
+    :param n_fct: Number of forecast steps
+    :param nan_frac: Fraction of missing historical values
+    :param seed: Seed of the random generator
+    :return: Dictionary of build/query times (s) and of the differences between both mappings (% water fraction)
+    """
+    rng = np.random.default_rng(seed)
+    obs = np.clip(rng.gamma(2., 15., (n_hist,) + shape), 0, 100)
+    syn = np.clip(obs * 0.8 + rng.normal(10., 8., obs.shape), 0, 100)
+    obs[rng.random(obs.shape) < nan_frac] = np.nan
+    fct = np.clip(rng.gamma(2., 15., (n_fct,) + shape), 0, 100)
+    qm_mask = rng.random(shape) < 0.7
+
+    report = {}
+    st_time = time.time()
+    binmid = qm_bins(100)
+    qobs = np.nanquantile(obs, binmid, axis=0)
+    qsyn = np.nanquantile(syn, binmid, axis=0)
+    report['bins_build'] = time.time() - st_time
+    st_time = time.time()
+    out_bins = apply_qm_tables(fct.copy(), qobs, qsyn, qm_mask, binmid)
+    report['bins_query'] = time.time() - st_time
+
+    st_time = time.time()
+    sorted_obs, count_obs = sort_history(obs)
+    sorted_syn, count_syn = sort_history(syn)
+    report['ecdf_build'] = time.time() - st_time
+    st_time = time.time()
+    out_ecdf = apply_qm_ecdf(fct.copy(), sorted_obs, sorted_syn, count_obs, count_syn, qm_mask)
+    report['ecdf_query'] = time.time() - st_time
+
+    diff = np.abs(out_ecdf - out_bins)[:, qm_mask]
+    report['max_abs_diff'] = float(np.nanmax(diff))
+    report['mean_abs_diff'] = float(np.nanmean(diff))
+    report['p99_abs_diff'] = float(np.nanpercentile(diff, 99))
+
+    return report
+
+
+if __name__ == '__main__':
+    # Offline build of the quantile tables, e.g. "python qm_tools.py MississippiRiver RedRiver",
+    # or "python qm_tools.py benchmark" to time the vectorized mapping and compare the empirical-CDF and the 100-bin
+    # mappings
+    if sys.argv[1:] == ['benchmark']:
+        for key, value in benchmark_qm_vectorized().items():
+            print(key, value)
+        for key, value in benchmark_qm_ecdf().items():
+            print(key, value)
+    for AOI_str in sys.argv[1:]:
+        if AOI_str == 'benchmark':
+            continue
+        print(build_qm_tables('AOI/'+AOI_str+'/for_qm_scaling/'))
+        print(build_qm_month_tables('AOI/'+AOI_str+'/for_qm_scaling/'))
+        print(build_qm_sorted('AOI/'+AOI_str+'/for_qm_scaling/'))
@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+
+import numpy as np
+import pandas as pd
+
+from aoi_context import get_aoi_context
+from nwm_index import archive_index
+from qm_tools import _atomic_open, _file_stats, source_hash, qm_source_paths
+from tpc_models import tpc_model_path
+
+# Monthly quantile mapping makes the maps depend on the date, not only on the discharges
+MONTHLY_QM_METHODS = ('month_tables', 'month_funcs')
+
+# Maps are stored as uint16 codes of the water fraction (0-100), with a quantization step of ~0.0015
+_NAN_CODE = 65535
+_WF_SCALE = 65534 / 100.
+
+
+def surface_paths(AOI_str, qm_method='tables'):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param qm_method: Quantile mapping engine the surface is evaluated with
+    :return: Paths to the maps of the response surface and to its manifest
+    """
+    prefix = 'AOI/'+AOI_str+'/RSM/wf_surface_'+qm_method
+    return prefix + '.npy', prefix + '.json'
+
+
+def surface_axes(ctx):
+    """
+    Modes driven by the same NWM site share one discharge axis of the surface
+
+    :param ctx: AOIContext of the AOI
+    :return: NWM site of each axis, and axis of each mode
+    """
+    mode_sites = ctx.nwm_sites.tolist()
+    sites = list(dict.fromkeys(mode_sites))
+    return sites, [sites.index(site) for site in mode_sites]
+
+
+def surface_source_paths(AOI_str, qm_method, ctx):
+    """
+    :return: Files the maps of the response surface are computed from
+    """
+    qm_scaling_path = 'AOI/'+AOI_str+'/for_qm_scaling/'
+    sources = ['AOI/'+AOI_str+'/RSM/SM_hydro_App.nc', 'AOI/'+AOI_str+'/RSM/JRC_perm_water.nc',
+               qm_scaling_path+'qm_spr_r_mask.nc']
+    for site, mode in zip(ctx.hydro_sites, ctx.modes):
+        sources.append(tpc_model_path(AOI_str, site, mode))
+    if qm_method=='funcs':
+        sources += [qm_scaling_path+'wf2quant_funcs.npy', qm_scaling_path+'quant2wf_funcs.npy']
+    else:
+        sources += qm_source_paths(qm_scaling_path)
+    return sources
+
+
+def _encode_wf(wf):
+    wf = np.asarray(wf)
+    code = np.rint(np.clip(np.nan_to_num(wf), 0, 100) * _WF_SCALE).astype(np.uint16)
+    code[np.isnan(wf)] = _NAN_CODE
+    return code
+
+
+def _decode_wf(code):
+    wf = code.astype(np.float32) / np.float32(_WF_SCALE)
+    wf[code == _NAN_CODE] = np.nan
+    return wf
+
+
+def map_errors(a, b, error_quantile=1.):
+    """
+    :param a: Water fraction maps (time x lat x lon)
+    :param b: Reference water fraction maps (time x lat x lon)
+    :param error_quantile: Quantile of the absolute pixel errors reported for each map (default: 1, the maximum)
+    :return: Error of each map, ignoring NaN pixels
+    """
+    diff = np.abs(np.asarray(a, dtype=np.float64) - b).reshape(len(a), -1)
+    diff[np.isnan(diff)] = 0
+    if not diff.size:
+        return np.zeros(len(diff))
+    return diff.max(axis=1) if error_quantile >= 1 else np.quantile(diff, error_quantile, axis=1)
+
+
+def build_response_surface(wf_func, q_ranges, tol=1., n_init=9, max_points=65, batch=64, error_quantile=1.):
+    """
+    Tabulates a discharge-to-water-fraction function on a tensor grid of discharges, log-spaced per axis and
+    refined adaptively: every grid interval whose midpoint map differs from the linear interpolation of its end
+    maps by more than tol is split, until all intervals pass or an axis holds max_points nodes. Quantile mapping
+    jumps where a pixel's historical quantiles are tied (e.g. at 0 or 100), so a few pixels may never pass; the
+    error can be measured on a quantile of the pixels instead of their maximum
+
+    :param wf_func: Function mapping discharges (point x axis) to water fraction maps (point x lat x lon)
+    :param q_ranges: (min, max) discharge of each axis
+    :param tol: Error bound in water fraction percent
+    :param n_init: Number of nodes of each axis before refinement
+    :param max_points: Maximum number of nodes of each axis
+    :param batch: Number of maps computed per call of wf_func
+    :param error_quantile: Quantile of the absolute pixel errors compared with tol (default: 1, the maximum)
+    :return: Dictionary with the nodes of each axis, the uint16 coded maps (node_1 x ... x node_k x lat x lon),
+             the midpoint error of each interval of each axis and its maximum, and the number of maps computed
+    """
+    axes = [np.expm1(np.linspace(np.log1p(lo), np.log1p(hi), n_init)) for lo, hi in q_ranges]
+    cache = {}
+
+    def evaluate(points):
+        missing = list(dict.fromkeys(tuple(p) for p in points.tolist() if tuple(p) not in cache))
+        for ct in range(0, len(missing), batch):
+            maps = wf_func(np.array(missing[ct:ct + batch], dtype=np.float64))
+            for point, wf in zip(missing[ct:ct + batch], maps):
+                cache[point] = _encode_wf(wf)
+        return np.stack([_decode_wf(cache[tuple(p)]) for p in points.tolist()])
+
+    def grid_points(grid_axes):
+        return np.stack(np.meshgrid(*grid_axes, indexing='ij'), axis=-1).reshape(-1, len(grid_axes))
+
+    while True:
+        interval_errors = []
+        refined = False
+        for ct_axis, axis in enumerate(axes):
+            if len(axis) < 2:
+                interval_errors.append(np.zeros(0))
+                continue
+            mids = (axis[:-1] + axis[1:]) / 2
+            lo_axes, hi_axes, mid_axes = list(axes), list(axes), list(axes)
+            lo_axes[ct_axis], hi_axes[ct_axis], mid_axes[ct_axis] = axis[:-1], axis[1:], mids
+
+            # The nodes are log-spaced, so the midpoint in discharge is exactly halfway for the linear interpolation
+            err = map_errors(evaluate(grid_points(mid_axes)),
+                             (evaluate(grid_points(lo_axes)) + evaluate(grid_points(hi_axes))) / 2, error_quantile)
+            err = np.moveaxis(err.reshape([len(a) for a in mid_axes]), ct_axis, 0)
+            err = err.reshape(len(mids), -1).max(axis=1)
+
+            split = np.flatnonzero(err > tol)
+            budget = max_points - len(axis)
+            if len(split) > budget:
+                split = split[np.argsort(err[split])[::-1][:max(budget, 0)]]
+            if len(split):
+                axes[ct_axis] = np.sort(np.concatenate([axis, mids[split]]))
+                refined = True
+            interval_errors.append(err)
+        if not refined:
+            break
+
+    maps = np.stack([cache[tuple(p)] for p in grid_points(axes).tolist()])
+    maps = maps.reshape([len(axis) for axis in axes] + list(maps.shape[1:]))
+
+    return dict(axes=axes, maps=maps, interval_errors=interval_errors, n_maps=len(cache),
+                max_midpoint_error=max([float(err.max()) for err in interval_errors] + [0.]))
+
+
+def interp_response_surface(surface, q):
+    """
+    Multilinear interpolation of the water fraction maps on the response surface
+
+    :param surface: Dictionary with the nodes of each axis ('axes') and the coded maps ('maps')
+    :param q: Discharge of each axis (time x axis)
+    :return: Water fraction (time x lat x lon), or None when a discharge is outside the surface
+    """
+    axes = surface['axes']
+    maps = surface['maps']
+    q = np.asarray(q, dtype=np.float64).reshape(-1, len(axes))
+    if np.isnan(q).any() or any(((q[:, ct] < axis[0]) | (q[:, ct] > axis[-1])).any() for ct, axis in enumerate(axes)):
+        return None
+
+    idx, frac = [], []
+    for ct, axis in enumerate(axes):
+        i = np.clip(np.searchsorted(axis, q[:, ct], side='right') - 1, 0, len(axis) - 2)
+        idx.append(i)
+        frac.append((q[:, ct] - axis[i]) / (axis[i + 1] - axis[i]))
+
+    out = np.zeros((q.shape[0],) + maps.shape[len(axes):], dtype=np.float64)
+    for corner in itertools.product((0, 1), repeat=len(axes)):
+        weight = np.ones(q.shape[0])
+        for ct, c in enumerate(corner):
+            weight *= frac[ct] if c else 1 - frac[ct]
+        corner_maps = _decode_wf(maps[tuple(idx[ct] + c for ct, c in enumerate(corner))])
+        out += weight.reshape((-1,) + (1,) * (out.ndim - 1)) * corner_maps
+
+    return out
+
+
+def archive_q_ranges(AOI_str, sites, margin=1.5):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param sites: NWM site of each axis
+    :param margin: Factor applied to the largest archived discharge, to cover forecasts above the archive
+    :return: (0, margin x largest discharge) of each site over the archived and bias-corrected NWM forecasts
+    """
+    q_ranges = []
+    indexes = [archive_index(AOI_str, in_run_type) for in_run_type in ('archive', 'biascorrection')]
+    for site in sites:
+        q_max = max(float(np.nanmax(index.site_values(site))) for index in indexes)
+        q_ranges.append((0., q_max * margin))
+    return q_ranges
+
+
+def build_wf_surface(AOI_str, qm_method='tables', tol=1., n_init=9, max_points=65, q_ranges=None,
+                     synth_dtype=np.float64, error_quantile=1.):
+    """
+    Evaluates the full FIER pipeline (TPC models, synthesis, quantile mapping and permanent water) of an AOI on a
+    discharge grid per NWM site, and stores the maps with a manifest of the source files
+
+    :param AOI_str: Area-Of-Interest
+    :param qm_method: Quantile mapping engine, see run_fier_batch; the monthly engines depend on the date and are
+                      not supported
+    :param tol: Error bound in water fraction percent, see build_response_surface
+    :param n_init: Number of nodes of each axis before refinement
+    :param max_points: Maximum number of nodes of each axis
+    :param q_ranges: (min, max) discharge of each NWM site (default: from the NWM archives, see archive_q_ranges)
+    :param synth_dtype: Data type of the water fraction synthesis from the spatial modes (default: float64)
+    :param error_quantile: Quantile of the absolute pixel errors compared with tol (default: 1, the maximum)
+    :return: Path to the maps of the response surface
+    """
+    from syn_noaa2 import discharge_to_wf
+
+    if qm_method in MONTHLY_QM_METHODS:
+        raise ValueError('The response surface does not support the monthly quantile mapping engine ' + qm_method)
+
+    ctx = get_aoi_context(AOI_str)
+    sites, mode_axis = surface_axes(ctx)
+    if q_ranges is None:
+        q_ranges = archive_q_ranges(AOI_str, sites)
+
+    def wf_func(q):
+        return discharge_to_wf(AOI_str, q[:, mode_axis], None, qm_method, synth_dtype, ctx)
+
+    st_time = time.time()
+    surface = build_response_surface(wf_func, q_ranges, tol, n_init, max_points, error_quantile=error_quantile)
+    sources = surface_source_paths(AOI_str, qm_method, ctx)
+    meta = dict(
+        qm_method=qm_method,
+        sites=sites,
+        mode_axis=mode_axis,
+        axes=[axis.tolist() for axis in surface['axes']],
+        interval_errors=[err.tolist() for err in surface['interval_errors']],
+        tol=tol,
+        error_quantile=error_quantile,
+        max_midpoint_error=surface['max_midpoint_error'],
+        n_maps=surface['n_maps'],
+        build_seconds=time.time() - st_time,
+        source_stats=_file_stats(sources),
+        source_hash=source_hash(sources, qm_method),
+    )
+
+    maps_path, meta_path = surface_paths(AOI_str, qm_method)
+    with _atomic_open(maps_path) as f:
+        np.save(f, surface['maps'])
+    with _atomic_open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    return maps_path
+
+
+_surfaces = {}
+_surfaces_lock = threading.Lock()
+
+
+def load_wf_surface(AOI_str, qm_method='tables'):
+    """
+    Loads the stored response surface of an AOI once per process (memory-mapped), checking it against its source
+    files: size and modification time first, the content hash only when they changed
+
+    :param AOI_str: Area-Of-Interest
+    :param qm_method: Quantile mapping engine the surface is evaluated with
+    :return: Dictionary with the manifest entries, the nodes of each axis ('axes') and the coded maps ('maps'), or
+             None when no up-to-date surface is stored
+    """
+    maps_path, meta_path = surface_paths(AOI_str, qm_method)
+    if not (os.path.exists(maps_path) and os.path.exists(meta_path)):
+        return None
+
+    with _surfaces_lock:
+        key = (AOI_str, qm_method)
+        meta_mtime = os.path.getmtime(meta_path)
+        surface = _surfaces.get(key)
+        if surface is None or surface['meta_mtime'] != meta_mtime:
+            with open(meta_path) as f:
+                surface = json.load(f)
+            surface['axes'] = [np.array(axis) for axis in surface['axes']]
+            surface['maps'] = np.load(maps_path, mmap_mode='r')
+            surface['meta_mtime'] = meta_mtime
+            surface['sources'] = surface_source_paths(AOI_str, qm_method, get_aoi_context(AOI_str))
+            _surfaces[key] = surface
+
+        stats = _file_stats(surface['sources'])
+        if stats != surface['source_stats']:
+            if source_hash(surface['sources'], qm_method) != surface['source_hash']:
+                return None
+            surface['source_stats'] = stats
+
+    return surface
+
+
+def surface_wf(AOI_str, qm_method, fct_q):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param qm_method: Quantile mapping engine
+    :param fct_q: Discharge at the site of each mode (time x mode)
+    :return: Water fraction interpolated on the stored response surface (time x lat x lon), or None when no
+             up-to-date surface is stored, or the discharges fall outside of it or in an interval above its error
+             bound
+    """
+    if qm_method in MONTHLY_QM_METHODS:
+        return None
+    surface = load_wf_surface(AOI_str, qm_method)
+    if surface is None:
+        return None
+
+    fct_q = np.asarray(fct_q, dtype=np.float64)
+    mode_axis = np.array(surface['mode_axis'])
+    first_mode = [int(np.flatnonzero(mode_axis == ct)[0]) for ct in range(len(surface['axes']))]
+    q = fct_q[:, first_mode]
+    if not np.array_equal(q[:, mode_axis], fct_q, equal_nan=True):
+        return None
+
+    # Intervals left above the error bound when the refinement ran out of nodes are computed directly
+    for ct, (axis, err) in enumerate(zip(surface['axes'], surface['interval_errors'])):
+        i = np.clip(np.searchsorted(axis, q[:, ct], side='right') - 1, 0, len(axis) - 2)
+        if len(err) and (np.asarray(err)[i] > surface['tol']).any():
+            return None
+
+    return interp_response_surface(surface, q)
+
+
+def validate_wf_surface(AOI_str, qm_method='tables', dois=None, in_run_type='archive', n_dates=50):
+    """
+    Compares the maps interpolated on the stored response surface with the maps computed directly, for archived
+    forecasts, and writes the report next to the surface
+
+    :param AOI_str: Area-Of-Interest
+    :param qm_method: Quantile mapping engine
+    :param dois: Dates-Of-Interest (default: n_dates dates evenly spread over the NWM archive)
+    :param in_run_type: 'archive' or 'biascorrection', the archive the discharges are read from
+    :param n_dates: Number of dates when dois is not given
+    :return: Dictionary of the errors (water fraction percent) and timings; max_map_error is the largest error of a
+             map measured like the error bound of the surface (see map_errors), within_tol compares it with the bound
+    """
+    from syn_noaa2 import discharge_to_wf
+
+    surface = load_wf_surface(AOI_str, qm_method)
+    if surface is None:
+        raise FileNotFoundError('No up-to-date response surface for ' + AOI_str + ' (' + qm_method + ')')
+
+    ctx = get_aoi_context(AOI_str)
+    if dois is None:
+        times = ctx.archive_times(in_run_type)
+        dois = times[np.linspace(0, len(times) - 1, min(n_dates, len(times))).astype(int)]
+    dois = pd.to_datetime(np.atleast_1d(dois))
+    fct_q = np.stack([ctx.archive_discharge(in_run_type, site, dois) for site in ctx.nwm_sites], axis=1)
+
+    st_time = time.time()
+    direct = discharge_to_wf(AOI_str, fct_q, dois, qm_method, np.float64, ctx)
+    direct_time = time.time() - st_time
+
+    st_time = time.time()
+    surf = [surface_wf(AOI_str, qm_method, fct_q[ct:ct + 1]) for ct in range(len(dois))]
+    surface_time = time.time() - st_time
+
+    covered = np.array([wf is not None for wf in surf])
+    report = dict(AOI=AOI_str, qm_method=qm_method, in_run_type=in_run_type, tol=surface['tol'],
+                  n_dates=len(dois), n_covered=int(covered.sum()),
+                  direct_seconds_per_map=direct_time / len(dois), surface_seconds_per_map=surface_time / len(dois))
+    if covered.any():
+        surf = np.concatenate([wf for wf in surf if wf is not None])
+        map_err = map_errors(surf, direct[covered], surface['error_quantile'])
+        err = np.abs(surf - direct[covered])
+        err = err[~np.isnan(err)]
+        report.update(max_abs_error=float(err.max()), mean_abs_error=float(err.mean()),
+                      p99_abs_error=float(np.percentile(err, 99)),
+                      frac_pixels_over_tol=float((err > surface['tol']).mean()),
+                      max_map_error=float(map_err.max()), within_tol=bool(map_err.max() <= surface['tol']))
+
+    with _atomic_open(surface_paths(AOI_str, qm_method)[1].replace('.json', '_validation.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+
+    return report
+
+
+if __name__ == '__main__':
+    # Offline build and validation of the response surfaces, e.g. "python response_surface.py RedRiver"
+    for AOI_str in sys.argv[1:]:
+        print(build_wf_surface(AOI_str))
+        print(json.dumps(validate_wf_surface(AOI_str), indent=1))
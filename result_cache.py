@@ -0,0 +1,243 @@
+import os
+import io
+import json
+import shutil
+import fnmatch
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from qm_tools import _atomic_open
+
+# Artifacts derived from the AOI assets (see .gitignore); rebuilding them does not change the results
+_DERIVED_PATTERNS = ('qm_*.npy', 'qm_*.json', '*_funcs_knots.npy', '*_funcs_knots.json', '*_funcs_meta.npz',
+                     'qm_sketch.npz', 'wf_surface_*', '*.npz', '*.tmp')
+
+
+def aoi_source_files(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Source files of the AOI (spatial modes, masks, models, historical stacks, NWM archives, ...)
+    """
+    paths = []
+    for root, dirs, files in os.walk('AOI/'+AOI_str):
+        # The Zarr stores and the NWM archive indexes are built from the NetCDF assets
+        dirs[:] = sorted(name for name in dirs if name != 'zarr' and not name.endswith('.idx'))
+        for name in sorted(files):
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in _DERIVED_PATTERNS):
+                paths.append(os.path.join(root, name))
+    if AOI_str=='MississippiRiver':
+        paths.append('medium_lt08_tot.nc')
+    return paths
+
+
+def aoi_fingerprint(AOI_str):
+    """
+    :param AOI_str: Area-Of-Interest
+    :return: Digest of the size and modification time of the source files of the AOI
+    """
+    stats = [[p, os.path.getsize(p), os.path.getmtime(p)] for p in aoi_source_files(AOI_str) if os.path.exists(p)]
+    return hashlib.sha256(json.dumps(stats).encode()).hexdigest()[:16]
+
+
+def result_key(AOI_str, doi, in_run_type, in_run_type2, fct_q, **options):
+    """
+    Live NWM requests returning an unchanged forecast resolve to the same discharges, hence the same key
+
+    :param AOI_str: Area-Of-Interest
+    :param doi: Date-Of-Interest
+    :param in_run_type: Forecasting run type
+    :param in_run_type2: Forecasting run type, distinguishing the bias-corrected medium range forecast
+    :param fct_q: Resolved discharge at the site of each mode
+    :param options: Other options the result depends on (quantile mapping engine, data type, ...)
+    :return: Hex digest identifying the result
+    """
+    digest = hashlib.sha256(json.dumps([AOI_str, str(doi), in_run_type, in_run_type2,
+                                        sorted((k, str(v)) for k, v in options.items())]).encode())
+    fct_q = np.ascontiguousarray(fct_q, dtype=np.float64)
+    digest.update(str(fct_q.shape).encode())
+    digest.update(fct_q.tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache of the run_fier results (water fraction and rendered PNG): an in-memory LRU of max_entries
+    results in front of a directory holding at most max_disk_bytes, least recently used first out
+
+    Entries are stored under the fingerprint of the AOI assets, so any change to them invalidates the results of
+    that AOI; the stale ones are dropped from both tiers on the next access.
+    """
+
+    def __init__(self, cache_dir='Output/cache', max_entries=32, max_disk_bytes=2**30):
+        """
+        :param cache_dir: Directory of the disk tier (None for memory only)
+        :param max_entries: Number of results held in memory
+        :param max_disk_bytes: Size cap in bytes of the disk tier (default: 1 GiB)
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.RLock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.
+
+    def _entry_path(self, AOI_str, fingerprint, key):
+        return os.path.join(self.cache_dir, AOI_str, fingerprint, key)
+
+    def _check_fingerprint(self, AOI_str, fingerprint):
+        if self._fingerprints.get(AOI_str) == fingerprint:
+            return
+        self._fingerprints[AOI_str] = fingerprint
+        for key in [key for key in self._memory if key[0] == AOI_str and key[1] != fingerprint]:
+            del self._memory[key]
+        aoi_dir = os.path.join(self.cache_dir, AOI_str) if self.cache_dir else None
+        if aoi_dir and os.path.isdir(aoi_dir):
+            for name in os.listdir(aoi_dir):
+                if name != fingerprint:
+                    shutil.rmtree(os.path.join(aoi_dir, name), ignore_errors=True)
+
+    def get(self, AOI_str, key):
+        """
+        :param AOI_str: Area-Of-Interest
+        :param key: Key of the result, see result_key
+        :return: Dictionary of the water fraction ('wf'), PNG bytes ('png', None when not rendered), bounds and
+                 compute time ('seconds'), or None on a miss
+        """
+        fingerprint = aoi_fingerprint(AOI_str)
+        with self._lock:
+            self._check_fingerprint(AOI_str, fingerprint)
+            entry = self._memory.get((AOI_str, fingerprint, key))
+            if entry is not None:
+                self._memory.move_to_end((AOI_str, fingerprint, key))
+                self.memory_hits += 1
+                self.saved_seconds += entry['seconds']
+                return entry
+
+        entry = self._read_disk(AOI_str, fingerprint, key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.saved_seconds += entry['seconds']
+            self._remember((AOI_str, fingerprint, key), entry)
+        return entry
+
+    def put(self, AOI_str, key, wf, png, bounds, seconds):
+        """
+        :param AOI_str: Area-Of-Interest
+        :param key: Key of the result, see result_key
+        :param wf: Water fraction (time x lat x lon)
+        :param png: Rendered PNG bytes (None when the result is only shown as tiles)
+        :param bounds: Bounds of the AOI
+        :param seconds: Time taken to compute the result
+        :return: The stored entry
+        """
+        fingerprint = aoi_fingerprint(AOI_str)
+        entry = dict(wf=np.asarray(wf), png=png, bounds=bounds, seconds=float(seconds))
+        with self._lock:
+            self._check_fingerprint(AOI_str, fingerprint)
+            self._remember((AOI_str, fingerprint, key), entry)
+        try:
+            self._write_disk(AOI_str, fingerprint, key, entry)
+        except OSError:
+            # The result is still served from memory
+            pass
+        return entry
+
+    def _remember(self, full_key, entry):
+        self._memory[full_key] = entry
+        self._memory.move_to_end(full_key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, AOI_str, fingerprint, key):
+        if not self.cache_dir:
+            return None
+        path = self._entry_path(AOI_str, fingerprint, key)
+        try:
+            with np.load(path + '.npz') as arrays:
+                entry = dict(wf=arrays['wf'], bounds=arrays['bounds'].tolist(), seconds=float(arrays['seconds']))
+        except (OSError, KeyError, ValueError):
+            return None
+        try:
+            with open(path + '.png', 'rb') as f:
+                entry['png'] = f.read()
+            os.utime(path + '.png')
+        except OSError:
+            entry['png'] = None
+        # Refresh the modification time, which orders the disk tier for eviction
+        os.utime(path + '.npz')
+        return entry
+
+    def _write_disk(self, AOI_str, fingerprint, key, entry):
+        if not self.cache_dir:
+            return
+        path = self._entry_path(AOI_str, fingerprint, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, wf=entry['wf'], bounds=np.asarray(entry['bounds'], dtype=np.float64),
+                            seconds=entry['seconds'])
+        for ext, data in (('.png', entry['png']), ('.npz', buffer.getvalue())):
+            if data is not None:
+                with _atomic_open(path + ext) as f:
+                    f.write(data)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    files.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except OSError:
+                    continue
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Drops every result of both tiers and resets the counters
+        """
+        with self._lock:
+            self._memory.clear()
+            self._fingerprints.clear()
+            if self.cache_dir:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.memory_hits = self.disk_hits = self.misses = 0
+            self.saved_seconds = 0.
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss counters per tier, hit ratio, compute time saved by the hits and number of
+                 results held in memory
+        """
+        with self._lock:
+            requests = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / requests if requests else 0.,
+                'saved_seconds': self.saved_seconds,
+                'memory_entries': len(self._memory),
+            }
+
+
+# Shared by all sessions of the process
+result_cache = ResultCache()
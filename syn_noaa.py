@@ -17,6 +17,9 @@ import pandas as pd
 from scipy import interpolate
 import time
 
+from qm_tools import perf_qm_vectorized, perf_qm_tables, perf_qm_month_tables, perf_qm_arrays, perf_qm_ecdf, \
+    perf_qm_sketch_tables
+
 
 def perf_qm_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100):
     """
@@ -50,7 +53,7 @@ def perf_qm_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_ma
     return fct_syn_wf_stack
 
 
-def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100):
+def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100, fct_dates=None):
     """
     :param hist_real_wf_stack: Historical real water fraction as reference to get the scales
     :param hist_syn_wf_stack: Historical synthesized water fraction to get the scales
@@ -58,6 +61,7 @@ def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack,
     :param qm_mask: Mask of where quantile scaling will be performed, based on the pre-generated correlation between
                     historical observed and synthesized water fractions (Default is Spearman's correlation)
     :param nbins: Number of bins to get the quantile (default: 100)
+    :param fct_dates: Date of each forecast step, required when fct_syn_wf_stack is a plain array without time
     :return: Quantile-scaled forecasted synthesized water fraction
     """
     binmid = np.arange(0, 1. + 1. / nbins, 1. / nbins)
@@ -66,8 +70,9 @@ def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack,
     syn = hist_syn_wf_stack.values
     hist_mon = pd.to_datetime(hist_real_wf_stack.time.values).month
 
-    fct_time = fct_syn_wf_stack.time
-    fct_mon = pd.to_datetime(fct_syn_wf_stack.time.values).month
+    if fct_dates is None:
+        fct_dates = fct_syn_wf_stack.time.values
+    fct_mon = pd.to_datetime(np.atleast_1d(fct_dates)).month
     uniq_fct_mon = np.unique(fct_mon)
 
     for uniq_mon in uniq_fct_mon:
@@ -181,13 +186,21 @@ def perf_qm_mon(fct_syn_wf_stack, fct_date, qm_scaling_path, qm_mask):
 
     return fct_syn_wf_stack
 
-def run_fier(AOI_str, doi, in_run_type):
+def run_fier(AOI_str, doi, in_run_type, qm_method='tables'):
     """
     This function read the AOI, DOI, forecasting run type to synthesized forecasted water fraction
 
     :param AOI_str: Area-Of-Interest
     :param doi: Date-Of-Interest
     :param in_run_type: Forecasting run type
+    :param qm_method: Quantile mapping engine, 'tables' (stored quantile tables, rebuilt when the historical stacks
+                      change), 'vectorized' (batched over all masked pixels) or 'quick' (per-pixel loop of
+                      perf_qm_quick); all give the same output. 'month_tables' scales with the stored
+                      climatological (monthly) tables instead, like perf_qm_month_quick. 'funcs' and 'month_funcs'
+                      use the array-converted pre-fitted interpolators of perf_qm and perf_qm_mon. 'ecdf' matches
+                      the exact empirical CDFs of the stored sorted histories instead of 100 quantile bins. 'sketch'
+                      uses the approximate tables emitted from the incrementally updated sketches (see
+                      update_qm_sketch_tables)
 
     :return: Synthesized forecasted water fraction
     """
@@ -208,8 +221,6 @@ def run_fier(AOI_str, doi, in_run_type):
 
     # Read neccessary data
     xr_RSM = xr.load_dataset(RSM_path)
-    hist_obs_wf = xr.load_dataarray(hist_real_stack_path, decode_coords='all')
-    hist_syn_wf = xr.load_dataarray(hist_syn_stack_path, decode_coords='all')
     jrc_perm_water = xr.load_dataarray(jrc_perm_water_path, decode_coords='all')
     #qm_mask = xr.load_dataarray(qm_pr_r_mask_path)
     qm_mask = xr.load_dataarray(qm_spr_r_mask_path)
@@ -262,7 +273,25 @@ def run_fier(AOI_str, doi, in_run_type):
     fct_syn_wf = fct_syn_wf + wf_mean
 
     st_time=time.time()
-    map_fct_syn_wf = perf_qm_quick(hist_obs_wf, hist_syn_wf, fct_syn_wf, qm_mask)
+    if qm_method=='tables':
+        map_fct_syn_wf = perf_qm_tables(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='month_tables':
+        map_fct_syn_wf = perf_qm_month_tables(fct_syn_wf, [doi], qm_scaling_path, qm_mask)
+    elif qm_method=='ecdf':
+        map_fct_syn_wf = perf_qm_ecdf(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='sketch':
+        map_fct_syn_wf = perf_qm_sketch_tables(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='funcs':
+        map_fct_syn_wf = perf_qm_arrays(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='month_funcs':
+        map_fct_syn_wf = perf_qm_arrays(fct_syn_wf, qm_scaling_path, qm_mask, doi)
+    else:
+        hist_obs_wf = xr.load_dataarray(hist_real_stack_path, decode_coords='all')
+        hist_syn_wf = xr.load_dataarray(hist_syn_stack_path, decode_coords='all')
+        if qm_method=='vectorized':
+            map_fct_syn_wf = perf_qm_vectorized(hist_obs_wf, hist_syn_wf, fct_syn_wf, qm_mask)
+        else:
+            map_fct_syn_wf = perf_qm_quick(hist_obs_wf, hist_syn_wf, fct_syn_wf, qm_mask)
     #map_fct_syn_wf = perf_qm(fct_syn_wf, qm_scaling_path, qm_mask)
     #map_fct_syn_wf = perf_qm_mon(fct_syn_wf, doi, qm_scaling_path, qm_mask)
     #map_fct_syn_wf = fct_syn_wf
@@ -1,18 +1,21 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-from tensorflow.keras import models
 #import tensorflow.keras as keras
 #import tensorflow.compat.v1 as tf
 
 #tf.compat.v1.disable_v2_behavior()
 import pickle
 
-import tensorflow as tf
+# TensorFlow is only needed for models the NumPy engine of tpc_models cannot run
+try:
+    import tensorflow as tf
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+except ImportError:
+    tf = None
 import streamlit as st
 #import tensorflow.compat.v1 as tf
 #tf.disable_v2_behavior()
 #tf.compat.v1.disable_v2_behavior
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 import xarray as xr
 import matplotlib.pyplot as plt
@@ -29,6 +32,21 @@ from scipy import interpolate
 from scipy.interpolate import interp1d
 import time
 
+from aoi_context import get_aoi_context
+from aoi_store import open_aoi_dataarray
+from nwm_index import archive_index
+from nwm_cache import forecast_cache
+from nwm_forecast import daily_discharge
+from bias_correction import get_bias_correction
+from tpc_models import model_registry, predict_modes
+from response_surface import surface_wf
+from result_cache import result_cache, result_key
+from wf_render import render_wf_png
+from wf_tiles import TILE_ROOT, prune_tile_pyramids, read_tile_pyramid, tile_url, write_tile_pyramid
+from wf_warp import get_warp_index
+from qm_tools import perf_qm_vectorized, perf_qm_tables, perf_qm_month_tables, perf_qm_arrays, perf_qm_ecdf, \
+    perf_qm_sketch_tables
+
 
 def perf_qm_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100):
     """
@@ -62,7 +80,7 @@ def perf_qm_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_ma
     return fct_syn_wf_stack
 
 
-def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100):
+def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack, qm_mask, nbins=100, fct_dates=None):
     """
     :param hist_real_wf_stack: Historical real water fraction as reference to get the scales
     :param hist_syn_wf_stack: Historical synthesized water fraction to get the scales
@@ -70,6 +88,7 @@ def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack,
     :param qm_mask: Mask of where quantile scaling will be performed, based on the pre-generated correlation between
                     historical observed and synthesized water fractions (Default is Spearman's correlation)
     :param nbins: Number of bins to get the quantile (default: 100)
+    :param fct_dates: Date of each forecast step, required when fct_syn_wf_stack is a plain array without time
     :return: Quantile-scaled forecasted synthesized water fraction
     """
     binmid = np.arange(0, 1. + 1. / nbins, 1. / nbins)
@@ -78,8 +97,9 @@ def perf_qm_month_quick(hist_real_wf_stack, hist_syn_wf_stack, fct_syn_wf_stack,
     syn = hist_syn_wf_stack.values
     hist_mon = pd.to_datetime(hist_real_wf_stack.time.values).month
 
-    fct_time = fct_syn_wf_stack.time
-    fct_mon = pd.to_datetime(fct_syn_wf_stack.time.values).month
+    if fct_dates is None:
+        fct_dates = fct_syn_wf_stack.time.values
+    fct_mon = pd.to_datetime(np.atleast_1d(fct_dates)).month
     uniq_fct_mon = np.unique(fct_mon)
 
     for uniq_mon in uniq_fct_mon:
@@ -193,152 +213,246 @@ def perf_qm_mon(fct_syn_wf_stack, fct_date, qm_scaling_path, qm_mask):
 
     return fct_syn_wf_stack
 
-def run_fier(AOI_str, doi, in_run_type, in_run_type2):
+def synthesize_wf(est_tpc, sm_matrix, wf_mean, dtype=np.float64):
     """
-    This function read the AOI, DOI, forecasting run type to synthesized forecasted water fraction
+    Synthesizes water fraction as the weighted sum of spatial modes, (time x mode) @ (mode x pixel) + temporal mean,
+    in one matrix product instead of building full-size cubes per mode
+
+    :param est_tpc: Estimated temporal principal components (time x mode)
+    :param sm_matrix: Spatial modes (mode x pixel), see stack_spatial_modes
+    :param wf_mean: Temporal mean water fraction (lat x lon)
+    :param dtype: Data type of the computation; float32 halves the memory traffic (default: float64)
+    :return: Synthesized water fraction (time x lat x lon)
+    """
+    est_tpc = np.asarray(est_tpc, dtype=dtype).reshape(-1, sm_matrix.shape[0])
+    fct_syn_wf = est_tpc @ np.asarray(sm_matrix, dtype=dtype)
+    fct_syn_wf += np.asarray(wf_mean, dtype=dtype).reshape(1, -1)
 
-    :param AOI_str: Area-Of-Interest
-    :param doi: Date-Of-Interest
-    :param in_run_type: Forecasting run type
+    return fct_syn_wf.reshape((est_tpc.shape[0],) + np.shape(wf_mean))
 
-    :return: Synthesized forecasted water fraction
+
+def discharge_to_wf(AOI_str, fct_q, dois=None, qm_method='tables', synth_dtype=np.float64, ctx=None):
+    """
+    This function runs the deterministic part of FIER, from the discharges to the water fraction maps: TPC models,
+    synthesis from the spatial modes, quantile mapping and permanent water overlay
+
+    :param AOI_str: Area-Of-Interest
+    :param fct_q: Discharge at the site of each mode (time x mode); with fewer columns than modes, only the first
+                  modes contribute
+    :param dois: Date of each row of fct_q, needed by the monthly quantile mapping engines
+    :param qm_method: Quantile mapping engine, see run_fier_batch
+    :param synth_dtype: Data type of the water fraction synthesis from the spatial modes (default: float64)
+    :param ctx: AOIContext of the AOI (default: None, the shared context from get_aoi_context)
+
+    :return: Synthesized forecasted water fraction (time x lat x lon)
     """
-    # Path to read neccessary data
-    TF_model_path = 'AOI/'+AOI_str+'/TF_model/'
     qm_scaling_path = 'AOI/'+AOI_str+'/for_qm_scaling/'
 
-    hist_real_stack_path = qm_scaling_path+'hist_real_wf_trim.nc'
-    hist_syn_stack_path = qm_scaling_path+'hist_syn_wf_trim.nc'
-
-    RSM_path = 'AOI/'+AOI_str+'/RSM/SM_hydro_App.nc'
-    jrc_perm_water_path = 'AOI/'+AOI_str+'/RSM/JRC_perm_water.nc'
-    qm_pr_r_mask_path = qm_scaling_path+'qm_pr_r_mask.nc'
-    qm_spr_r_mask_path = qm_scaling_path+'qm_spr_r_mask.nc'
-
-    # Path to archived NWM forecast
-    model_path = 'AOI/'+AOI_str+'/nwm_archive/'
-    nwm_archive_path = 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc'
-    
-    if AOI_str=='MississippiRiver':
-        nwm_archive_path = 'medium_lt08_tot.nc'
-        nwm_archive = xr.load_dataarray(nwm_archive_path)
-        nwm_bias_corrected_archive_path = 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App_biascorrected.nc'
-        nwm_bias_corrected_archive = xr.load_dataarray(nwm_bias_corrected_archive_path)
-    elif AOI_str=='RedRiver': 
-        nwm_archive = xr.load_dataarray(nwm_archive_path, engine = 'h5netcdf')
-        nwm_bias_corrected_archive_path = 'AOI/'+AOI_str+'/nwm_archive/medium_lt08_App.nc'
-        nwm_bias_corrected_archive = xr.load_dataarray(nwm_bias_corrected_archive_path, engine = 'h5netcdf')
-    # Read neccessary data
-    xr_RSM = xr.load_dataset(RSM_path, engine = 'h5netcdf')
-    hist_obs_wf = xr.load_dataarray(hist_real_stack_path, decode_coords='all', engine = 'h5netcdf')
-    hist_syn_wf = xr.load_dataarray(hist_syn_stack_path, decode_coords='all', engine = 'h5netcdf')
-    jrc_perm_water = xr.load_dataarray(jrc_perm_water_path, decode_coords='all', engine = 'h5netcdf')
-    #qm_mask = xr.load_dataarray(qm_pr_r_mask_path, engine = 'h5netcdf')
-    qm_mask = xr.load_dataarray(qm_spr_r_mask_path, engine = 'h5netcdf')
-
-    
-
-    wf_mean = xr_RSM.temporal_mean.values
-    for ct_mode in range(xr_RSM.sizes['mode']):
-
-        mode = xr_RSM.spatial_modes.mode[ct_mode].values
-
-        sm = xr_RSM.spatial_modes.sel(mode=mode)
-        site = xr_RSM.hydro_site.sel(mode=mode).values
-        nwm_site = xr_RSM.nwm_site.sel(mode=mode).values
-        RTPC_std = xr_RSM.model_RTPC_std_sel.sel(mode=mode).values
-        RTPC_mean = xr_RSM.model_RTPC_mean_sel.sel(mode=mode).values
-            
-        if in_run_type=='archive':
-            doi_fct_q = nwm_archive.sel(site=nwm_site).sel(time=pd.to_datetime(doi)).values
-        elif in_run_type=='biascorrection':
-            doi_fct_q = nwm_bias_corrected_archive.sel(site=nwm_site).sel(time=pd.to_datetime(doi)).values
-        else:        
-
-            ssl._create_default_https_context = ssl._create_stdlib_context
-           
-            webURL = urllib.request.urlopen('https://nwmdata.nohrsc.noaa.gov/latest/forecasts/'+in_run_type+'/streamflow?&station_id='+str(nwm_site))
-            data = webURL.read()
-            encoding = webURL.info().get_content_charset('utf-8')
-            JSON_object = json.loads(data.decode(encoding))
-            
-            fct_datetime = pd.to_datetime(pd.DataFrame(JSON_object[0]["data"])["forecast-time"])
-            doi_indx0 = fct_datetime >= (dt.datetime.strptime(doi,'%Y-%m-%d'))
-            doi_indx1 = (fct_datetime < (dt.datetime.strptime(doi,'%Y-%m-%d'))+dt.timedelta(days=1))
-            doi_indx = doi_indx0 & doi_indx1
-        
-            doi_fct_datetime = fct_datetime[doi_indx]
-            doi_fct_q = (pd.DataFrame(JSON_object[0]["data"])['value'][doi_indx]*0.0283168).mean()
-            if in_run_type2=='medium_range_ensemble_mean_bias_corrected':
-                try: 
-                    with open(model_path + 'interpolated_function'+str(nwm_site) + '.pkl', 'rb') as file:
-                        bc_model = pickle.load(file)
-                    doi_fct_q = bc_model (doi_fct_q)
-                except:
-                    st.write("This option is not available for Red River")
-                    break
-
-        #model_directory = r'AOI/MississippiRiver/TF_model/site-07024175_tpc01'
-        model_directory = TF_model_path+'site-'+str(site)+'_tpc'+str(mode).zfill(2)
-        
-        #try:
-            #with tf.Session(graph=tf.Graph()) as sess:
-                #tf.saved_model.loader.load(sess, [tf.saved_model.SERVING], model_directory)
-                #print("Model loaded successfully in TensorFlow 1.x compatibility mode.")
-        
-        #except Exception as e:
-            #print(f"Error loading model: {e}")
-        
-        in_model = models.load_model(TF_model_path+'site-'+str(site)+'_tpc'+str(mode).zfill(2)+'.h5')
-        #in_model = tf.saved_model.load(model_directory, export_dir = model_directory)
-        in_good_hydro = doi_fct_q
-        tf_good_hydro = tf.data.Dataset.from_tensors(in_good_hydro)
-        est_tpc = in_model.predict(tf_good_hydro)*RTPC_std+RTPC_mean
-
-        est_tpc1 = np.tile(est_tpc[:, :, None], (1, sm.sizes['lat'], sm.sizes['lon']))
-        sm1 = np.tile(sm.values[None,:,:], (est_tpc.shape[0], 1, 1))
-    
-        syn_wf_temp = sm1*est_tpc1
-        if ct_mode==0:
-            fct_syn_wf = syn_wf_temp
-        else:
-            fct_syn_wf = fct_syn_wf + syn_wf_temp
-    fct_syn_wf = fct_syn_wf + wf_mean
+    if ctx is None:
+        ctx = get_aoi_context(AOI_str)
+    qm_mask = ctx.qm_mask
+
+    fct_q = np.asarray(fct_q, dtype=np.float32)
+    fct_q = fct_q.reshape(fct_q.shape[0], -1)
+    if dois is not None:
+        dois = pd.to_datetime(np.atleast_1d(dois))
+
+    n_modes = fct_q.shape[1]
+    in_models = [model_registry.get(AOI_str, site, mode)
+                 for site, mode in zip(ctx.hydro_sites[:n_modes], ctx.modes[:n_modes])]
+
+    # All modes are evaluated at once for the whole batch of dates
+    est_tpc = predict_modes(in_models, fct_q) if in_models else np.empty((fct_q.shape[0], 0))
+    est_tpc = est_tpc*ctx.rtpc_std[:n_modes]+ctx.rtpc_mean[:n_modes]
+    sm_matrix = ctx.spatial_modes(synth_dtype)[:n_modes]
+    fct_syn_wf = synthesize_wf(est_tpc, sm_matrix, ctx.wf_mean, synth_dtype)
 
     st_time=time.time()
-    map_fct_syn_wf = perf_qm_quick(hist_obs_wf, hist_syn_wf, fct_syn_wf, qm_mask)
+    if qm_method=='tables':
+        map_fct_syn_wf = perf_qm_tables(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='month_tables':
+        map_fct_syn_wf = perf_qm_month_tables(fct_syn_wf, dois, qm_scaling_path, qm_mask)
+    elif qm_method=='ecdf':
+        map_fct_syn_wf = perf_qm_ecdf(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='sketch':
+        map_fct_syn_wf = perf_qm_sketch_tables(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='funcs':
+        map_fct_syn_wf = perf_qm_arrays(fct_syn_wf, qm_scaling_path, qm_mask)
+    elif qm_method=='month_funcs':
+        map_fct_syn_wf = fct_syn_wf
+        for mon in np.unique(dois.month):
+            map_fct_syn_wf[dois.month==mon] = perf_qm_arrays(fct_syn_wf[dois.month==mon], qm_scaling_path, qm_mask,
+                                                             dois[dois.month==mon][0])
+    else:
+        with open_aoi_dataarray(AOI_str, 'hist_real_wf_trim') as hist_obs_wf, \
+                open_aoi_dataarray(AOI_str, 'hist_syn_wf_trim') as hist_syn_wf:
+            if qm_method=='vectorized':
+                map_fct_syn_wf = perf_qm_vectorized(hist_obs_wf, hist_syn_wf, fct_syn_wf, qm_mask)
+            else:
+                map_fct_syn_wf = perf_qm_quick(hist_obs_wf, hist_syn_wf, fct_syn_wf, xr.DataArray(qm_mask))
     #map_fct_syn_wf = perf_qm(fct_syn_wf, qm_scaling_path, qm_mask)
     #map_fct_syn_wf = perf_qm_mon(fct_syn_wf, doi, qm_scaling_path, qm_mask)
     #map_fct_syn_wf = fct_syn_wf
     ed_time=time.time()
     print(ed_time-st_time)
-    map_fct_syn_wf = np.where(jrc_perm_water==1, 100, map_fct_syn_wf)
 
-    # Create image
-    folder_name = 'Output'
-    if not os.path.exists(folder_name):
-        os.makedirs(folder_name)
+    return np.where(ctx.perm_water, 100, map_fct_syn_wf)
+
+
+def resolve_discharges(AOI_str, dois, in_run_type, in_run_type2, ctx=None):
+    """
+    This function gathers the forecasted discharge at the NWM site of each mode, from the archives or the live NWM
+    forecast (daily mean, in cms)
+
+    :param AOI_str: Area-Of-Interest
+    :param dois: Dates-Of-Interest
+    :param in_run_type: Forecasting run type
+    :param in_run_type2: Forecasting run type, distinguishing the bias-corrected medium range forecast
+    :param ctx: AOIContext of the AOI (default: None, the shared context from get_aoi_context)
+
+    :return: Discharge at the site of each mode (time x mode); sites without bias correction keep their
+             uncorrected forecast, and are reported
+    """
+    dois = pd.to_datetime(np.atleast_1d(dois))
+
+    if ctx is None:
+        ctx = get_aoi_context(AOI_str)
+
+    if in_run_type in ('archive', 'biascorrection'):
+        return np.stack([ctx.archive_discharge(in_run_type, nwm_site, dois) for nwm_site in ctx.nwm_sites], axis=1)
+
+    # Live forecasts of the unique sites, from the shared forecast cache (fetched concurrently when missing)
+    fct_series = forecast_cache.get_many(in_run_type, ctx.nwm_sites)
+
+    if in_run_type2=='medium_range_ensemble_mean_bias_corrected':
+        # Whole forecast horizons corrected at once, once per site, with the functions compiled for the AOI
+        bias_correction = get_bias_correction(AOI_str)
+        missing_sites = bias_correction.missing(ctx.nwm_sites)
+        if missing_sites:
+            st.write("Bias correction is not available for NWM site(s) " + ", ".join(map(str, missing_sites))
+                     + " of " + AOI_str + "; their uncorrected forecast is used")
+        for nwm_site, series in fct_series.items():
+            if nwm_site not in missing_sites:
+                fct_series[nwm_site] = series._replace(daily_q=bias_correction.apply(nwm_site, series.daily_q))
+
+    # Daily means of the whole horizon, computed once when the forecast was parsed
+    return np.stack([daily_discharge(fct_series[int(nwm_site)], dois) for nwm_site in ctx.nwm_sites], axis=1)
+
+
+def run_fier_batch(AOI_str, dois, in_run_type, in_run_type2, qm_method='tables', synth_dtype=np.float64,
+                   out_path=None, use_surface=False, fct_q=None):
+    """
+    This function runs FIER for many dates at once: the AOI data and the models are read once, the discharges of
+    all dates are gathered per site in one pass, each model predicts once on the whole discharge vector, and all
+    dates are synthesized and quantile-scaled together
+
+    :param AOI_str: Area-Of-Interest
+    :param dois: Dates-Of-Interest (list of 'YYYY-MM-DD' strings, dates or a pandas date range)
+    :param in_run_type: Forecasting run type
+    :param in_run_type2: Forecasting run type, distinguishing the bias-corrected medium range forecast
+    :param qm_method: Quantile mapping engine, 'tables' (stored quantile tables, rebuilt when the historical stacks
+                      change), 'vectorized' (batched over all masked pixels) or 'quick' (per-pixel loop of
+                      perf_qm_quick); all give the same output. 'month_tables' scales with the stored
+                      climatological (monthly) tables instead, like perf_qm_month_quick. 'funcs' and 'month_funcs'
+                      use the array-converted pre-fitted interpolators of perf_qm and perf_qm_mon. 'ecdf' matches
+                      the exact empirical CDFs of the stored sorted histories instead of 100 quantile bins. 'sketch'
+                      uses the approximate tables emitted from the incrementally updated sketches (see
+                      update_qm_sketch_tables)
+    :param synth_dtype: Data type of the water fraction synthesis from the spatial modes (default: float64)
+    :param out_path: Path of a NetCDF file to write the water fraction cube to (default: None, not written)
+    :param use_surface: Interpolate the maps on the precomputed discharge response surface of the AOI when one is
+                        stored for qm_method and covers the discharges (see response_surface.py); otherwise, or by
+                        default, the maps are computed directly
+    :param fct_q: Discharges already gathered by resolve_discharges (default: None, gathered here)
+
+    :return: Synthesized forecasted water fraction (time x lat x lon) and the bounds of the AOI
+    """
+    dois = pd.to_datetime(np.atleast_1d(dois))
+
+    # Static data of the AOI, loaded once per process
+    ctx = get_aoi_context(AOI_str)
 
-    fig = plt.figure()
-    plt.imshow(map_fct_syn_wf[0], cmap='jet', vmin=0, vmax=100,interpolation='none')
-    plt.axis('off')
-    plt.savefig(folder_name +'/water_fraction.png', bbox_inches='tight', dpi=600, pad_inches = 0)
-    plt.close()
+    if fct_q is None:
+        fct_q = resolve_discharges(AOI_str, dois, in_run_type, in_run_type2, ctx)
+    map_fct_syn_wf = None
+    if use_surface and fct_q.shape[1]==len(ctx.modes):
+        map_fct_syn_wf = surface_wf(AOI_str, qm_method, fct_q)
+    if map_fct_syn_wf is None:
+        map_fct_syn_wf = discharge_to_wf(AOI_str, fct_q, dois, qm_method, synth_dtype, ctx)
 
-    bounds = [[xr_RSM.lat.values.min(), xr_RSM.lon.values.min()],
-    [xr_RSM.lat.values.max(), xr_RSM.lon.values.max()]]
+    bounds = [list(corner) for corner in ctx.bounds]
 
     out_file = xr.DataArray(
             data = map_fct_syn_wf,
             coords = dict(
-                time=(["time"],[pd.to_datetime(doi)]),
-                lat=(["lat"],xr_RSM.lat.values),
-                lon=(["lon"],xr_RSM.lon.values)
+                time=(["time"],dois),
+                lat=(["lat"],ctx.lat),
+                lon=(["lon"],ctx.lon)
             )
         )
 
-    #out_file.to_netcdf(folder_name +'/'+in_run_type+'_'+doi+'.nc', engine = 'h5netcdf')
+    if out_path is not None:
+        out_file.to_netcdf(out_path, engine = 'h5netcdf')
 
-    xr_RSM.close()
+    return out_file, bounds
 
-    return bounds
+
+def run_fier(AOI_str, doi, in_run_type, in_run_type2, qm_method='tables', synth_dtype=np.float64, use_surface=False,
+             use_cache=True, tiles=False):
+    """
+    This function read the AOI, DOI, forecasting run type to synthesized forecasted water fraction
+
+    :param AOI_str: Area-Of-Interest
+    :param doi: Date-Of-Interest
+    :param in_run_type: Forecasting run type
+    :param qm_method: Quantile mapping engine, see run_fier_batch
+    :param synth_dtype: Data type of the water fraction synthesis from the spatial modes (default: float64)
+    :param use_surface: Interpolate on the precomputed discharge response surface when available, see run_fier_batch
+    :param use_cache: Reuse the result of an identical earlier request (same AOI assets, date, run types, options
+                      and resolved discharges) from result_cache
+    :param tiles: Cut the water fraction into an XYZ tile pyramid (see write_tile_pyramid) instead of rendering
+                  the image overlay Output/water_fraction.png
+
+    :return: Bounds of the water fraction map (written to Output/water_fraction.png unless tiles is set), and the
+             description of its tile pyramid with the URL template of the tiles ('url') when tiles is set
+    """
+    st_time = time.time()
+    fct_q = resolve_discharges(AOI_str, [doi], in_run_type, in_run_type2)
+
+    key = result_key(AOI_str, doi, in_run_type, in_run_type2, fct_q, qm_method=qm_method,
+                     synth_dtype=np.dtype(synth_dtype).name, use_surface=use_surface, renderer='lut-mercator')
+    entry = result_cache.get(AOI_str, key) if use_cache else None
+    if entry is None:
+        out_file, bounds = run_fier_batch(AOI_str, [doi], in_run_type, in_run_type2, qm_method, synth_dtype,
+                                          use_surface=use_surface, fct_q=fct_q)
+        entry = result_cache.put(AOI_str, key, out_file.values, None, bounds, time.time() - st_time)
+
+    if not tiles:
+        if entry['png'] is None:
+            # Reprojected to Web-Mercator, so the overlay is not stretched between its bounds
+            png = render_wf_png(get_warp_index(AOI_str).warp(entry['wf'][0]))
+            entry = result_cache.put(AOI_str, key, entry['wf'], png, entry['bounds'], entry['seconds'])
+
+        # Create image
+        folder_name = 'Output'
+        if not os.path.exists(folder_name):
+            os.makedirs(folder_name)
+
+        with open(folder_name +'/water_fraction.png', 'wb') as f:
+            f.write(entry['png'])
+
+        #out_file.to_netcdf(folder_name +'/'+in_run_type+'_'+doi+'.nc', engine = 'h5netcdf')
+
+        return entry['bounds']
+
+    # One pyramid per result, reused as long as the result is. The tiles are sampled in Web-Mercator themselves, so
+    # the warped image overlay is not rendered
+    tile_dir = TILE_ROOT + '/' + AOI_str + '/' + key[:32]
+    pyramid = read_tile_pyramid(tile_dir)
+    if pyramid is None:
+        ctx = get_aoi_context(AOI_str)
+        pyramid = write_tile_pyramid(entry['wf'][0], ctx.lat, ctx.lon, tile_dir)
+        prune_tile_pyramids()
+    pyramid['url'] = tile_url(tile_dir)
+
+    return entry['bounds'], pyramid
@@ -0,0 +1,68 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def synthetic_history(n_time=60, shape=(4, 5), nan_frac=0.2, seed=0):
+    """
+    :return: Observed and synthesized water fractions (time x lat x lon) in whole percentages, with missing
+             observations
+    """
+    rng = np.random.default_rng(seed)
+    obs = np.clip(np.round(rng.gamma(2., 15., (n_time,) + shape)), 0, 100)
+    syn = np.clip(np.round(obs * 0.8 + rng.normal(10., 8., obs.shape)), 0, 100)
+    obs[rng.random(obs.shape) < nan_frac] = np.nan
+    return obs, syn
+
+
+def write_history(qm_scaling_path, obs, syn, freq='5D'):
+    """
+    Writes the historical stacks of a quantile scaling folder, one scene every freq from 2020-01-01
+    """
+    coords = {'time': pd.date_range('2020-01-01', periods=len(obs), freq=freq),
+              'lat': 48. - 0.01 * np.arange(obs.shape[1]), 'lon': -97.5 + 0.01 * np.arange(obs.shape[2])}
+    for name, wf in [('hist_real_wf_trim.nc', obs), ('hist_syn_wf_trim.nc', syn)]:
+        xr.DataArray(wf, coords, ('time', 'lat', 'lon'), name='wf').to_netcdf(qm_scaling_path + name,
+                                                                               engine='h5netcdf')
+
+
+def write_aoi(root, shape=(6, 8), n_time=60, seed=0):
+    """
+    Writes a small RedRiver AOI under root: two modes of the repository's TPC models at one NWM site, quantile
+    scaling history and a NWM archive
+    """
+    rng = np.random.default_rng(seed)
+    aoi = os.path.join(root, 'AOI', 'RedRiver', '')
+    for folder in ('RSM', 'TF_model', 'for_qm_scaling', 'nwm_archive'):
+        os.makedirs(aoi + folder, exist_ok=True)
+    models = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'AOI', 'RedRiver', 'TF_model')
+    for mode in (1, 2):
+        name = 'site-05092000_tpc%02d' % mode
+        for ext in ('.h5', '_reference.json'):
+            shutil.copy(os.path.join(models, name + ext), aoi + 'TF_model/' + name + ext)
+
+    lat, lon = 48. - 0.01 * np.arange(shape[0]), -97.5 + 0.01 * np.arange(shape[1])
+    coords = {'lat': lat, 'lon': lon}
+    xr.Dataset({'spatial_modes': (('mode', 'lat', 'lon'), rng.normal(0., 5., (2,) + shape)),
+                'temporal_mean': (('lat', 'lon'), rng.uniform(10., 60., shape)),
+                'hydro_site': (('mode',), np.array(['05092000', '05092000'])),
+                'nwm_site': (('mode',), np.array([7469342, 7469342])),
+                'model_RTPC_mean_sel': (('mode',), np.array([0.1, -0.2])),
+                'model_RTPC_std_sel': (('mode',), np.array([2., 1.5]))},
+               dict(coords, mode=[1, 2])).to_netcdf(aoi + 'RSM/SM_hydro_App.nc', engine='h5netcdf')
+    perm_water = np.zeros(shape)
+    perm_water[0, 0] = 1
+    xr.DataArray(perm_water, coords, ('lat', 'lon'), name='jrc').to_netcdf(aoi + 'RSM/JRC_perm_water.nc',
+                                                                          engine='h5netcdf')
+    xr.DataArray(rng.random(shape) < 0.7, coords, ('lat', 'lon'), name='mask').to_netcdf(
+        aoi + 'for_qm_scaling/qm_spr_r_mask.nc', engine='h5netcdf')
+    write_history(aoi + 'for_qm_scaling/', *synthetic_history(n_time, shape, seed=seed))
+
+    times = pd.date_range('2022-01-01', '2023-08-31')
+    xr.DataArray(rng.uniform(50., 800., (2, len(times))), {'site': [7469342, 7469392], 'time': times},
+                 ('site', 'time'), name='streamflow').to_netcdf(aoi + 'nwm_archive/medium_lt08_App.nc',
+                                                                engine='h5netcdf')
+    return 'RedRiver'
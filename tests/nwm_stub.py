@@ -0,0 +1,90 @@
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class NWMStub:
+    """
+    Local stand-in of the NWM API answering every forecast request after a delay, with an ETag per station and
+    version; records the requests, and the maximum number of requests in flight
+    """
+
+    def __init__(self, delay=0.2, fail_times=None, truncate_times=None):
+        """
+        :param delay: Seconds before each response
+        :param fail_times: Dictionary of the number of 503 responses to send to each station before succeeding;
+                           a negative number fails forever
+        :param truncate_times: Dictionary of the number of responses to cut short (connection closed in the middle
+                               of the body) for each station before succeeding
+        """
+        self.delay = delay
+        self.fail_times = dict(fail_times or {})
+        self.truncate_times = dict(truncate_times or {})
+        self.version = 1
+        self.requests = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parts = urllib.parse.urlsplit(self.path)
+                station = int(urllib.parse.parse_qs(parts.query)['station_id'][0])
+                with stub.lock:
+                    stub.requests.append((station, self.headers.get('If-None-Match'), self.client_address[1]))
+                    stub.inflight += 1
+                    stub.max_inflight = max(stub.max_inflight, stub.inflight)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.inflight -= 1
+                    failures = stub.fail_times.get(station, 0)
+                    if failures > 0:
+                        stub.fail_times[station] = failures - 1
+                    truncated = stub.truncate_times.get(station, 0)
+                    if truncated > 0:
+                        stub.truncate_times[station] = truncated - 1
+                    etag = '"%d-%d"' % (station, stub.version)
+                if failures:
+                    self._send(503, b'')
+                elif self.headers.get('If-None-Match')==etag:
+                    self._send(304, b'', etag)
+                else:
+                    self._send(200, json.dumps(stub.payload(station)).encode(), etag, truncated > 0)
+
+            def _send(self, status, body, etag=None, truncated=False):
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if truncated:
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def payload(self, station):
+        """
+        :return: JSON forecast of a station: one value per hour of a day
+        """
+        return [{"station_id": station, "reference-time": "2026-10-18T00:00:00",
+                 "data": [{"forecast-time": "2026-10-18T%02d:00:00" % hour, "value": float(station % 1000 + self.version)}
+                          for hour in range(24)]}]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
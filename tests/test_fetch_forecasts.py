@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import nwm_forecast
+from http_client import HTTPClient
+from nwm_forecast import LiveSource, fetch_forecasts
+from nwm_stub import NWMStub
+
+
+@pytest.fixture
+def live(monkeypatch):
+    monkeypatch.setattr(nwm_forecast, 'forecast_source', LiveSource())
+    monkeypatch.setattr(nwm_forecast, 'nwm_client', HTTPClient(max_per_host=4, retries=0))
+
+
+def test_duplicate_sites_fetched_once_and_concurrently(live):
+    stub = NWMStub(delay=0.5)
+    try:
+        stations = [7469342, 7469343, 7469344, 7469345] * 3
+        start = time.perf_counter()
+        payloads = fetch_forecasts('short_range', stations, base_url=stub.url)
+        elapsed = time.perf_counter() - start
+    finally:
+        stub.close()
+    assert sorted(payloads) == sorted(set(stations))
+    assert sorted(station for station, _, _ in stub.requests) == sorted(set(stations))
+    # All four in flight at once: about one round trip, not four
+    assert stub.max_inflight == 4
+    assert elapsed < 2 * stub.delay
+
+
+def test_request_timeout_raises(live):
+    stub = NWMStub(delay=1.)
+    try:
+        start = time.perf_counter()
+        with pytest.raises(OSError):
+            fetch_forecasts('short_range', [7469342], base_url=stub.url, timeout=0.2)
+        assert time.perf_counter() - start < stub.delay
+    finally:
+        stub.close()
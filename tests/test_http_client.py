@@ -0,0 +1,82 @@
+import ssl
+import json
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from http_client import HTTPClient
+from nwm_stub import NWMStub
+
+
+@pytest.fixture
+def stub():
+    stub = NWMStub(delay=0.05)
+    yield stub
+    stub.close()
+
+
+def _url(stub, station):
+    return stub.url + 'short_range/streamflow?station_id=%d' % station
+
+
+def test_connections_kept_alive_per_host(stub):
+    client = HTTPClient(max_per_host=4)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(lambda station: client.get(_url(stub, station)), range(7469342, 7469354)))
+    assert [response.status for response in responses] == [200] * 12
+    assert client.stats()['connections'] == 4
+    assert len(set(port for _, _, port in stub.requests)) == 4
+    assert stub.max_inflight <= 4
+    client.close()
+
+
+def test_not_modified_replays_body(stub):
+    client = HTTPClient()
+    first = client.get(_url(stub, 7469342))
+    second = client.get(_url(stub, 7469342))
+    assert second.status == 304 and second.body == first.body
+    assert stub.requests[1][1] == first.headers['ETag']
+    assert client.stats()['not_modified'] == 1
+
+    stub.version += 1
+    third = client.get(_url(stub, 7469342))
+    assert third.status == 200 and third.body != first.body
+
+
+def test_unavailable_retried_to_success(stub):
+    stub.fail_times[7469342] = 2
+    client = HTTPClient(retries=3, backoff=0.01)
+    assert client.get(_url(stub, 7469342)).status == 200
+    assert client.stats()['retried'] == 2
+    assert len(stub.requests) == 3
+
+
+def test_truncated_response_retried(stub):
+    stub.truncate_times[7469342] = 1
+    client = HTTPClient(retries=3, backoff=0.01)
+    response = client.get(_url(stub, 7469342))
+    assert response.status == 200 and response.body == json.dumps(stub.payload(7469342)).encode()
+    assert client.stats()['retried'] == 1
+
+
+def test_retry_budget_exhaustion_raises(stub):
+    stub.fail_times[7469342] = -1
+    client = HTTPClient(retries=3, backoff=0.01, retry_budget=1.)
+    with pytest.raises(urllib.error.HTTPError) as error:
+        client.get(_url(stub, 7469342))
+    assert error.value.code == 503
+    # One retry allowed by the budget instead of the three allowed by retries
+    assert len(stub.requests) == 2
+    with pytest.raises(urllib.error.HTTPError):
+        client.get(_url(stub, 7469342))
+    assert len(stub.requests) == 3
+
+
+def test_global_ssl_context_untouched():
+    default_context = ssl._create_default_https_context
+    import nwm_forecast
+    client = HTTPClient()
+    assert ssl._create_default_https_context is default_context is ssl.create_default_context
+    assert nwm_forecast.nwm_client.ssl_context is not None and client.ssl_context is not None
+    assert client.ssl_context.verify_mode == ssl.CERT_REQUIRED and client.ssl_context.check_hostname
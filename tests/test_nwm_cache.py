@@ -0,0 +1,72 @@
+import os
+import time
+
+import pandas as pd
+
+from nwm_cache import ForecastCache, expiry_time
+
+
+def _fetcher(issue_times, calls):
+    def fetch(run_type, stations):
+        calls.append(list(stations))
+        return {station: [{"station_id": station, "reference-time": issue_times[0],
+                           "data": [{"forecast-time": "2026-10-18T%02d:00:00" % hour, "value": 100.}
+                                    for hour in range(24)]}] for station in stations}
+    return fetch
+
+
+def test_expiry_from_issue_time():
+    issue_time = pd.Timestamp('2026-10-18T06:00:00')
+    assert expiry_time('medium_range', issue_time) == pd.Timestamp('2026-10-18T18:00:00').timestamp()
+    assert expiry_time('short_range', issue_time) == pd.Timestamp('2026-10-18T09:00:00').timestamp()
+
+
+def test_fresh_until_next_cycle_expected(tmp_path, monkeypatch):
+    now = pd.Timestamp('2026-10-18T13:00:00').timestamp()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    issue_times, calls = ['2026-10-18T06:00:00'], []
+    cache = ForecastCache(str(tmp_path), fetch=_fetcher(issue_times, calls))
+
+    cache.get('medium_range', 7469342)
+    cache.get('medium_range', 7469342)
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 1
+    # Read back from disk by another process
+    assert ForecastCache(str(tmp_path)).get('medium_range', 7469342).issue_time == pd.Timestamp(issue_times[0])
+
+
+def test_late_cycle_revalidated_soon(tmp_path, monkeypatch):
+    # 12:00 cycle expected at 18:00 but not published yet
+    now = pd.Timestamp('2026-10-18T19:00:00').timestamp()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    issue_times, calls = ['2026-10-18T06:00:00'], []
+    cache = ForecastCache(str(tmp_path), revalidate_seconds=300, fetch=_fetcher(issue_times, calls))
+
+    cache.get('medium_range', 7469342)
+    assert cache._lookup('medium_range', 7469342)[2] == now + 300
+    now += 200
+    cache.get('medium_range', 7469342)
+    assert len(calls) == 1
+
+    # Once revalidation is due, the entry is served stale while the next cycle is fetched
+    now += 200
+    issue_times[0] = '2026-10-18T12:00:00'
+    cache.get('medium_range', 7469342)
+    for _ in range(100):
+        if cache._lookup('medium_range', 7469342)[0].issue_time == pd.Timestamp(issue_times[0]):
+            break
+        time.sleep(0.01)
+    assert len(calls) == 2
+    entry = cache._lookup('medium_range', 7469342)
+    assert entry[0].issue_time == pd.Timestamp(issue_times[0])
+    assert entry[2] == pd.Timestamp('2026-10-19T00:00:00').timestamp()
+
+
+def test_concurrent_writers_of_one_entry(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = ForecastCache(str(tmp_path), fetch=_fetcher(['2026-10-18T06:00:00'], []))
+    series = cache.get('medium_range', 7469342)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: cache._write_disk('medium_range', series, 0., 1.), range(80)))
+    assert os.listdir(tmp_path / 'medium_range') == ['7469342_20261018T0600.npz']
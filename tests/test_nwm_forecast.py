@@ -0,0 +1,39 @@
+import warnings
+
+import numpy as np
+
+from nwm_forecast import CFS_TO_CMS, daily_discharge, parse_forecast
+
+
+def _payload(points):
+    return [{"station_id": "7469342", "data": [{"forecast-time": t, "value": v} for t, v in points]}]
+
+
+def test_daily_means_skip_missing_values():
+    series = parse_forecast(7469342, _payload([
+        ('2026-10-18T00:00:00', 100.), ('2026-10-18T01:00:00', None), ('2026-10-18T02:00:00', 300.),
+        ('2026-10-19T00:00:00', None), ('2026-10-19T06:00:00', float('nan')),
+        ('2026-10-20T00:00:00', 50.),
+    ]))
+    q = daily_discharge(series, ['2026-10-18', '2026-10-19', '2026-10-20', '2026-10-21'])
+    np.testing.assert_allclose(q[0], 200. * CFS_TO_CMS)
+    # A day without any value, and a day outside the horizon, are NaN
+    assert np.isnan(q[1]) and np.isnan(q[3])
+    np.testing.assert_allclose(q[2], 50. * CFS_TO_CMS)
+
+
+def test_daily_means_use_utc_days():
+    series = parse_forecast(7469342, _payload([
+        ('2026-10-18T23:00:00Z', 10.), ('2026-10-19T05:00:00+06:00', 30.), ('2026-10-19T01:00:00Z', 70.),
+    ]))
+    q = daily_discharge(series, ['2026-10-18', '2026-10-19'])
+    np.testing.assert_allclose(q, [20. * CFS_TO_CMS, 70. * CFS_TO_CMS])
+
+
+def test_utc_offsets_parsed_without_warning():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        series = parse_forecast(7469342, _payload([
+            ('2026-10-19T05:00:00+06:00', 1.), ('2026-10-18T18:30:00-0530', 2.), ('2026-10-19T00:00:00Z', 3.),
+        ]))
+    assert (series.times == np.datetime64('2026-10-18T23:00:00', 's').astype(np.int64) + [0, 3600, 3600]).all()
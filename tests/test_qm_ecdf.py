@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from aoi_stub import write_history
+from qm_tools import perf_qm_ecdf
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import perf_qm_quick
+
+
+def test_same_output_as_quick_with_one_bin_per_scene(tmp_path):
+    qm_scaling_path = str(tmp_path) + '/'
+    rng = np.random.default_rng(0)
+    obs = rng.uniform(0., 100., (40, 6, 7))
+    syn = np.clip(obs * 0.8 + rng.normal(10., 8., obs.shape), 0., 100.)
+    write_history(qm_scaling_path, obs, syn)
+    qm_mask = xr.DataArray(rng.random((6, 7)) < 0.7)
+    fct = rng.uniform(-5., 105., (8, 6, 7))
+
+    # With nbins = n - 1 the quantile levels are the order statistics themselves
+    expected = perf_qm_quick(xr.DataArray(obs), xr.DataArray(syn), fct.copy(), qm_mask, nbins=len(obs) - 1)
+    np.testing.assert_allclose(perf_qm_ecdf(fct.copy(), qm_scaling_path, qm_mask), expected, rtol=0, atol=1e-9)
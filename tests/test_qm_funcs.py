@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+from scipy.interpolate import interp1d
+
+from qm_tools import load_qm_funcs, perf_qm_arrays
+
+
+def _save_funcs(path, offset):
+    funcs = {'r%d_c%d' % (row, col): interp1d([0., 50., 100.], [offset, 50. + offset, 100.], bounds_error=False,
+                                               fill_value=(0., 100.))
+             for row in range(2) for col in range(3)}
+    np.save(path, funcs, allow_pickle=True)
+
+
+def test_converted_funcs_follow_pickled_funcs(tmp_path):
+    qm_scaling_path = str(tmp_path) + '/'
+    _save_funcs(qm_scaling_path + 'wf2quant_funcs.npy', 0.)
+    first = load_qm_funcs(qm_scaling_path, 'wf2quant_funcs', (2, 3))
+    assert first['knots'][1, 0, 1, 0] == 50.
+
+    # Unchanged pickled functions are not converted again
+    mtime = os.path.getmtime(qm_scaling_path + 'wf2quant_funcs_knots.npy')
+    load_qm_funcs(qm_scaling_path, 'wf2quant_funcs')
+    assert os.path.getmtime(qm_scaling_path + 'wf2quant_funcs_knots.npy') == mtime
+
+    _save_funcs(qm_scaling_path + 'wf2quant_funcs.npy', 5.)
+    assert load_qm_funcs(qm_scaling_path, 'wf2quant_funcs', (2, 3))['knots'][1, 0, 1, 0] == 55.
+
+
+def test_same_output_as_pickled_funcs(tmp_path):
+    pytest.importorskip('streamlit')
+    from syn_noaa2 import perf_qm, perf_qm_mon
+
+    qm_scaling_path = str(tmp_path) + '/'
+    rng = np.random.default_rng(0)
+    binmid = np.linspace(0., 1., 101)
+    qsyn = np.sort(rng.uniform(0., 100., (101, 6, 7)), axis=0)
+    qobs = np.sort(rng.uniform(0., 100., (101, 6, 7)), axis=0)
+    wf2quant, quant2wf, wf2quant_mon, quant2wf_mon = {}, {}, {}, {}
+    for row in range(6):
+        for col in range(7):
+            # Pixels without an interpolator are only clipped
+            if (row, col) == (0, 0):
+                continue
+            key = 'r%d_c%d' % (row, col)
+            wf2quant[key] = interp1d(qsyn[:, row, col], binmid, bounds_error=False, fill_value=(0., 1.))
+            quant2wf[key] = interp1d(binmid, qobs[:, row, col], fill_value='extrapolate')
+            wf2quant_mon['mon3_' + key] = interp1d(qsyn[:, row, col], binmid, bounds_error=False,
+                                                   fill_value=(0., 1.))
+            quant2wf_mon['mon3' + key] = interp1d(binmid, qobs[:, row, col] / 2, fill_value='extrapolate')
+    for name, funcs in [('wf2quant_funcs', wf2quant), ('quant2wf_funcs', quant2wf),
+                        ('wf2quant_mon_funcs', wf2quant_mon), ('quant2wf_mon_funcs', quant2wf_mon)]:
+        np.save(qm_scaling_path + name + '.npy', funcs, allow_pickle=True)
+
+    qm_mask = xr.DataArray(rng.random((6, 7)) < 0.7)
+    qm_mask[0, 0] = True
+    fct = rng.uniform(-5., 105., (1, 6, 7))
+
+    np.testing.assert_array_equal(perf_qm_arrays(fct.copy(), qm_scaling_path, qm_mask),
+                                  perf_qm(fct.copy(), qm_scaling_path, qm_mask))
+    np.testing.assert_array_equal(perf_qm_arrays(fct.copy(), qm_scaling_path, qm_mask, '2023-03-15'),
+                                  perf_qm_mon(fct.copy(), '2023-03-15', qm_scaling_path, qm_mask))
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from aoi_stub import synthetic_history, write_history
+from qm_tools import perf_qm_month_tables
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import perf_qm_month_quick
+
+
+def test_same_output_as_month_quick(tmp_path):
+    qm_scaling_path = str(tmp_path) + '/'
+    # Twenty months of scenes, so every month has a history
+    obs, syn = synthetic_history(n_time=120, shape=(6, 7))
+    obs[:, 0, 0] = np.nan
+    write_history(qm_scaling_path, obs, syn)
+    hist_obs = xr.load_dataarray(qm_scaling_path + 'hist_real_wf_trim.nc')
+    hist_syn = xr.load_dataarray(qm_scaling_path + 'hist_syn_wf_trim.nc')
+
+    rng = np.random.default_rng(1)
+    qm_mask = xr.DataArray(rng.random((6, 7)) < 0.7)
+    qm_mask[0, 0] = True
+    # A horizon crossing a month boundary
+    fct_dates = pd.date_range('2023-01-28', periods=8)
+    fct = rng.uniform(-5., 105., (8, 6, 7))
+
+    expected = perf_qm_month_quick(hist_obs, hist_syn, fct.copy(), qm_mask, fct_dates=fct_dates)
+    np.testing.assert_array_equal(perf_qm_month_tables(fct.copy(), fct_dates, qm_scaling_path, qm_mask), expected)
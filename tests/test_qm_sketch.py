@@ -0,0 +1,32 @@
+import numpy as np
+
+from qm_tools import init_qm_sketch, qm_bins, qm_sketch_quantiles, update_qm_sketch
+
+
+def _sketch_quantiles(hist):
+    sketch = update_qm_sketch(init_qm_sketch(hist.shape[1:]), hist)
+    return qm_sketch_quantiles(sketch, qm_bins(100))
+
+
+def test_tied_values_exact():
+    hist = np.concatenate([np.zeros(50), np.full(50, 100.)]).reshape(100, 1, 1)
+    quants = _sketch_quantiles(hist)
+    assert quants[49, 0, 0] == 0.
+    np.testing.assert_array_equal(quants, np.nanquantile(hist, qm_bins(100), axis=0))
+
+
+def test_whole_percentages_exact():
+    rng = np.random.default_rng(0)
+    hist = np.clip(np.round(rng.gamma(2., 15., (365, 4, 5))), 0, 100)
+    hist[rng.random(hist.shape) < 0.2] = np.nan
+    hist[:, 0, 0] = np.nan
+    quants = _sketch_quantiles(hist)
+    assert np.isnan(quants[:, 0, 0]).all()
+    np.testing.assert_array_equal(quants, np.nanquantile(hist, qm_bins(100), axis=0))
+
+
+def test_continuous_values_within_half_bin():
+    rng = np.random.default_rng(1)
+    hist = np.clip(rng.gamma(2., 15., (365, 4, 5)), 0, 100)
+    quants = _sketch_quantiles(hist)
+    assert np.abs(quants - np.nanquantile(hist, qm_bins(100), axis=0)).max() < 0.5
@@ -0,0 +1,30 @@
+import numpy as np
+
+import qm_tools
+from aoi_stub import synthetic_history, write_history
+from qm_tools import build_qm_sketches, load_qm_sketch_tables, load_qm_tables, update_qm_sketch_tables
+
+
+def test_update_folds_new_scenes_only(tmp_path, monkeypatch):
+    qm_scaling_path = str(tmp_path) + '/'
+    obs, syn = synthetic_history()
+
+    write_history(qm_scaling_path, obs[:50], syn[:50])
+    build_qm_sketches(qm_scaling_path)
+    qobs, _, binmid = load_qm_tables(qm_scaling_path)
+    np.testing.assert_array_equal(qobs, np.nanquantile(obs[:50], binmid, axis=0))
+
+    # The update reads neither the historical stacks nor the exact tables
+    write_history(qm_scaling_path, obs, syn)
+    with monkeypatch.context() as m:
+        m.setattr(qm_tools.xr, 'load_dataarray', None)
+        m.setattr(qm_tools.xr, 'open_dataarray', None)
+        update_qm_sketch_tables(qm_scaling_path, obs[50:], syn[50:])
+        # Already folded: a repeated call leaves the sketches as they are
+        update_qm_sketch_tables(qm_scaling_path, obs[50:], syn[50:])
+        qobs, qsyn, _ = load_qm_sketch_tables(qm_scaling_path)
+    np.testing.assert_array_equal(qobs, np.nanquantile(obs, binmid, axis=0))
+    np.testing.assert_array_equal(qsyn, np.nanquantile(syn, binmid, axis=0))
+
+    # The exact tables are still built from the stacks
+    np.testing.assert_array_equal(load_qm_tables(qm_scaling_path)[0], np.nanquantile(obs, binmid, axis=0))
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+import qm_tools
+from aoi_stub import synthetic_history, write_history
+from qm_tools import build_qm_month_tables, build_qm_sorted, build_qm_tables, load_qm_tables
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('build, outputs', [
+    (build_qm_tables, ['qm_tables.npy', 'qm_tables.json']),
+    (build_qm_month_tables, ['qm_month_tables.npy', 'qm_month_tables.json']),
+    (build_qm_sorted, ['qm_sorted.npy', 'qm_sorted_counts.npy', 'qm_sorted.json']),
+])
+def test_tiled_build_same_as_full_build(tmp_path, build, outputs):
+    qm_scaling_path = str(tmp_path) + '/'
+    obs, syn = synthetic_history(n_time=80, shape=(6, 7))
+    obs[:, 0, 0] = np.nan
+    write_history(qm_scaling_path, obs, syn)
+
+    build(qm_scaling_path)
+    full = [_read(qm_scaling_path + name) for name in outputs]
+    # A few pixels per tile
+    build(qm_scaling_path, max_memory=2**16, n_workers=1)
+    assert [_read(qm_scaling_path + name) for name in outputs] == full
+    assert sorted(os.listdir(qm_scaling_path)) == sorted(outputs + ['hist_real_wf_trim.nc', 'hist_syn_wf_trim.nc'])
+
+
+def test_online_rebuild_streams_the_stacks(tmp_path, monkeypatch):
+    qm_scaling_path = str(tmp_path) + '/'
+    obs, syn = synthetic_history()
+    write_history(qm_scaling_path, obs, syn)
+    monkeypatch.setattr(qm_tools.xr, 'load_dataarray', None)
+    qobs, qsyn, binmid = load_qm_tables(qm_scaling_path)
+    np.testing.assert_array_equal(qobs, np.nanquantile(obs, binmid, axis=0))
+    np.testing.assert_array_equal(qsyn, np.nanquantile(syn, binmid, axis=0))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from qm_tools import perf_qm_vectorized
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import perf_qm_quick
+
+
+def test_same_output_as_quick():
+    rng = np.random.default_rng(0)
+    obs = np.clip(rng.gamma(2., 15., (100, 12, 15)), 0, 100)
+    syn = np.clip(obs * 0.8 + rng.normal(10., 8., obs.shape), 0, 100)
+    obs[rng.random(obs.shape) < 0.2] = np.nan
+    syn[rng.random(syn.shape) < 0.2] = np.nan
+    # Pixels with very few or tied valid values
+    obs[:-3, 0, 0] = np.nan
+    obs[:, 0, 1] = 0.
+    fct = np.clip(rng.gamma(2., 15., (8, 12, 15)), 0, 100)
+    qm_mask = xr.DataArray(rng.random((12, 15)) < 0.7)
+    qm_mask[0, :2] = True
+
+    expected = perf_qm_quick(xr.DataArray(obs), xr.DataArray(syn), fct.copy(), qm_mask)
+    np.testing.assert_array_equal(perf_qm_vectorized(obs, syn, fct.copy(), qm_mask), expected)
@@ -0,0 +1,40 @@
+import json
+
+import numpy as np
+import pytest
+
+from aoi_stub import write_aoi
+from response_surface import build_wf_surface, map_errors, surface_paths, surface_wf, validate_wf_surface
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import discharge_to_wf
+
+
+def test_surface_within_tolerance_of_direct_maps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    red_river = write_aoi(str(tmp_path))
+    tol, error_quantile = 1., 0.99
+    build_wf_surface(red_river, tol=tol, n_init=5, max_points=33, error_quantile=error_quantile)
+    with open(surface_paths(red_river)[1]) as f:
+        meta = json.load(f)
+    axes = [np.array(axis) for axis in meta['axes']]
+
+    # Discharges between the nodes, where the interpolation error is largest
+    rng = np.random.default_rng(0)
+    q = np.stack([rng.uniform(axis[0], axis[-1], 20) for axis in axes], axis=1)
+    fct_q = q[:, meta['mode_axis']]
+    direct = discharge_to_wf(red_river, fct_q)
+
+    n_covered = 0
+    for ct in range(len(fct_q)):
+        surf = surface_wf(red_river, 'tables', fct_q[ct:ct + 1])
+        if surf is None:
+            continue
+        n_covered += 1
+        assert map_errors(surf, direct[ct:ct + 1], error_quantile)[0] <= tol
+    assert n_covered
+
+    report = validate_wf_surface(red_river, n_dates=5)
+    assert report['n_covered'] == 0 or report['within_tol']
+    with open(surface_paths(red_river)[1].replace('.json', '_validation.json')) as f:
+        assert json.load(f) == report
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from result_cache import ResultCache
+
+
+def test_concurrent_writers_of_one_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ResultCache(cache_dir=str(tmp_path / 'cache'))
+    entry = dict(wf=np.arange(12.).reshape(1, 3, 4), png=b'png', bounds=[[30., -91.], [31., -90.]], seconds=1.)
+
+    def write(_):
+        cache._write_disk('RedRiver', 'fingerprint', 'key', entry)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(write, range(80)))
+
+    stored = cache._read_disk('RedRiver', 'fingerprint', 'key')
+    np.testing.assert_array_equal(stored['wf'], entry['wf'])
+    assert stored['png'] == b'png'
+    # No temporary file left behind
+    assert sorted(os.listdir(tmp_path / 'cache' / 'RedRiver' / 'fingerprint')) == ['key.npz', 'key.png']
+
+
+def test_put_survives_disk_errors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'cache').write_text('not a directory')
+    cache = ResultCache(cache_dir=str(tmp_path / 'cache'))
+    cache.put('RedRiver', 'key', np.zeros((1, 2, 2)), b'png', [[0., 0.], [1., 1.]], 1.)
+    assert cache.get('RedRiver', 'key')['png'] == b'png'
+
+
+def test_entry_without_png(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ResultCache(cache_dir=str(tmp_path / 'cache'))
+    cache.put('RedRiver', 'key', np.zeros((1, 2, 2)), None, [[0., 0.], [1., 1.]], 1.)
+    cache._memory.clear()
+    assert cache.get('RedRiver', 'key')['png'] is None
+    cache.put('RedRiver', 'key', np.zeros((1, 2, 2)), b'png', [[0., 0.], [1., 1.]], 1.)
+    cache._memory.clear()
+    assert cache.get('RedRiver', 'key')['png'] == b'png'
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import aoi_context
+from aoi_store import convert_aoi_store, store_path
+from aoi_stub import write_aoi
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import run_fier_batch
+
+
+def test_batch_same_as_single_dates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    AOI_str = write_aoi(str(tmp_path))
+    # A horizon crossing a month boundary, for the monthly engine
+    dois = pd.date_range('2023-03-28', periods=6)
+
+    for qm_method in ('tables', 'month_tables', 'ecdf'):
+        batch, bounds = run_fier_batch(AOI_str, dois, 'archive', 'archive', qm_method)
+        assert batch.shape[0] == len(dois)
+        single = [run_fier_batch(AOI_str, [doi], 'archive', 'archive', qm_method)[0].values for doi in dois]
+        # The TPC models run in float32, where a batched product may round differently from single rows
+        np.testing.assert_allclose(batch.values, np.concatenate(single), rtol=0, atol=1e-4)
+
+
+def test_store_same_as_netcdf(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    AOI_str = write_aoi(str(tmp_path))
+    dois = pd.date_range('2023-03-28', periods=6)
+    monkeypatch.setattr(aoi_context, '_contexts', {})
+    expected, bounds = run_fier_batch(AOI_str, dois, 'archive', 'archive')
+
+    convert_aoi_store(AOI_str)
+    assert os.path.isdir(store_path(AOI_str) + 'SM_hydro_App.zarr')
+    monkeypatch.setattr(aoi_context, '_contexts', {})
+    from_store, store_bounds = run_fier_batch(AOI_str, dois, 'archive', 'archive')
+    np.testing.assert_array_equal(from_store.values, expected.values)
+    np.testing.assert_array_equal(from_store.lat, expected.lat)
+    np.testing.assert_array_equal(from_store.lon, expected.lon)
+    assert store_bounds == bounds
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from aoi_context import get_aoi_context
+from aoi_stub import write_aoi
+
+pytest.importorskip('streamlit')
+from syn_noaa2 import synthesize_wf
+
+
+def test_same_output_as_mode_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ctx = get_aoi_context(write_aoi(str(tmp_path)))
+    est_tpc = np.random.default_rng(0).normal(0., 2., (30, len(ctx.modes)))
+
+    # Weighted sum of the spatial modes as run_fier built it, one full-size cube per mode
+    with xr.open_dataset('AOI/RedRiver/RSM/SM_hydro_App.nc', engine='h5netcdf') as xr_RSM:
+        expected = 0
+        for ct_mode, mode in enumerate(xr_RSM.mode.values):
+            sm = xr_RSM.spatial_modes.sel(mode=mode)
+            est_tpc1 = np.tile(est_tpc[:, ct_mode, None, None], (1, sm.sizes['lat'], sm.sizes['lon']))
+            expected = expected + np.tile(sm.values[None, :, :], (est_tpc.shape[0], 1, 1)) * est_tpc1
+        expected = expected + xr_RSM.temporal_mean.values
+
+    np.testing.assert_allclose(synthesize_wf(est_tpc, ctx.spatial_modes(), ctx.wf_mean), expected, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(synthesize_wf(est_tpc, ctx.spatial_modes(np.float32), ctx.wf_mean, np.float32),
+                               expected, rtol=0, atol=1e-4)
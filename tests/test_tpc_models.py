@@ -0,0 +1,33 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pytest
+
+from tpc_models import NumpyTPCModel, check_tpc_model, export_tpc_model, predict_modes, tpc_reference_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS = sorted(glob.glob(os.path.join(ROOT, 'AOI', '*', 'TF_model', 'site-*_tpc*.h5')))
+
+
+@pytest.mark.parametrize('path', MODELS, ids=os.path.basename)
+def test_numpy_engine_reproduces_keras(tmp_path, path):
+    # Outputs recorded with Keras by record_tpc_reference
+    with open(tpc_reference_path(path)) as f:
+        reference = json.load(f)
+    model = NumpyTPCModel(export_tpc_model(path, str(tmp_path / 'model.npz')))
+
+    tpc = predict_modes([model, model], np.repeat(np.reshape(reference['discharges'], (-1, 1)), 2, axis=1))
+    expected = np.float32(reference['tpc'])
+    np.testing.assert_allclose(tpc, np.stack([expected, expected], axis=1), rtol=0,
+                               atol=1e-5 * np.abs(expected).max())
+    assert check_tpc_model(model, path) is not None
+
+
+def test_departing_model_rejected(tmp_path):
+    path = MODELS[0]
+    model = NumpyTPCModel(export_tpc_model(path, str(tmp_path / 'model.npz')))
+    model.layers[-1][2][:] += 1.
+    with pytest.raises(ValueError):
+        check_tpc_model(model, path)
@@ -0,0 +1,45 @@
+import io
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from wf_render import render_wf_png, wf_to_rgba
+
+
+def _map_wf():
+    rng = np.random.default_rng(0)
+    map_wf = rng.uniform(-5., 105., (30, 40))
+    map_wf[:, :3] = [0., 100., 50.]
+    map_wf[rng.random(map_wf.shape) < 0.1] = np.nan
+    return map_wf
+
+
+def _imshow_rgba(map_wf):
+    # The former overlay figure, one figure pixel per grid cell
+    fig = Figure(figsize=(map_wf.shape[1], map_wf.shape[0]), dpi=1)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(map_wf, cmap='jet', vmin=0, vmax=100, interpolation='none')
+    ax.axis('off')
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())
+
+
+def test_same_colors_as_imshow():
+    map_wf = _map_wf()
+    expected = _imshow_rgba(map_wf)
+    # NaN pixels are transparent in the overlay and show the white figure background in imshow
+    valid = ~np.isnan(map_wf)
+    np.testing.assert_array_equal(wf_to_rgba(map_wf)[valid], expected[valid])
+    assert (wf_to_rgba(map_wf)[~valid] == 0).all()
+
+
+def test_png_decodes_to_the_colors():
+    map_wf = _map_wf()
+    png = Image.open(io.BytesIO(render_wf_png(map_wf, transparent_zero=True)))
+    assert png.mode == 'RGBA' and png.size == (40, 30)
+    rgba = wf_to_rgba(map_wf)
+    rgba[map_wf == 0] = 0
+    np.testing.assert_array_equal(np.asarray(png), rgba)
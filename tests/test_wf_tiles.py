@@ -0,0 +1,33 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from wf_tiles import read_tile_pyramid, write_tile_pyramid
+
+
+def _grid():
+    lat = np.linspace(31., 30., 40)
+    lon = np.linspace(-91., -90., 40)
+    map_wf = np.random.default_rng(0).random((40, 40)) * 100
+    return map_wf, lat, lon
+
+
+def test_concurrent_writers_of_one_pyramid(tmp_path):
+    map_wf, lat, lon = _grid()
+    out_dir = str(tmp_path / 'RedRiver' / 'key')
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        metas = list(pool.map(lambda _: write_tile_pyramid(map_wf, lat, lon, out_dir, zooms=(6, 9)), range(4)))
+    assert all(meta['n_tiles'] == metas[0]['n_tiles'] > 0 for meta in metas)
+    assert read_tile_pyramid(out_dir)['n_tiles'] == metas[0]['n_tiles']
+    # No temporary directory left behind
+    assert os.listdir(tmp_path / 'RedRiver') == ['key']
+
+
+def test_finished_pyramid_kept(tmp_path):
+    map_wf, lat, lon = _grid()
+    out_dir = str(tmp_path / 'key')
+    first = write_tile_pyramid(map_wf, lat, lon, out_dir, zooms=(6, 8))
+    second = write_tile_pyramid(map_wf, lat, lon, out_dir + '/', zooms=(6, 8))
+    assert second == first == read_tile_pyramid(out_dir)
+    assert os.listdir(tmp_path) == ['key']
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from qm_tools import _atomic_open
+
+
+def tpc_model_path(AOI_str, site, mode):
+    """
+    :param AOI_str: Area-Of-Interest
+    :param site: Hydrologic site of the mode
+    :param mode: Mode number
+    :return: Path to the Keras model that maps the discharge at the site to the temporal principal component
+    """
+    return 'AOI/'+AOI_str+'/TF_model/site-'+str(site)+'_tpc'+str(mode).zfill(2)+'.h5'
+
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh': np.tanh,
+    'elu': lambda x: np.where(x > 0, x, np.expm1(x)),
+    'softplus': lambda x: np.logaddexp(x, 0),
+}
+
+# Keras clamps the standard deviation of its Normalization layer to backend.epsilon()
+_KERAS_EPSILON = 1e-7
+
+# Discharges (cfs) the Keras reference outputs are recorded at, from no flow to beyond the largest floods
+_REFERENCE_DISCHARGES = np.concatenate([[0.], np.geomspace(10., 3e6, 24)]).astype(np.float32)
+
+
+def _decode(names):
+    return [name.decode() if isinstance(name, bytes) else str(name) for name in names]
+
+
+def export_tpc_model(h5_path, npz_path=None):
+    """
+    Exports the weights and activations of a Keras TPC model (.h5) to a compact .npz for the NumPy engine,
+    reading the HDF5 file directly so TensorFlow is not needed
+
+    :param h5_path: Path to the Keras model
+    :param npz_path: Path to the exported model (default: the model path with the .npz extension)
+    :return: Path to the exported model
+    """
+    import h5py
+
+    npz_path = npz_path or os.path.splitext(h5_path)[0] + '.npz'
+    arrays = {}
+    layers = []
+    with h5py.File(h5_path, 'r') as f:
+        config = json.loads(f.attrs['model_config'])
+        layer_configs = {layer['config']['name']: layer for layer in config['config']['layers']}
+        weights = f['model_weights']
+        for name in _decode(weights.attrs['layer_names']):
+            layer = layer_configs[name]
+            group = weights[name]
+            values = {weight_name.split('/')[-1].split(':')[0]: group[weight_name][()]
+                      for weight_name in _decode(group.attrs['weight_names'])}
+            ct = len(layers)
+            if layer['class_name'] == 'Normalization':
+                if layer['config'].get('invert', False):
+                    raise ValueError('Inverted Normalization layers are not supported: ' + h5_path)
+                arrays['mean_%d' % ct] = values['mean'].astype(np.float32)
+                arrays['variance_%d' % ct] = values['variance'].astype(np.float32)
+                layers.append(['normalization', None])
+            elif layer['class_name'] == 'Dense':
+                activation = layer['config']['activation']
+                if activation not in _ACTIVATIONS:
+                    raise ValueError('Unsupported activation ' + activation + ': ' + h5_path)
+                arrays['kernel_%d' % ct] = values['kernel'].astype(np.float32)
+                arrays['bias_%d' % ct] = values['bias'].astype(np.float32)
+                layers.append(['dense', activation])
+            elif layer['class_name'] not in ('InputLayer', 'Dropout'):
+                raise ValueError('Unsupported layer ' + layer['class_name'] + ': ' + h5_path)
+
+    arrays['layers'] = np.array(json.dumps(layers))
+    with _atomic_open(npz_path) as f:
+        np.savez(f, **arrays)
+
+    return npz_path
+
+
+class NumpyTPCModel:
+    """
+    NumPy forward pass of an exported TPC model, with the same predict interface as the Keras model
+    """
+
+    def __init__(self, npz_path):
+        """
+        :param npz_path: Path to a model exported by export_tpc_model
+        """
+        with np.load(npz_path) as arrays:
+            self.layers = []
+            for ct, (kind, activation) in enumerate(json.loads(str(arrays['layers']))):
+                if kind == 'normalization':
+                    std = np.maximum(np.sqrt(arrays['variance_%d' % ct]), np.float32(_KERAS_EPSILON))
+                    self.layers.append((kind, arrays['mean_%d' % ct], std))
+                else:
+                    self.layers.append((kind, arrays['kernel_%d' % ct], arrays['bias_%d' % ct], activation))
+
+    def predict(self, x, verbose=None):
+        """
+        :param x: Discharges, any shape holding one value per sample
+        :param verbose: Ignored, accepted for compatibility with Keras
+        :return: Predicted temporal principal components (sample x 1), float32
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 1)
+        for layer in self.layers:
+            if layer[0] == 'normalization':
+                x = (x - layer[1]) / layer[2]
+            else:
+                x = _ACTIVATIONS[layer[3]](x @ layer[1] + layer[2])
+        return x
+
+    def get_weights(self):
+        return [array for layer in self.layers for array in layer[1:3]]
+
+
+def tpc_reference_path(path):
+    """
+    :param path: Path to the Keras model (.h5)
+    :return: Path to the outputs of the Keras model recorded by record_tpc_reference
+    """
+    return os.path.splitext(path)[0] + '_reference.json'
+
+
+def record_tpc_reference(path, discharges=_REFERENCE_DISCHARGES):
+    """
+    Records the outputs of a Keras TPC model for fixed discharges next to the model, so the NumPy engine can be
+    checked against Keras without TensorFlow (see check_tpc_model). Needs TensorFlow.
+
+    :param path: Path to the Keras model (.h5)
+    :param discharges: Discharges the model is evaluated at
+    :return: Path to the recorded outputs
+    """
+    discharges = np.asarray(discharges, dtype=np.float32).reshape(-1, 1)
+    tpc = _load_keras_model(path).predict(discharges, verbose=0)
+    reference = {'discharges': discharges[:, 0].tolist(), 'tpc': np.asarray(tpc, dtype=np.float32)[:, 0].tolist()}
+    with _atomic_open(tpc_reference_path(path), 'w') as f:
+        json.dump(reference, f)
+    return tpc_reference_path(path)
+
+
+def check_tpc_model(model, path, rtol=1e-5):
+    """
+    Compares the outputs of a model with the Keras outputs recorded for its Keras file
+
+    :param model: Loaded TPC model
+    :param path: Path to the Keras model (.h5)
+    :param rtol: Tolerance, relative to the largest recorded output
+    :return: Largest absolute difference, None when no outputs were recorded
+    :raise ValueError: When the difference exceeds the tolerance
+    """
+    try:
+        with open(tpc_reference_path(path)) as f:
+            reference = json.load(f)
+    except FileNotFoundError:
+        return None
+    expected = np.asarray(reference['tpc'], dtype=np.float32)
+    error = float(np.max(np.abs(predict_modes([model], reference['discharges'])[:, 0] - expected)))
+    if not error <= rtol * max(float(np.max(np.abs(expected))), 1.):
+        raise ValueError('The NumPy engine departs from the recorded Keras outputs by %g: %s' % (error, path))
+    return error
+
+
+def load_tpc_model(path):
+    """
+    Loads a TPC model with the NumPy engine, exporting the Keras file first when the export is missing or older.
+    Falls back to Keras (and TensorFlow) for models the NumPy engine does not support or does not reproduce (see
+    check_tpc_model).
+
+    :param path: Path to the Keras model (.h5)
+    :return: The loaded model
+    """
+    npz_path = os.path.splitext(path)[0] + '.npz'
+    try:
+        if not os.path.exists(npz_path) or os.path.getmtime(npz_path) < os.path.getmtime(path):
+            export_tpc_model(path, npz_path)
+        model = NumpyTPCModel(npz_path)
+        check_tpc_model(model, path)
+        return model
+    except (ValueError, OSError):
+        return _load_keras_model(path)
+
+
+def predict_modes(models, discharges):
+    """
+    Evaluates the models of all modes for a whole batch of discharges
+
+    :param models: TPC model of each mode
+    :param discharges: Discharge of each sample at the site of each mode (sample x mode)
+    :return: Predicted temporal principal components (sample x mode)
+    """
+    discharges = np.asarray(discharges, dtype=np.float32).reshape(-1, len(models))
+    return np.concatenate([model.predict(discharges[:, ct], verbose=0) for ct, model in enumerate(models)], axis=1)
+
+
+def _load_keras_model(path):
+    from tensorflow.keras import models
+    return models.load_model(path)
+
+
+def _model_nbytes(model, path):
+    try:
+        return int(sum(weight.nbytes for weight in model.get_weights()))
+    except AttributeError:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class ModelRegistry:
+    """
+    Thread-safe in-process registry of the per-mode TPC models, keyed by (AOI, site, mode)
+
+    Each model is loaded once and kept warm across requests and Streamlit reruns. When the models held exceed
+    max_bytes, whole AOIs are evicted, least recently used first (the AOI being served is never evicted).
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, loader=load_tpc_model):
+        """
+        :param max_bytes: Memory cap in bytes of the models held (default: 512 MiB, None for no cap)
+        :param loader: Function loading a model from its path (default: load_tpc_model, the NumPy engine; pass
+                       _load_keras_model to serve with TensorFlow)
+        """
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self._aois = OrderedDict()
+        self._nbytes = {}
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, AOI_str, site, mode):
+        """
+        :param AOI_str: Area-Of-Interest
+        :param site: Hydrologic site of the mode
+        :param mode: Mode number
+        :return: The loaded model
+        """
+        key = (str(site), int(mode))
+        with self._lock:
+            models = self._aois.get(AOI_str)
+            if models is not None and key in models:
+                self._aois.move_to_end(AOI_str)
+                self.hits += 1
+                return models[key]
+            key_lock = self._key_locks.setdefault((AOI_str,) + key, threading.Lock())
+
+        # Load outside the registry lock so other models stay available; the key lock avoids double loads
+        with key_lock:
+            with self._lock:
+                models = self._aois.get(AOI_str)
+                if models is not None and key in models:
+                    self._aois.move_to_end(AOI_str)
+                    self.hits += 1
+                    return models[key]
+                self.misses += 1
+
+            path = tpc_model_path(AOI_str, site, mode)
+            model = self.loader(path)
+            nbytes = _model_nbytes(model, path)
+
+            with self._lock:
+                self._aois.setdefault(AOI_str, {})[key] = model
+                self._aois.move_to_end(AOI_str)
+                self._nbytes[AOI_str] = self._nbytes.get(AOI_str, 0) + nbytes
+                self._evict(keep=AOI_str)
+
+        return model
+
+    def _evict(self, keep):
+        while self.max_bytes is not None and sum(self._nbytes.values()) > self.max_bytes:
+            victim = next((AOI_str for AOI_str in self._aois if AOI_str != keep), None)
+            if victim is None:
+                break
+            del self._aois[victim]
+            del self._nbytes[victim]
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drops every model and resets the counters
+        """
+        with self._lock:
+            self._aois.clear()
+            self._nbytes.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss/eviction counters, hit ratio, bytes held and loaded AOIs
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / requests if requests else 0.,
+                'nbytes': sum(self._nbytes.values()),
+                'aois': list(self._aois),
+            }
+
+
+# Shared by all sessions of the process
+model_registry = ModelRegistry()
+
+
+if __name__ == '__main__':
+    # Offline export of the TPC models, e.g. "python tpc_models.py MississippiRiver RedRiver", or
+    # "python tpc_models.py reference MississippiRiver RedRiver" to record their Keras outputs (needs TensorFlow)
+    import glob
+    record = sys.argv[1:2] == ['reference']
+    for AOI_str in sys.argv[1 + record:]:
+        for h5_path in sorted(glob.glob('AOI/'+AOI_str+'/TF_model/site-*_tpc*.h5')):
+            print(record_tpc_reference(h5_path) if record else export_tpc_model(h5_path))
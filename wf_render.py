@@ -0,0 +1,92 @@
+import zlib
+import struct
+
+import numpy as np
+import matplotlib
+
+# Water fraction range of the colormap, as in the former imshow(..., vmin=0, vmax=100)
+WF_VMIN = 0.
+WF_VMAX = 100.
+
+
+def colormap_lut(cmap='jet', N=256):
+    """
+    :param cmap: Name of the matplotlib colormap
+    :param N: Number of entries
+    :return: RGBA lookup table of the colormap (N x 4, uint8), the colors matplotlib draws, followed by a
+             transparent entry (N + 1 entries in all)
+    """
+    lut = matplotlib.colormaps[cmap].resampled(N)(np.arange(N), bytes=True)
+    lut = np.vstack([lut, np.zeros((1, 4), dtype=np.uint8)])
+    lut.flags.writeable = False
+    return lut
+
+
+_luts = {}
+
+
+def _lut(cmap):
+    lut = _luts.get(cmap)
+    if lut is None:
+        lut = _luts[cmap] = colormap_lut(cmap)
+    return lut
+
+
+def wf_to_rgba(map_wf, cmap='jet', vmin=WF_VMIN, vmax=WF_VMAX, transparent_zero=False):
+    """
+    Maps a water fraction map to colors through the lookup table of the colormap, binned like matplotlib's
+    Normalize and Colormap
+
+    :param map_wf: Water fraction (lat x lon)
+    :param cmap: Name of the matplotlib colormap
+    :param vmin: Water fraction of the first color
+    :param vmax: Water fraction of the last color
+    :param transparent_zero: Also make the pixels without water transparent (NaN always are)
+    :return: RGBA image (lat x lon x 4, uint8)
+    """
+    lut = _lut(cmap)
+    N = len(lut) - 1
+    map_wf = np.asarray(map_wf, dtype=np.float64)
+    transparent = ~np.isfinite(map_wf)
+    if transparent_zero:
+        transparent |= map_wf == 0
+    with np.errstate(invalid='ignore'):
+        scaled = np.clip((map_wf - vmin) / (vmax - vmin) * N, 0, N - 1)
+    # Transparent pixels point to the last entry of the lookup table
+    index = np.where(transparent, N, scaled).astype(np.intp)
+    return lut.take(index, axis=0)
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def encode_png(rgba, compress_level=1):
+    """
+    Encodes an RGBA image as a PNG with zlib, without row filters, which are slow to choose and gain little on
+    colormapped maps
+
+    :param rgba: RGBA image (rows x columns x 4, uint8)
+    :param compress_level: zlib compression level, 1 (fastest) to 9 (smallest)
+    :return: PNG bytes
+    """
+    height, width = rgba.shape[:2]
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = np.asarray(rgba, dtype=np.uint8).reshape(height, -1)
+    return (b'\x89PNG\r\n\x1a\n'
+            + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), compress_level))
+            + _png_chunk(b'IEND', b''))
+
+
+def render_wf_png(map_fct_syn_wf, cmap='jet', transparent_zero=False):
+    """
+    Renders a water fraction map at its native resolution, one pixel per grid cell, without matplotlib figures,
+    so it is thread-safe
+
+    :param map_fct_syn_wf: Water fraction (lat x lon)
+    :param cmap: Name of the matplotlib colormap
+    :param transparent_zero: Also make the pixels without water transparent (NaN always are)
+    :return: PNG bytes of the water fraction map
+    """
+    return encode_png(wf_to_rgba(map_fct_syn_wf, cmap, transparent_zero=transparent_zero))
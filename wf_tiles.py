@@ -0,0 +1,218 @@
+import os
+import json
+import math
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from wf_render import wf_to_rgba, encode_png
+
+TILE_SIZE = 256
+
+# Root of the tile pyramids, served by Streamlit as app/static/ (see .streamlit/config.toml)
+TILE_ROOT = 'static/tiles'
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+    :param lon: Longitude
+    :param lat: Latitude
+    :param zoom: Zoom level
+    :return: Fractional Web-Mercator XYZ tile column and row of the point
+    """
+    n = 2 ** zoom
+    lat = np.clip(lat, -85.0511287798, 85.0511287798)
+    x = (np.asarray(lon) + 180.) / 360. * n
+    y = (1. - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2. * n
+    return x, y
+
+
+def tile_to_lonlat(x, y, zoom):
+    """
+    :param x: Fractional tile column
+    :param y: Fractional tile row
+    :param zoom: Zoom level
+    :return: Longitude and latitude of the point
+    """
+    n = 2 ** zoom
+    lon = np.asarray(x) / n * 360. - 180.
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * np.asarray(y) / n))))
+    return lon, lat
+
+
+def _grid_step(coords):
+    return (coords[-1] - coords[0]) / (len(coords) - 1) if len(coords) > 1 else 1.
+
+
+def tile_zoom_range(lat, lon):
+    """
+    Zoom levels the grid supports: from the level where the grid fits in about one tile to the first level where a
+    tile pixel is no larger than a grid cell; Leaflet upscales the tiles of the last level beyond it
+
+    :param lat: Latitudes of the grid cell centers (regular)
+    :param lon: Longitudes of the grid cell centers (regular)
+    :return: Minimum and maximum zoom levels
+    """
+    cell = min(abs(_grid_step(lon)), abs(_grid_step(lat)))
+    extent = max(abs(lon[-1] - lon[0]), abs(lat[-1] - lat[0])) + cell
+    max_zoom = int(np.clip(math.ceil(math.log2(360. / (TILE_SIZE * cell))), 0, 22))
+    min_zoom = int(np.clip(math.floor(math.log2(360. / extent)), 0, max_zoom))
+    return min_zoom, max_zoom
+
+
+def _nearest_index(coords, values):
+    """
+    :return: Index of the nearest cell of a regular grid for each value, -1 outside the grid
+    """
+    index = np.rint((values - coords[0]) / _grid_step(coords)).astype(np.intp)
+    index[(index < 0) | (index >= len(coords))] = -1
+    return index
+
+
+def render_tile(map_wf, lat, lon, zoom, x, y, transparent_zero=False):
+    """
+    Renders one tile by nearest-neighbour sampling of the grid; the tile rows only depend on the latitude and its
+    columns on the longitude, so the sampling is a single outer-indexed gather
+
+    :param map_wf: Water fraction (lat x lon)
+    :param lat: Latitudes of the grid cell centers (regular)
+    :param lon: Longitudes of the grid cell centers (regular)
+    :param zoom: Zoom level
+    :param x: Tile column
+    :param y: Tile row
+    :param transparent_zero: Also make the pixels without water transparent, see wf_to_rgba
+    :return: PNG bytes of the tile, or None when it holds no data
+    """
+    pixel = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    tile_lon, _ = tile_to_lonlat(x + pixel, y, zoom)
+    _, tile_lat = tile_to_lonlat(x, y + pixel, zoom)
+    rows = _nearest_index(lat, tile_lat)
+    cols = _nearest_index(lon, tile_lon)
+    if (rows < 0).all() or (cols < 0).all():
+        return None
+
+    tile_wf = map_wf[np.ix_(rows, cols)]
+    tile_wf[rows < 0, :] = np.nan
+    tile_wf[:, cols < 0] = np.nan
+    if np.isnan(tile_wf).all() or (transparent_zero and not np.nanmax(tile_wf) > 0):
+        return None
+    return encode_png(wf_to_rgba(tile_wf, transparent_zero=transparent_zero))
+
+
+def write_tile_pyramid(map_wf, lat, lon, out_dir, zooms=None, n_workers=None, transparent_zero=False):
+    """
+    Cuts a water fraction map into a Web-Mercator XYZ tile pyramid (out_dir/{z}/{x}/{y}.png), rendering the tiles
+    in parallel and skipping those without data, and describes it in out_dir/tiles.json. The pyramid is written
+    to a temporary directory of its own first, so readers never see a partial one and concurrent writers of the
+    same pyramid do not clash: when another writer finished out_dir first, its pyramid is kept and returned
+
+    :param map_wf: Water fraction (lat x lon)
+    :param lat: Latitudes of the grid cell centers (regular)
+    :param lon: Longitudes of the grid cell centers (regular)
+    :param out_dir: Directory of the pyramid
+    :param zooms: Minimum and maximum zoom levels (default: see tile_zoom_range)
+    :param n_workers: Number of rendering threads (default: ThreadPoolExecutor's)
+    :param transparent_zero: Also make the pixels without water transparent, see wf_to_rgba
+    :return: Dictionary of the pyramid description
+    """
+    map_wf = np.asarray(map_wf, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    min_zoom, max_zoom = zooms if zooms is not None else tile_zoom_range(lat, lon)
+    south, north = lat.min() - abs(_grid_step(lat)) / 2, lat.max() + abs(_grid_step(lat)) / 2
+    west, east = lon.min() - abs(_grid_step(lon)) / 2, lon.max() + abs(_grid_step(lon)) / 2
+
+    jobs = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        x0, y0 = lonlat_to_tile(west, north, zoom)
+        x1, y1 = lonlat_to_tile(east, south, zoom)
+        for x in range(int(x0), min(int(x1), 2 ** zoom - 1) + 1):
+            for y in range(int(y0), min(int(y1), 2 ** zoom - 1) + 1):
+                jobs.append((zoom, x, y))
+
+    out_dir = out_dir.rstrip('/')
+    parent = os.path.dirname(out_dir) or '.'
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.' + os.path.basename(out_dir) + '.', dir=parent)
+    # Served as static files
+    os.chmod(tmp_dir, 0o755)
+
+    def write_tile(job):
+        zoom, x, y = job
+        png = render_tile(map_wf, lat, lon, zoom, x, y, transparent_zero)
+        if png is None:
+            return 0
+        os.makedirs('%s/%d/%d' % (tmp_dir, zoom, x), exist_ok=True)
+        with open('%s/%d/%d/%d.png' % (tmp_dir, zoom, x, y), 'wb') as f:
+            f.write(png)
+        return 1
+
+    try:
+        st_time = time.time()
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            n_tiles = sum(pool.map(write_tile, jobs))
+
+        meta = dict(min_zoom=min_zoom, max_zoom=max_zoom,
+                    bounds=[[float(south), float(west)], [float(north), float(east)]],
+                    n_tiles=n_tiles, n_skipped=len(jobs) - n_tiles, seconds=time.time() - st_time)
+        with open(tmp_dir + '/tiles.json', 'w') as f:
+            json.dump(meta, f, indent=1)
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            finished = read_tile_pyramid(out_dir)
+            if finished is not None:
+                # Another writer finished the pyramid first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return finished
+            # Leftover of an interrupted write
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.rename(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return meta
+
+
+def read_tile_pyramid(out_dir):
+    """
+    :param out_dir: Directory of the pyramid
+    :return: Dictionary of the pyramid description, or None when there is no complete pyramid
+    """
+    try:
+        with open(out_dir.rstrip('/') + '/tiles.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_tile_pyramids(root=TILE_ROOT, keep=16):
+    """
+    Deletes all but the keep most recently written pyramids under root (one directory level per AOI)
+
+    :param root: Root of the tile pyramids
+    :param keep: Number of pyramids kept
+    """
+    pyramids = []
+    for AOI_dir in (os.path.join(root, name) for name in os.listdir(root)) if os.path.isdir(root) else ():
+        for name in os.listdir(AOI_dir):
+            if name.startswith('.'):
+                # Pyramid being written
+                continue
+            path = os.path.join(AOI_dir, name)
+            if os.path.exists(os.path.join(path, 'tiles.json')):
+                pyramids.append((os.path.getmtime(os.path.join(path, 'tiles.json')), path))
+    for _, path in sorted(pyramids, reverse=True)[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def tile_url(out_dir):
+    """
+    :param out_dir: Directory of the pyramid under static/
+    :return: URL template of the tiles as served by Streamlit's static file serving
+    """
+    return 'app/' + out_dir.strip('/') + '/{z}/{x}/{y}.png'
@@ -0,0 +1,112 @@
+import threading
+
+import numpy as np
+
+from aoi_context import get_aoi_context
+
+
+def mercator_y(lat):
+    """
+    :param lat: Latitude
+    :return: Web-Mercator northing of the latitude, in radians of longitude
+    """
+    return np.arcsinh(np.tan(np.radians(np.asarray(lat, dtype=np.float64))))
+
+
+def _fractional_index(coords, values):
+    """
+    :return: Fractional position of each value in a regular grid (0 at coords[0], 1 at coords[1], ...)
+    """
+    step = (coords[-1] - coords[0]) / (len(coords) - 1) if len(coords) > 1 else 1.
+    return (values - coords[0]) / step
+
+
+class WarpIndex:
+    """
+    Gather table reprojecting a lat/lon (EPSG:4326) grid to Web-Mercator: each output pixel holds the flat indices
+    of its source cells and, for bilinear sampling, their weights, so a map is warped with one take
+
+    The output covers the bounds of the grid (centers of the corner cells) with as many columns as the grid and rows
+    of the same Mercator size as the columns, north up, so an overlay placed on these bounds is undistorted.
+    """
+
+    def __init__(self, lat, lon, method='nearest'):
+        """
+        :param lat: Latitudes of the grid cell centers (regular)
+        :param lon: Longitudes of the grid cell centers (regular)
+        :param method: 'nearest' or 'bilinear'
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        self.method = method
+        self.src_shape = (len(lat), len(lon))
+
+        west, east = lon.min(), lon.max()
+        north, south = mercator_y(lat.max()), mercator_y(lat.min())
+        width = len(lon)
+        height = max(1, int(round((north - south) / np.radians(east - west) * width))) if width > 1 else len(lat)
+        self.shape = (height, width)
+
+        out_lon = west + (np.arange(width) + 0.5) / width * (east - west)
+        out_y = north - (np.arange(height) + 0.5) / height * (north - south)
+        out_lat = np.degrees(np.arctan(np.sinh(out_y)))
+        rows = np.clip(_fractional_index(lat, out_lat), 0, len(lat) - 1)
+        cols = np.clip(_fractional_index(lon, out_lon), 0, len(lon) - 1)
+
+        if method=='nearest':
+            corners = [(np.rint(rows), np.rint(cols), None, None)]
+        elif method=='bilinear':
+            row0, col0 = np.floor(rows), np.floor(cols)
+            row1, col1 = np.minimum(row0 + 1, len(lat) - 1), np.minimum(col0 + 1, len(lon) - 1)
+            d_row, d_col = rows - row0, cols - col0
+            corners = [(row0, col0, 1 - d_row, 1 - d_col), (row0, col1, 1 - d_row, d_col),
+                       (row1, col0, d_row, 1 - d_col), (row1, col1, d_row, d_col)]
+        else:
+            raise ValueError('Unknown warp method: ' + str(method))
+
+        self.index = np.stack([(r.astype(np.int64)[:, None] * len(lon) + c.astype(np.int64)[None, :]).astype(np.int32)
+                               for r, c, _, _ in corners])
+        self.weights = None
+        if method=='bilinear':
+            self.weights = np.stack([(w_r[:, None] * w_c[None, :]).astype(np.float32) for _, _, w_r, w_c in corners])
+        self.index.flags.writeable = False
+
+    def warp(self, map_wf):
+        """
+        :param map_wf: Water fraction on the lat/lon grid (lat x lon)
+        :return: Water fraction on the Web-Mercator grid (height x width); bilinear sampling falls back to the nearest
+                 source cell next to NaN cells
+        """
+        flat = np.asarray(map_wf).reshape(-1)
+        if self.weights is None:
+            return flat.take(self.index[0])
+
+        samples = flat.take(self.index)
+        warped = np.einsum('kij,kij->ij', samples, self.weights)
+        invalid = np.isnan(warped)
+        if invalid.any():
+            nearest = np.take_along_axis(samples, self.weights.argmax(axis=0)[None], axis=0)[0]
+            warped[invalid] = nearest[invalid]
+        return warped
+
+
+_warp_indexes = {}
+_warp_indexes_lock = threading.Lock()
+
+
+def get_warp_index(AOI_str, method='nearest'):
+    """
+    Returns the Web-Mercator gather table of an AOI, built once per process from the grid of its context and
+    rebuilt when the context is reloaded
+
+    :param AOI_str: Area-Of-Interest
+    :param method: 'nearest' or 'bilinear'
+    :return: The WarpIndex
+    """
+    ctx = get_aoi_context(AOI_str)
+    with _warp_indexes_lock:
+        cached = _warp_indexes.get((AOI_str, method))
+        if cached is None or cached[0] is not ctx:
+            cached = (ctx, WarpIndex(ctx.lat, ctx.lon, method))
+            _warp_indexes[(AOI_str, method)] = cached
+    return cached[1]